@@ -0,0 +1,102 @@
+from concurrent.futures import ProcessPoolExecutor
+import statistics
+import argparse
+import datetime
+import platform
+import logging
+import tomllib
+import cases
+import json
+import sys
+import os
+
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s",
+    datefmt="%Y-%m-%d %H:%M:%S"
+)
+
+def load_config():
+    """Load configuration details related to the benchmarks.
+    """
+    with open(os.path.join(os.path.dirname(__file__), "config.toml"), mode="rb") as file:
+        config = tomllib.load(file)
+    return config
+
+def parse_arguments() -> argparse.Namespace:
+    """Parse the command line arguments.
+    """
+    parser = argparse.ArgumentParser(description="Benchmark the feature processing and the mappings with synthetic data.")
+    parser.add_argument("--scales", nargs="+", help="Scales to run instead of the ones in config.toml, e.g., small national.")
+    parser.add_argument("--cases", nargs="+", help="Cases to run instead of all of them, e.g., build_features compute_mappings.")
+    parser.add_argument("--history", help="History file of the results instead of the one in config.toml.")
+    parser.add_argument("--no-record", action="store_true", help="Compare the results to the history without recording them.")
+    return parser.parse_args()
+
+def load_history(path: str) -> list[dict]:
+    """Load the results of the previous benchmark runs, or an empty history if there is none.
+    """
+    if not os.path.exists(path):
+        return []
+    with open(path, "r", encoding="utf-8") as file:
+        return json.load(file)
+
+def save_history(path: str, history: list[dict]):
+    """Save the results of all the benchmark runs.
+    """
+    with open(path, "w", encoding="utf-8") as file:
+        json.dump(history, file, ensure_ascii=False, indent=2)
+
+def find_regressions(history: list[dict], results: list[dict], thresholds: dict) -> list[str]:
+    """Compare the results to the median of the latest previous results of the same case and scale on the same host.
+    A result regresses when its fastest wall time or its peak memory exceeds the baseline by more than the relative
+    threshold. The fastest run is compared instead of the median as it is the least affected by other processes.
+    Returns descriptions of the regressions.
+    """
+    regressions = []
+    for result in results:
+        previous = [record for record in history if all(record[key] == result[key] for key in ["case", "municipalities", "areas", "host"])]
+        previous = previous[-thresholds["baseline_runs"]:]
+        if not previous:
+            continue
+        for metric, threshold in [("min_wall_time_s", thresholds["time_threshold"]), ("peak_rss_mb", thresholds["memory_threshold"])]:
+            baseline = statistics.median(record[metric] for record in previous)
+            if result[metric] > baseline * (1 + threshold):
+                regressions.append(f"{result['case']} at scale {result['scale']}: {metric} {result[metric]:.4g} exceeds the baseline "
+                                   f"{baseline:.4g} by more than {threshold:.0%}")
+    return regressions
+
+def main():
+    arguments = parse_arguments()
+    config = load_config()
+    scales = arguments.scales or config["benchmarks"]["scales"]
+    case_names = cases.case_names(cases.load_stage("features"))
+    if arguments.cases:
+        case_names = [case for case in case_names if case in arguments.cases or case.split("[")[0] in arguments.cases]
+    history_path = arguments.history or config["benchmarks"]["history_file"]
+
+    # Every case is run in a new process, so that the peak memory is of that case only
+    results = []
+    timestamp = datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds")
+    with ProcessPoolExecutor(max_workers=1, max_tasks_per_child=1) as executor:
+        for scale in scales:
+            for case in case_names:
+                result = executor.submit(cases.run_case, case, scale, config).result()
+                logging.info(f"{case} at scale {scale} ({result['areas']} areas): {result['wall_time_s']:.4f} s, "
+                             f"{result['areas_per_second']:.0f} areas/s, peak RSS {result['peak_rss_mb']:.0f} MB")
+                results.append(result | {"timestamp": timestamp, "host": platform.node(), "python": platform.python_version()})
+
+    history = load_history(history_path)
+    regressions = find_regressions(history, results, config["regression"])
+    if not arguments.no_record:
+        logging.info(f"Recording {len(results)} results to {history_path}")
+        save_history(history_path, history + results)
+    for regression in regressions:
+        logging.warning(f"Regression in {regression}")
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+from collections.abc import Callable
+from contextlib import ExitStack
+from types import ModuleType
+import importlib.util
+import pandas as pd
+import numpy as np
+import synthetic_data
+import statistics
+import resource
+import logging
+import time
+import sys
+import os
+
+
+ROOT_DIRECTORY = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", ".."))
+STAGE_DIRECTORIES = {
+    "features": os.path.join(ROOT_DIRECTORY, "feature-engineering", "src", "living-area-features"),
+    "mappings": os.path.join(ROOT_DIRECTORY, "predictive-inferences", "src", "living-area-mappings")
+}
+# The mappings are also computed with the other distance metrics, in float32 and with parallel worker processes
+MAPPING_VARIANTS = ["cosine", "mahalanobis", "float32", "parallel"]
+
+def load_stage(name: str) -> ModuleType:
+    """Import the main module of a stage package under the name of the stage. The directory of the stage is added to
+    the module search path for its own modules.
+    """
+    directory = STAGE_DIRECTORIES[name]
+    if directory not in sys.path:
+        sys.path.append(directory)
+    spec = importlib.util.spec_from_file_location(f"{name}_stage", os.path.join(directory, "__main__.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def case_names(features: ModuleType) -> list[str]:
+    """Names of the benchmark cases in the order they are run. Every feature of the registry is also built on its own
+    and the mappings are also computed with every variant.
+    """
+    feature_cases = [f"build_features[{name}]" for name in features.feature_processing.FEATURE_NAMES]
+    mapping_cases = [f"compute_mappings[{variant}]" for variant in MAPPING_VARIANTS]
+    return ["preprocess_data", "feature_inputs", "linear_combination", "municipality_sums", "build_features", *feature_cases,
+            "normalize_features", "compute_mappings", *mapping_cases]
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of the process in megabytes.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024**2 if sys.platform == "darwin" else peak / 1024
+
+def prepare_inputs(features: ModuleType, raw_data: dict[str, pd.DataFrame]) -> tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+    """Preprocess the raw data and merge the postal code mapping to the postal code info as the features stage does.
+    """
+    tables = features.preprocess_raw_data(raw_data)
+    postal_code_info = tables["postal_code_info_latest"].merge(tables["postal_code_mapping"], how="left", on="Postal code")
+    return postal_code_info, tables["postal_code_info_old"], tables["apartment_prices_areas"], tables["apartment_prices_municipalities"]
+
+def prepare_case(case: str, features: ModuleType, mappings: ModuleType, raw_data: dict[str, pd.DataFrame],
+                 config: dict, resources: ExitStack) -> Callable[[], object]:
+    """Prepare the inputs of the benchmark case outside of the timing and return the function to be timed. Resources
+    used by the function, e.g., the worker processes of the parallel mappings, are entered to the given exit stack.
+    """
+    feature_processing = features.feature_processing
+    if case == "preprocess_data":
+        return lambda: features.preprocess_raw_data(raw_data)
+    if case == "normalize_features":
+        postal_code_info, *tables = prepare_inputs(features, raw_data)
+        inputs = feature_processing.feature_inputs(postal_code_info, *tables)
+        feature_columns = feature_processing.build_features(inputs, postal_code_info["municipality"], index=postal_code_info.index)
+        feature_frame = pd.concat([postal_code_info.loc[:, ["Postal code", "municipality"]], feature_columns.loc[:, feature_processing.FEATURE_NAMES]], axis=1)
+        return lambda: features.normalize_features(feature_frame)
+    if case == "compute_mappings" or case.startswith("compute_mappings[") and case.endswith("]"):
+        variant = case[len("compute_mappings["):-1] if case.endswith("]") else "euclidean"
+        pool = resources.enter_context(mappings.nearest_neighbours.worker_pool(config["benchmarks"]["mapping_workers"] if variant == "parallel" else 1))
+        if variant in mappings.distance_metrics.DTYPES:
+            metric = mappings.distance_metrics.DistanceMetric(dtype=variant)
+        elif variant in mappings.distance_metrics.METRICS:
+            metric = mappings.distance_metrics.DistanceMetric(variant)
+        else:
+            metric = mappings.distance_metrics.DistanceMetric()
+        _, municipality_features, _ = features.compute_features(raw_data)
+        municipalities = sorted(municipality_features)
+        all_features = [municipality_features[municipality] for municipality in municipalities]
+        return lambda: list(mappings.compute_mappings(all_features, municipalities, config["benchmarks"]["memory_limit_mb"], metric=metric,
+                                                      pool=pool))
+
+    postal_code_info, *tables = prepare_inputs(features, raw_data)
+    if case == "feature_inputs":
+        return lambda: feature_processing.feature_inputs(postal_code_info, *tables)
+    inputs = feature_processing.feature_inputs(postal_code_info, *tables)
+    length = len(postal_code_info.index)
+    if case == "linear_combination":
+        return lambda: [feature_processing.linear_combination(inputs, coefficients, length) for feature in feature_processing.FEATURES
+                        for coefficients in (feature.numerator, feature.denominator) if coefficients]
+    if case == "municipality_sums":
+        # The terms of the aggregates of the fallbacks: the numerator and the denominator or the weight of every feature
+        aggregated = [feature for feature in feature_processing.FEATURES if feature.fallback is not None]
+        terms = np.column_stack([feature_processing.linear_combination(inputs, coefficients, length) for feature in aggregated
+                                 for coefficients in (feature.numerator, feature.denominator or {feature.weight: 1})])
+        codes, municipality_names = pd.factorize(postal_code_info["municipality"])
+        return lambda: feature_processing.municipality_sums(terms, codes, len(municipality_names))
+    if case == "build_features":
+        return lambda: feature_processing.build_features(inputs, postal_code_info["municipality"])
+    if case.startswith("build_features[") and case.endswith("]"):
+        feature = next(feature for feature in feature_processing.FEATURES if feature.name == case[len("build_features["):-1])
+        return lambda: feature_processing.build_features(inputs, postal_code_info["municipality"], [feature])
+    raise ValueError(f"Unknown benchmark case: {case}")
+
+def run_case(case: str, scale: str, config: dict) -> dict:
+    """Run a benchmark case at the given scale in the current process, which should be a fresh one for the peak memory
+    to be of the case only. The synthetic data is generated and the case prepared before the timing, and the case is
+    timed at least the configured amount of times and until the runs take the configured minimum duration, so that
+    fast cases are timed enough times to be stable. Returns the result with the median wall time of the runs.
+    """
+    logging.disable(logging.WARNING)
+    features, mappings = [load_stage(name) for name in STAGE_DIRECTORIES]
+    municipality_count, area_count = config["scales"][scale]["municipalities"], config["scales"][scale]["areas"]
+    raw_data = synthetic_data.generate_raw_data(municipality_count, area_count, config["data"]["seed"], config["data"]["missing_rate"],
+                                                config["data"]["placeholders"])
+    with ExitStack() as resources:
+        work = prepare_case(case, features, mappings, raw_data, config, resources)
+        setup_peak_rss = peak_rss_mb()
+        wall_times = []
+        while len(wall_times) < config["benchmarks"]["repeat"] or sum(wall_times) < config["benchmarks"]["min_duration_s"]:
+            start = time.perf_counter()
+            work()
+            wall_times.append(time.perf_counter() - start)
+    wall_time = statistics.median(wall_times)
+    return {
+        "case": case,
+        "scale": scale,
+        "municipalities": municipality_count,
+        "areas": area_count,
+        "repeat": len(wall_times),
+        "wall_time_s": wall_time,
+        "min_wall_time_s": min(wall_times),
+        "areas_per_second": area_count / wall_time,
+        "peak_rss_mb": peak_rss_mb(),
+        "setup_peak_rss_mb": setup_peak_rss
+    }
@@ -0,0 +1,190 @@
+import pandas as pd
+import numpy as np
+
+
+# Variables of the Paavo postal code area query and their labels, in the order of the query
+VARIABLES = {
+    "pinta_ala": "Postinumeroalueen pinta-ala",
+    "he_vakiy": "Asukkaat yhteensä (HE)",
+    "he_miehet": "Miehet (HE)",
+    "he_naiset": "Naiset (HE)",
+    "he_kika": "Asukkaiden keski-ikä (HE)",
+    "he_0_2": "0-2-vuotiaat (HE)",
+    "he_3_6": "3-6-vuotiaat (HE)",
+    "he_7_12": "7-12-vuotiaat (HE)",
+    "he_13_15": "13-15-vuotiaat (HE)",
+    "he_16_17": "16-17-vuotiaat (HE)",
+    "he_18_19": "18-19-vuotiaat (HE)",
+    "he_20_24": "20-24-vuotiaat (HE)",
+    "he_25_29": "25-29-vuotiaat (HE)",
+    "he_30_34": "30-34-vuotiaat (HE)",
+    "he_35_39": "35-39-vuotiaat (HE)",
+    "he_40_44": "40-44-vuotiaat (HE)",
+    "he_45_49": "45-49-vuotiaat (HE)",
+    "he_50_54": "50-54-vuotiaat (HE)",
+    "he_55_59": "55-59-vuotiaat (HE)",
+    "he_60_64": "60-64-vuotiaat (HE)",
+    "he_65_69": "65-69-vuotiaat (HE)",
+    "he_70_74": "70-74-vuotiaat (HE)",
+    "he_75_79": "75-79-vuotiaat (HE)",
+    "he_80_84": "80-84-vuotiaat (HE)",
+    "he_85_": "85 vuotta täyttäneet (HE)",
+    "ko_yliop": "Ylioppilastutkinnon suorittaneet (KO)",
+    "ko_al_kork": "Alemman korkeakoulututkinnon suorittaneet (KO)",
+    "ko_yl_kork": "Ylemmän korkeakoulututkinnon suorittaneet (KO)",
+    "hr_ktu": "Asukkaiden keskitulot (HR)",
+    "hr_mtu": "Asukkaiden mediaanitulot (HR)",
+    "te_taly": "Taloudet yhteensä (TE)",
+    "te_as_valj": "Asumisväljyys (TE)",
+    "te_yks": "Yksinasuvien taloudet (TE)",
+    "te_laps": "Lapsitaloudet (TE)",
+    "te_elak": "Eläkeläisten taloudet (TE)",
+    "te_omis_as": "Omistusasunnoissa asuvat taloudet (TE)",
+    "te_vuok_as": "Vuokra-asunnoissa asuvat taloudet (TE)",
+    "tr_kuty": "Taloudet yhteensä (TR)",
+    "ra_ke": "Kesämökit yhteensä (RA)",
+    "ra_raky": "Rakennukset yhteensä (RA)",
+    "ra_asunn": "Asunnot (RA)",
+    "ra_as_kpa": "Asuntojen keskipinta-ala (RA)",
+    "ra_pt_as": "Pientaloasunnot (RA)",
+    "ra_kt_as": "Kerrostaloasunnot (RA)",
+    "ra_muu_as": "Muut rakennukset yhteensä (RA)",
+    "pt_tyoll": "Työlliset (PT)",
+    "pt_tyott": "Työttömät (PT)",
+    "pt_0_14": "0-14-vuotiaat (PT)",
+    "pt_opisk": "Opiskelijat (PT)",
+    "pt_elakel": "Eläkeläiset (PT)"
+}
+
+AGE_GROUPS = [code for code in VARIABLES if code.startswith("he_") and code[3].isdigit()]
+# Variables of areas with few inhabitants which are confidential in Paavo, i.e., have the placeholder ".."
+CONFIDENTIAL_VARIABLES = ["he_kika", "hr_ktu", "hr_mtu", "te_as_valj", "ko_yliop", "ko_al_kork", "ko_yl_kork", "tr_kuty"]
+# Variables that are not defined for areas without inhabitants, i.e., have the placeholder "."
+UNDEFINED_VARIABLES = ["he_kika", "hr_ktu", "hr_mtu", "te_as_valj", "ra_as_kpa"]
+# Totals that are never missing, as they are the denominators of the other variables
+COMPLETE_VARIABLES = ["pinta_ala", "he_vakiy", "te_taly", "ra_asunn"]
+CONFIDENTIALITY_LIMIT = 30
+
+def municipality_names(municipality_count: int) -> pd.Series:
+    """Names of the synthetic municipalities indexed by their three digit municipality codes.
+    """
+    codes = [f"{code:03d}" for code in range(1, municipality_count + 1)]
+    return pd.Series([f"Kunta {code}" for code in codes], index=codes)
+
+def area_counts(municipality_count: int, area_count: int) -> np.ndarray:
+    """Distribute the postal code areas to the municipalities with a long tail, as in Finland: a few municipalities
+    have most of the areas and most municipalities have only a few of them. Every municipality has at least one area.
+    """
+    if area_count < municipality_count:
+        raise ValueError(f"At least one area per municipality is needed, got {area_count} areas for {municipality_count} municipalities")
+    weights = 1 / np.arange(1, municipality_count + 1) ** 0.8
+    counts = 1 + np.floor(weights / weights.sum() * (area_count - municipality_count)).astype(int)
+    counts[:area_count - counts.sum()] += 1
+    return counts
+
+def with_placeholders(values: np.ndarray, confidential: np.ndarray, undefined: np.ndarray, placeholders: bool) -> pd.Series:
+    """Mark the missing values of a variable either with the placeholders of the StatsFin API, ".." for confidential
+    and "." for undefined values, or as nulls of a nullable column, as the extraction stage parses them.
+    """
+    if placeholders:
+        column = pd.Series(values, dtype=object)
+        column[confidential] = ".."
+        column[undefined] = "."
+        return column
+    column = pd.Series(values).convert_dtypes(convert_string=False, convert_boolean=False)
+    column[confidential | undefined] = pd.NA
+    return column
+
+def postal_code_info(postal_codes: np.ndarray, population: np.ndarray, rng: np.random.Generator, missing_rate: float,
+                     placeholders: bool) -> pd.DataFrame:
+    """Generate the Paavo information of the postal code areas with the given populations. The counts of the
+    variables are consistent with the population, e.g., the age groups sum to it, and the variables of sparsely
+    populated areas are confidential.
+    """
+    n = len(postal_codes)
+    values = {}
+    values["pinta_ala"] = np.round(rng.lognormal(15, 1.5, n)).astype(np.int64)
+    values["he_vakiy"] = population
+    values["he_miehet"] = rng.binomial(population, 0.49)
+    values["he_naiset"] = population - values["he_miehet"]
+    values["he_kika"] = np.round(rng.normal(42, 6, n)).clip(20, 70).astype(np.int64)
+    age_shares = rng.dirichlet(np.full(len(AGE_GROUPS), 4.0), n)
+    for code, counts in zip(AGE_GROUPS, rng.multinomial(population, age_shares).T):
+        values[code] = counts
+    adults = population - values["he_0_2"] - values["he_3_6"] - values["he_7_12"] - values["he_13_15"] - values["he_16_17"]
+    values["ko_yliop"] = rng.binomial(adults, 0.4)
+    values["ko_al_kork"] = rng.binomial(adults, 0.15)
+    values["ko_yl_kork"] = rng.binomial(adults, 0.12)
+    values["hr_mtu"] = np.round(rng.lognormal(np.log(26000), 0.2, n)).astype(np.int64)
+    values["hr_ktu"] = np.round(values["hr_mtu"] * rng.uniform(1.05, 1.4, n)).astype(np.int64)
+    households = rng.binomial(population, 0.5)
+    values["te_taly"] = households
+    values["te_as_valj"] = np.round(rng.uniform(25, 60, n), 1)
+    values["te_yks"] = rng.binomial(households, 0.45)
+    values["te_laps"] = rng.binomial(households, 0.2)
+    values["te_elak"] = rng.binomial(households, 0.25)
+    values["te_vuok_as"] = rng.binomial(households, rng.beta(2, 3, n))
+    values["te_omis_as"] = households - values["te_vuok_as"]
+    values["tr_kuty"] = households
+    dwellings = households + rng.binomial(households, 0.1)
+    values["ra_ke"] = rng.poisson(5, n)
+    values["ra_raky"] = rng.binomial(dwellings, 0.3) + values["ra_ke"]
+    values["ra_asunn"] = dwellings
+    values["ra_as_kpa"] = np.round(rng.uniform(45, 110, n)).astype(np.int64)
+    values["ra_kt_as"] = rng.binomial(dwellings, rng.beta(2, 2, n))
+    values["ra_pt_as"] = rng.binomial(dwellings - values["ra_kt_as"], 0.9)
+    values["ra_muu_as"] = dwellings - values["ra_kt_as"] - values["ra_pt_as"]
+    values["pt_tyoll"] = rng.binomial(adults, 0.45)
+    values["pt_tyott"] = rng.binomial(adults, 0.05)
+    values["pt_0_14"] = values["he_0_2"] + values["he_3_6"] + values["he_7_12"] + rng.binomial(values["he_13_15"], 0.6)
+    values["pt_opisk"] = rng.binomial(adults, 0.08)
+    values["pt_elakel"] = rng.binomial(adults, 0.22)
+
+    df = pd.DataFrame({"Postal code": postal_codes})
+    uninhabited = population == 0
+    sparse = (population > 0) & (population < CONFIDENTIALITY_LIMIT)
+    for code, label in VARIABLES.items():
+        confidential = (sparse if code in CONFIDENTIAL_VARIABLES else np.zeros(n, dtype=bool)) | (rng.random(n) < missing_rate)
+        confidential &= code not in COMPLETE_VARIABLES
+        undefined = uninhabited if code in UNDEFINED_VARIABLES else np.zeros(n, dtype=bool)
+        df[label] = with_placeholders(values[code], confidential & ~undefined, undefined, placeholders)
+    return df
+
+def generate_raw_data(municipality_count: int, area_count: int, seed: int = 0, missing_rate: float = 0.02,
+                      placeholders: bool = True) -> dict[str, pd.DataFrame]:
+    """Generate synthetic raw data tables shaped like the outputs of the extraction stage, with the same names,
+    columns and missing values as the data of the StatsFin API. The postal code areas are distributed to the
+    municipalities with a long tail, the information of five years ago has the same postal code areas with the
+    newest areas missing, and about a third of the areas lack an apartment price of their own.
+    """
+    rng = np.random.default_rng(seed)
+    municipalities = municipality_names(municipality_count)
+    postal_codes = np.char.zfill(np.sort(rng.choice(100000, area_count, replace=False)).astype(str), 5)
+    area_municipalities = np.repeat(municipalities.to_numpy(), area_counts(municipality_count, area_count))
+    postal_code_mapping = pd.DataFrame({"Postal code": postal_codes, "name": [f"Alue {postal_code}" for postal_code in postal_codes],
+                                        "municipality": area_municipalities})
+
+    # A few areas are uninhabited and a few sparsely populated, the rest follow a long tailed distribution
+    population = np.round(rng.lognormal(7.5, 1.3, area_count)).astype(np.int64)
+    population[rng.random(area_count) < 0.03] = 0
+    sparse = rng.random(area_count) < 0.03
+    population[sparse] = rng.integers(1, CONFIDENTIALITY_LIMIT, sparse.sum())
+    old_population = np.round(population * rng.uniform(0.85, 1.1, area_count)).astype(np.int64)
+    new_areas = rng.random(area_count) < 0.01
+    postal_code_info_latest = postal_code_info(postal_codes, population, rng, missing_rate, placeholders)
+    postal_code_info_old = postal_code_info(postal_codes, old_population, rng, missing_rate, placeholders)
+    postal_code_info_old.loc[new_areas, postal_code_info_old.columns[1:]] = "." if placeholders else pd.NA
+
+    municipality_prices = np.round(rng.lognormal(np.log(2000), 0.35, municipality_count)).astype(np.int64)
+    area_prices = np.round(pd.Series(area_municipalities).map(dict(zip(municipalities, municipality_prices))).to_numpy() * rng.lognormal(0, 0.3, area_count))
+    apartment_prices_areas = pd.DataFrame({"Postal code": postal_codes, "Neliöhinta EUR/m2": with_placeholders(
+        area_prices.astype(np.int64), rng.random(area_count) < 0.35, np.zeros(area_count, dtype=bool), placeholders)})
+    apartment_prices_municipalities = pd.DataFrame({"Municipality code": municipalities.index, "Neliöhinta EUR/m2": pd.array(municipality_prices, dtype="Int64"),
+                                                    "municipality": municipalities.to_numpy()})
+    return {
+        "postal_code_info_latest": postal_code_info_latest,
+        "postal_code_info_old": postal_code_info_old,
+        "apartment_prices_areas": apartment_prices_areas,
+        "apartment_prices_municipalities": apartment_prices_municipalities,
+        "postal_code_mapping": postal_code_mapping
+    }
@@ -1,11 +1,19 @@
-from google.cloud import storage
+import pandas as pd
+import argparse
 import logging
 import tomllib
+import io
 import os
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from statfin_client import StatFinClient
+from storage_backends import StorageBackend, create_backends
+import instrumentation
+import manifest
+import columnar
 from api_calls import extract_apartment_price_info_for_areas, \
         extract_apartment_price_info_for_municipalities, extract_postal_code_info, \
-        extract_postal_code_mapping
+        extract_postal_code_info_history, extract_postal_code_mapping, history_year
 
 
 logging.basicConfig(
@@ -21,31 +29,110 @@ def load_config():
         config = tomllib.load(file)
     return config
 
+def parse_arguments() -> argparse.Namespace:
+    """Parse the command line arguments.
+    """
+    parser = argparse.ArgumentParser(description="Extract data from StatsFin API for postal code area analysis.")
+    parser.add_argument("--offline", action="store_true", help="Replay all API responses from the response cache without network access.")
+    return parser.parse_args()
+
+def extraction_years() -> dict[str, str]:
+    """Years of the extracted data: the latest and the five years older postal code area info, which is published with
+    a delay of two years, and the apartment prices of the previous year.
+    """
+    current_year = datetime.now().year
+    return {"postal_code_info_latest": str(current_year - 2), "postal_code_info_old": str(current_year - 7),
+            "apartment_prices": str(current_year - 1)}
+
+def history_years(config: dict, years: dict[str, str]) -> list[str]:
+    """Years of the postal code area info in the history mode: from the first year of the configuration, or the year
+    of the older info if it is earlier, to the year of the latest info.
+    """
+    first_year = min(config["history"]["first_year"], int(years["postal_code_info_old"]))
+    return [str(year) for year in range(first_year, int(years["postal_code_info_latest"]) + 1)]
+
+def load_previous_history(backend: StorageBackend, storage_format: str) -> pd.DataFrame | None:
+    """Read the postal code area info panel of the previous run from the storage, or None if there is none.
+    """
+    blob_name = columnar.artifact_name("postal_code_info_history", storage_format)
+    if not backend.exists(blob_name):
+        return None
+    if storage_format == "columnar":
+        return columnar.read_table(backend.local_path(blob_name) or backend.read(blob_name))
+    return pd.read_csv(io.BytesIO(backend.read(blob_name)), sep=";", dtype={"Postal code": str})
+
+@instrumentation.timed
+def extract_raw_data(config: dict, years: dict[str, str], offline: bool = False, previous_history: pd.DataFrame | None = None) -> dict[str, pd.DataFrame]:
+    """Extract the raw data from the StatsFin API for the municipalities of the configuration. Returns the raw data
+    tables by their names, with the postal code or the municipality code as the first column. In the history mode, the
+    postal code area info of all the years is extracted as one panel, updating the previous panel with the new years,
+    and the latest and the older info are taken from the panel.
+    """
+    municipalities = config["extraction"]["municipalities"]
+    client = StatFinClient.from_config(config, offline)
+    raw_data = {}
+    with ThreadPoolExecutor(max_workers=config["extraction"]["max_workers"]) as executor:
+        apartment_prices_areas_future = executor.submit(extract_apartment_price_info_for_areas, client, config["sources"]["apartment_prices_area_url"], years["apartment_prices"])
+        apartment_prices_municipalities_future = executor.submit(extract_apartment_price_info_for_municipalities, client, config["sources"]["apartment_prices_municipality_url"], years["apartment_prices"], municipalities)
+        postal_code_mapping = extract_postal_code_mapping(client, config["sources"]["postal_code_url"], municipalities)
+        postal_codes = postal_code_mapping["Postal code"].to_list()
+        if config["history"]["enabled"]:
+            history = extract_postal_code_info_history(client, config["sources"]["postal_code_url"], postal_codes, history_years(config, years), previous_history,
+                                                       config["extraction"]["cell_limit"], config["extraction"]["max_workers"])
+            postal_code_info_latest = history_year(history, years["postal_code_info_latest"])
+            postal_code_info_old = history_year(history, years["postal_code_info_old"])
+            raw_data["postal_code_info_history"] = history
+        else:
+            postal_code_info_latest_future = executor.submit(extract_postal_code_info, client, config["sources"]["postal_code_url"], postal_codes, years["postal_code_info_latest"], config["extraction"]["cell_limit"], config["extraction"]["max_workers"])
+            postal_code_info_old_future = executor.submit(extract_postal_code_info, client, config["sources"]["postal_code_url"], postal_codes, years["postal_code_info_old"], config["extraction"]["cell_limit"], config["extraction"]["max_workers"])
+            postal_code_info_latest = postal_code_info_latest_future.result()
+            postal_code_info_old = postal_code_info_old_future.result()
+        apartment_prices_areas = apartment_prices_areas_future.result()
+        apartment_prices_municipalities = apartment_prices_municipalities_future.result()
+
+    return {
+        "postal_code_info_latest": postal_code_info_latest.rename_axis("Postal code").reset_index(),
+        "postal_code_info_old": postal_code_info_old.rename_axis("Postal code").reset_index(),
+        "apartment_prices_areas": apartment_prices_areas.rename_axis("Postal code").reset_index(),
+        "apartment_prices_municipalities": apartment_prices_municipalities.rename_axis("Municipality code").reset_index(),
+        "postal_code_mapping": postal_code_mapping
+    } | raw_data
+
+@instrumentation.timed
+def store_raw_data(backend: StorageBackend, raw_data: dict[str, pd.DataFrame], storage_format: str, parameters: dict,
+                   max_workers: int = 8):
+    """Upload the changed raw data tables to the storage concurrently and save the manifest of the extraction.
+    """
+    previous_manifest = manifest.load_manifest(backend, "extraction_manifest.json")
+    previous_outputs = {} if previous_manifest is None else previous_manifest["outputs"]
+
+    def upload(name: str, df: pd.DataFrame) -> tuple[str, str]:
+        blob_name = columnar.artifact_name(name, storage_format)
+        data = columnar.to_parquet(df) if storage_format == "columnar" else df.to_csv(index=False, sep=";")
+        return blob_name, manifest.upload_if_changed(backend, blob_name, data, previous_outputs)
+
+    logging.info("Uploading the changed dataframes to the storage")
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        outputs = dict(executor.map(upload, raw_data.keys(), raw_data.values()))
+    manifest.save_manifest(backend, "extraction_manifest.json", {}, outputs, parameters)
+
 def main():
+    arguments = parse_arguments()
     config = load_config()
-    current_year = datetime.now().year
-    postal_code_mapping = extract_postal_code_mapping(config["sources"]["postal_code_url"])
-    postal_code_info_latest = extract_postal_code_info(config["sources"]["postal_code_url"], postal_code_mapping["Postal code"].to_list(), str(current_year - 2))
-    postal_code_info_old = extract_postal_code_info(config["sources"]["postal_code_url"], postal_code_mapping["Postal code"].to_list(), str(current_year - 7))
-    apartment_prices_areas = extract_apartment_price_info_for_areas(config["sources"]["apartment_prices_area_url"], str(current_year - 1))
-    apartment_prices_municipalities = extract_apartment_price_info_for_municipalities(config["sources"]["apartment_prices_municipality_url"], str(current_year - 1))
-
-    logging.info("Creating client for authenticating to GCP")
-    storage_client = storage.Client(project=config["cloud"]["project_id"])
-    bucket = storage_client.bucket(config["cloud"]["bucket_name"])
-    postal_code_info_latest_blob = bucket.blob("postal_code_info_latest.csv")
-    postal_code_info_old_blob = bucket.blob("postal_code_info_old.csv")
-    apartment_prices_areas_blob = bucket.blob("apartment_prices_areas.csv")
-    apartment_prices_municipalities_blob = bucket.blob("apartment_prices_municipalities.csv")
-    postal_code_mapping_blob = bucket.blob("postal_code_mapping.csv")
-    
-    logging.info("Uploading the dataframes as csv-files to GCP cloud storage bucket")
-    postal_code_info_latest_blob.upload_from_string(postal_code_info_latest.to_csv(index=True, sep=";", index_label="Postal code"))
-    postal_code_info_old_blob.upload_from_string(postal_code_info_old.to_csv(index=True, sep=";", index_label="Postal code"))
-    apartment_prices_areas_blob.upload_from_string(apartment_prices_areas.to_csv(index=True, sep=";", index_label="Postal code"))
-    apartment_prices_municipalities_blob.upload_from_string(apartment_prices_municipalities.to_csv(index=True, sep=";"))
-    postal_code_mapping_blob.upload_from_string(postal_code_mapping.to_csv(index=False, sep=";"))
+    instrumentation.configure(config["instrumentation"]["metrics_file"], "extraction")
+    with instrumentation.span("extraction"):
+        years = extraction_years()
+        logging.info("Creating the storage backend")
+        backend = create_backends(config, {"raw_data": config["cloud"]["bucket_name"]})["raw_data"]
+        previous_history = load_previous_history(backend, config["storage"]["format"]) if config["history"]["enabled"] else None
+        raw_data = extract_raw_data(config, years, arguments.offline, previous_history)
+
+        parameters = {"municipalities": config["extraction"]["municipalities"], "years": list(years.values())}
+        if config["history"]["enabled"]:
+            parameters["history_years"] = history_years(config, years)
+        store_raw_data(backend, raw_data, config["storage"]["format"], parameters, config["storage"]["max_workers"])
 
 
 if __name__ == "__main__":
-    main()
+    with instrumentation.profiled("extraction"):
+        main()
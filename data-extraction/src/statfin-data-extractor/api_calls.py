@@ -1,87 +1,162 @@
 import pandas as pd
+import numpy as np
 import os
 import json
-import requests
+from statfin_client import StatFinClient
+from query_chunks import fetch_chunked
+import instrumentation
 import logging
 import re
 import csv
 
 
-def extract_postal_code_mapping(url: str) -> pd.DataFrame:
-    """Extract the postal codes and their names from StatsFin API.
+@instrumentation.timed
+def extract_postal_code_mapping(client: StatFinClient, url: str, municipalities: list[str] | str) -> pd.DataFrame:
+    """Extract the postal codes and their names from StatsFin API. Only the postal code areas of the given
+    municipalities are kept, unless the municipalities are "all".
     """
     logging.info("Extracting names for postal code areas")
     with open(os.path.join(os.path.dirname(__file__), "queries", "postal_codes_query.json"), "r") as file:
         query = json.load(file)
-    response = requests.post(url=url, json=query)
-    if response.status_code != 200:
-        logging.error(f"Request to Postal code API server failed with status code: {response.status_code}")
-        raise Exception("No response from API")
+    response = client.post(url, query)
     content = response.text
     postal_codes_combined = [re.split("\s+", line[0], 1) for line in list(csv.reader(content.splitlines(), delimiter=','))[2:]]
     postal_code_mapping = [[pair[0], pair[1].split("(")[0].strip(),  pair[1].split("(")[1].replace(")", "")] for pair in postal_codes_combined]
     df = pd.DataFrame(postal_code_mapping, columns=["Postal code", "name", "municipality"])
-    filtered_df = df.loc[df["municipality"].isin(["Helsinki", "Espoo", "Tampere", "Oulu", "Vantaa", "Turku"]),:]
+    if municipalities == "all":
+        filtered_df = df
+    else:
+        filtered_df = df.loc[df["municipality"].isin(municipalities),:]
     logging.info(f"Received {len(filtered_df.index)} postal code area names")
     return filtered_df
 
-def extract_postal_code_info(url: str, postal_codes: list[str], year: str) -> pd.DataFrame:
-    """Extract information related to postal codes of the specified year from StatsFin API.
+@instrumentation.timed
+def extract_postal_code_info(client: StatFinClient, url: str, postal_codes: list[str], year: str, cell_limit: int = 100000,
+                             max_workers: int = 4) -> pd.DataFrame:
+    """Extract information related to postal codes of the specified year from StatsFin API. The query is split into
+    chunks that stay under the cell limit of the API, and the values are parsed to typed columns with missing values
+    as nulls.
     """
     logging.info(f"Extracting postal code information of year {year}")
     with open(os.path.join(os.path.dirname(__file__), "queries", "postal_area_basics_query.json"), "r") as file:
         query = json.load(file)
     query["query"][0]["selection"]["values"] = postal_codes
     query["query"][2]["selection"]["values"] = [year]
-    response = requests.post(url=url, json=query)
-    if response.status_code != 200:
-        logging.error(f"Request to Postal code API server failed with status code: {response.status_code}")
-        raise Exception("No response from API")
-    content = response.json()
-    result = {}
-    for area in content["data"]:
-        code = area["key"][0]
-        result[code] = area["values"]
-    columns = [column["text"] for column in content["columns"][2:]]
-    df = pd.DataFrame.from_dict(result, orient="index", columns=columns)
+    values, labels = fetch_chunked(client, url, query, [0, 1, 2], cell_limit, max_workers)
+    variables = query["query"][1]["selection"]["values"]
+    df = pd.DataFrame(values[:, :, 0], index=postal_codes, columns=[labels[1].get(variable, variable) for variable in variables])
+    df = df.convert_dtypes(convert_string=False, convert_boolean=False)
     logging.info(f"Received information for {len(df.index)} postal code areas")
     return df
 
-def extract_apartment_price_info_for_areas(url: str, year: str) -> pd.DataFrame:
+def fetch_postal_code_info_history(client: StatFinClient, url: str, postal_codes: list[str], years: list[str],
+                                   cell_limit: int, max_workers: int) -> pd.DataFrame:
+    """Fetch the postal code information of the given postal codes and years with one query split into chunks under
+    the cell limit, as panel rows of every postal code area and year.
+    """
+    logging.info(f"Extracting postal code information of {len(postal_codes)} postal code areas of years {', '.join(years)}")
+    with open(os.path.join(os.path.dirname(__file__), "queries", "postal_area_basics_query.json"), "r") as file:
+        query = json.load(file)
+    query["query"][0]["selection"]["values"] = postal_codes
+    query["query"][2]["selection"]["values"] = years
+    values, labels = fetch_chunked(client, url, query, [0, 1, 2], cell_limit, max_workers)
+    variables = query["query"][1]["selection"]["values"]
+    # The axes of the values are the postal codes, the variables and the years, the rows of the panel are the postal
+    # codes and the years
+    df = pd.DataFrame(values.transpose(0, 2, 1).reshape(-1, len(variables)), columns=[labels[1].get(variable, variable) for variable in variables])
+    df.insert(0, "Year", np.tile(np.array(years, dtype=int), len(postal_codes)))
+    df.insert(0, "Postal code", np.repeat(np.array(postal_codes, dtype=object), len(years)))
+    return df.convert_dtypes(convert_string=False, convert_boolean=False)
+
+@instrumentation.timed
+def extract_postal_code_info_history(client: StatFinClient, url: str, postal_codes: list[str], years: list[str],
+                                     previous_history: pd.DataFrame | None = None, cell_limit: int = 100000,
+                                     max_workers: int = 4) -> pd.DataFrame:
+    """Extract information related to postal codes of the given years from StatsFin API as one panel with a row for
+    every postal code area and year, sorted by the postal code and the year. The rows of the previous panel are kept
+    for the postal code areas that have all of its years, so only the new years of those areas and all the years of
+    the new areas are fetched, each with one query split into chunks under the cell limit. Areas and years that are
+    no longer wanted are dropped from the panel.
+    """
+    frames = []
+    fetches = [(postal_codes, years)]
+    if previous_history is not None:
+        previous_history = previous_history.loc[previous_history["Postal code"].isin(postal_codes) & previous_history["Year"].astype(str).isin(years)]
+        previous_years = sorted(set(previous_history["Year"].astype(str)))
+        year_counts = previous_history.groupby("Postal code")["Year"].nunique()
+        known = set(year_counts.index[year_counts == len(previous_years)])
+        known_codes = [postal_code for postal_code in postal_codes if postal_code in known]
+        new_codes = [postal_code for postal_code in postal_codes if postal_code not in known]
+        if known_codes:
+            frames.append(previous_history.loc[previous_history["Postal code"].isin(known)].astype({"Year": int})
+                          .convert_dtypes(convert_string=False, convert_boolean=False))
+        fetches = [(known_codes, [year for year in years if year not in previous_years]), (new_codes, years)]
+    fetches = [(fetch_codes, fetch_years) for fetch_codes, fetch_years in fetches if fetch_codes and fetch_years]
+    if not fetches:
+        logging.info(f"Postal code information of all the years {years[0]}-{years[-1]} is already extracted")
+    frames.extend(fetch_postal_code_info_history(client, url, fetch_codes, fetch_years, cell_limit, max_workers)
+                  for fetch_codes, fetch_years in fetches)
+    # The panels are converted before concatenating them, so that the integer columns read as floats with NaNs from
+    # the previous panel stay integers
+    df = pd.concat(frames, ignore_index=True).sort_values(["Postal code", "Year"], ignore_index=True)
+    df = df.convert_dtypes(convert_string=False, convert_boolean=False)
+    logging.info(f"Received information for {df['Postal code'].nunique()} postal code areas of {df['Year'].nunique()} years")
+    return df
+
+def history_year(history: pd.DataFrame, year: str) -> pd.DataFrame:
+    """Select the postal code information of one year from the panel, in the same format as extracted for the year.
+    """
+    return history.loc[history["Year"] == int(year)].drop(columns="Year").set_index("Postal code").rename_axis(None)
+
+@instrumentation.timed
+def extract_apartment_price_info_for_areas(client: StatFinClient, url: str, year: str) -> pd.DataFrame:
     """Extract apartment price information of postal code areas for the specified year from StatsFin API.
     """
     logging.info(f"Extracting apartment price information for postal code areas of year {year}")
     with open(os.path.join(os.path.dirname(__file__), "queries", "apartment_price_query.json"), "r") as file:
         query = json.load(file)
     query["query"][0]["selection"]["values"] = [year]
-    response = requests.post(url, json=query)
-    if response.status_code != 200:
-        logging.error(f"Request to Postal code API server failed with status code: {response.status_code}")
-        raise Exception("No response from API")
+    response = client.post(url, query)
     content = response.json()
     result = {}
     for area in content["data"]:
         result[area["key"][1]] = area["values"][0].replace(".", "")
     df = pd.DataFrame.from_dict(result, orient="index", columns=["Neliöhinta EUR/m2"])
+    df["Neliöhinta EUR/m2"] = pd.to_numeric(df["Neliöhinta EUR/m2"], errors="coerce").astype("Int64")
     logging.info(f"Received apartment prices for {len(df.index)} postal code areas")
     return df
 
-def extract_apartment_price_info_for_municipalities(url: str, year: str) -> pd.DataFrame:
-    """Extract apartment price information of municipalities for the specified year from StatsFin API.
+@instrumentation.timed
+def extract_municipality_codes(client: StatFinClient, url: str, municipalities: list[str] | str) -> pd.Series:
+    """Extract the codes and names of the municipalities from the metadata of the StatsFin API table. Only the given
+    municipalities are kept, unless the municipalities are "all", in which case every municipality is kept.
+    """
+    logging.info("Extracting municipality codes")
+    response = client.get(url)
+    variable = next(variable for variable in response.json()["variables"] if variable["code"] == "Kunta")
+    municipality_codes = pd.Series(data=variable["valueTexts"], index=variable["values"])
+    municipality_codes = municipality_codes.loc[municipality_codes.index.str.fullmatch("[0-9]{3}")]
+    if municipalities != "all":
+        municipality_codes = municipality_codes.loc[municipality_codes.isin(municipalities)]
+    logging.info(f"Received codes for {len(municipality_codes.index)} municipalities")
+    return municipality_codes
+
+@instrumentation.timed
+def extract_apartment_price_info_for_municipalities(client: StatFinClient, url: str, year: str, municipalities: list[str] | str) -> pd.DataFrame:
+    """Extract apartment price information of the given municipalities for the specified year from StatsFin API.
     """
     logging.info(f"Extracting apartment price information for municipalities of year {year}")
+    municipality_codes = extract_municipality_codes(client, url, municipalities)
     with open(os.path.join(os.path.dirname(__file__), "queries", "apartment_price_municipality_query.json"), "r") as file:
         query = json.load(file)
     query["query"][0]["selection"]["values"] = [year]
-    response = requests.post(url, json=query)
-    if response.status_code != 200:
-        logging.error(f"Request to Postal code API server failed with status code: {response.status_code}")
-        raise Exception("No response from API")
+    query["query"][1]["selection"]["values"] = municipality_codes.index.to_list()
+    response = client.post(url, query)
     content = response.json()
     result = {}
     for area in content["data"]:
         result[area["key"][1]] = area["values"][0]
     muni_df = pd.DataFrame.from_dict(result, orient="index", columns=["Neliöhinta EUR/m2"])
-    muni_df["municipality"] = pd.Series(data=["Espoo", "Helsinki", "Oulu", "Tampere", "Turku", "Vantaa"], 
-                                   index=["049", "091", "564", "837", "853", "092"])
+    muni_df["Neliöhinta EUR/m2"] = pd.to_numeric(muni_df["Neliöhinta EUR/m2"], errors="coerce").astype("Int64")
+    muni_df["municipality"] = municipality_codes
     return muni_df
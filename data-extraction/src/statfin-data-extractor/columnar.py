@@ -0,0 +1,81 @@
+import pyarrow.parquet as pq
+import pyarrow as pa
+import pandas as pd
+import numpy as np
+import json
+import io
+
+
+def artifact_name(name: str, storage_format: str, kind: str = "table") -> str:
+    """Name of the stored artifact for the given storage format, "csv" or "columnar". In the columnar format, tables
+    are stored as Parquet and feature matrices as Arrow IPC files, which can be memory-mapped by the mapping stage.
+    """
+    if storage_format != "columnar":
+        return f"{name}.csv"
+    return f"{name}.arrow" if kind == "features" else f"{name}.parquet"
+
+def open_source(source: str | bytes) -> pa.NativeFile:
+    """Open a local file path as a memory map, or the content of an object read from a storage backend as a buffer.
+    """
+    return pa.memory_map(source, "r") if isinstance(source, str) else pa.BufferReader(source)
+
+def read_table(source: str | bytes, columns: list[str] | None = None) -> pd.DataFrame:
+    """Read the given columns, or all of them, of a Parquet file written by the extraction stage. Integer columns with
+    nulls are read as floats with NaNs, as they would be from a csv-file, and the dictionary encoded columns as plain
+    objects for the feature processing.
+    """
+    df = pq.read_table(open_source(source), columns=columns).to_pandas(ignore_metadata=True)
+    for column in df.select_dtypes("category").columns:
+        df[column] = df[column].astype(object)
+    return df
+
+def to_arrow_table(df: pd.DataFrame, schema: pa.Schema | None = None) -> pa.Table:
+    """Convert the dataframe to an Arrow table with an explicit schema, or with the given schema, e.g., of the previous
+    chunk of the same table. Postal codes are stored as strings keeping their leading zeros, municipality names as
+    dictionary encoded categories and the numeric columns with their types, missing values being nulls.
+    """
+    if schema is None:
+        schema = pa.Schema.from_pandas(df, preserve_index=False)
+        for i, field in enumerate(schema):
+            if field.name == "Postal code":
+                schema = schema.set(i, pa.field(field.name, pa.string()))
+            elif field.name == "municipality":
+                schema = schema.set(i, pa.field(field.name, pa.dictionary(pa.int32(), pa.string())))
+    df = df.astype({"Postal code": str}) if "Postal code" in df.columns else df
+    return pa.Table.from_pandas(df, schema=schema, preserve_index=False)
+
+def to_parquet(df: pd.DataFrame) -> bytes:
+    """Serialize the dataframe to zstd-compressed Parquet with the explicit schema of to_arrow_table.
+    """
+    buffer = io.BytesIO()
+    pq.write_table(to_arrow_table(df), buffer, compression="zstd")
+    return buffer.getvalue()
+
+def features_to_arrow(features: pd.DataFrame) -> bytes:
+    """Serialize the normalized features of a municipality to an uncompressed Arrow IPC file. The features are stored
+    as one fixed size list column holding the row-major feature matrix, so that the matrix can be memory-mapped
+    without copying, and the feature names are stored in the schema metadata.
+    """
+    matrix = np.ascontiguousarray(features.iloc[:, 2:].to_numpy(dtype=float))
+    table = pa.table({
+        "Postal code": pa.array(features["Postal code"].astype(str), type=pa.string()),
+        "municipality": pa.array(features["municipality"].astype(str), type=pa.string()).dictionary_encode(),
+        "features": pa.FixedSizeListArray.from_arrays(pa.array(matrix.ravel()), matrix.shape[1])
+    }, metadata={"feature_names": json.dumps(features.columns[2:].to_list(), ensure_ascii=False)})
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+def read_features(source: str | bytes) -> pd.DataFrame:
+    """Read the features of a municipality from an Arrow IPC file. A local file is memory-mapped and the feature
+    columns of the returned dataframe are a view of the row-major feature matrix in the file, so the matrix is not
+    copied until the features of all the municipalities are concatenated.
+    """
+    table = pa.ipc.open_file(open_source(source)).read_all()
+    feature_names = json.loads(table.schema.metadata[b"feature_names"])
+    matrix = table.column("features").combine_chunks().flatten().to_numpy(zero_copy_only=True).reshape(-1, len(feature_names))
+    features = pd.DataFrame(matrix, columns=feature_names, copy=False)
+    features.insert(0, "municipality", table.column("municipality").to_pandas())
+    features.insert(0, "Postal code", table.column("Postal code").to_pandas())
+    return features
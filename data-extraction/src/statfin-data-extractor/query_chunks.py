@@ -0,0 +1,79 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from statfin_client import StatFinClient
+import numpy as np
+import itertools
+import logging
+import math
+import copy
+
+
+def split_values(values: list[str], chunk_size: int) -> list[list[str]]:
+    """Split the values of a query dimension into chunks of at most the given size.
+    """
+    return [values[start:start + chunk_size] for start in range(0, len(values), chunk_size)]
+
+def plan_query_chunks(dimensions: list[list[str]], cell_limit: int) -> list[tuple[list[str], ...]]:
+    """Split the selected values of the query dimensions into chunks so that no chunk query has more cells than the
+    given limit. The largest dimension is halved until the chunks fit, so postal codes are split first, then the
+    variables and lastly the years. Returns the values of every dimension for each chunk query.
+    """
+    chunk_sizes = [max(len(values), 1) for values in dimensions]
+    while math.prod(chunk_sizes) > cell_limit and max(chunk_sizes) > 1:
+        largest = chunk_sizes.index(max(chunk_sizes))
+        chunk_sizes[largest] = math.ceil(chunk_sizes[largest] / 2)
+    return list(itertools.product(*[split_values(values, chunk_size) for values, chunk_size in zip(dimensions, chunk_sizes)]))
+
+def parse_json_stat(content: dict, codes: list[str], positions: list[dict[str, int]], result: np.ndarray) -> list[dict[str, str]]:
+    """Parse a json-stat2 response into the given preallocated result array, whose axes are in the order of the given
+    dimension codes and whose positions of the dimension values are given by the position lookups. Missing values are
+    left as NaN. Returns the labels of the values of every dimension.
+    """
+    values = np.array(content["value"], dtype=float).reshape(content["size"])
+    values = values.transpose([content["id"].index(code) for code in codes])
+    indices = []
+    labels = []
+    for code, dimension_positions in zip(codes, positions):
+        category = content["dimension"][code]["category"]
+        ordered_values = sorted(category["index"], key=category["index"].get)
+        indices.append([dimension_positions[value] for value in ordered_values])
+        labels.append(category.get("label", {}))
+    result[np.ix_(*indices)] = values
+    return labels
+
+def fetch_chunked(client: StatFinClient, url: str, query: dict, dimension_indices: list[int], cell_limit: int,
+                  max_workers: int) -> tuple[np.ndarray, list[dict[str, str]]]:
+    """Fetch the query split into chunks that stay under the cell limit. The chunks are fetched in parallel as
+    json-stat2 and each chunk is parsed into a preallocated float array as soon as it arrives. A chunk response is
+    parsed whole, so the cell limit bounds the memory of one response, and at most two chunks per worker are fetched
+    ahead of the parsing, so the responses held at a time are bounded as well. Returns the array, whose axes are the
+    dimensions of the given query indices, and the labels of the values of every dimension.
+    """
+    codes = [query["query"][i]["code"] for i in dimension_indices]
+    dimensions = [query["query"][i]["selection"]["values"] for i in dimension_indices]
+    positions = [{value: position for position, value in enumerate(values)} for values in dimensions]
+    result = np.full([len(values) for values in dimensions], np.nan)
+    labels = [{} for _ in dimensions]
+    chunks = plan_query_chunks(dimensions, cell_limit)
+    logging.info(f"Fetching {math.prod(result.shape)} cells in {len(chunks)} chunk queries")
+
+    def fetch_chunk(chunk: tuple[list[str], ...]) -> dict:
+        chunk_query = copy.deepcopy(query)
+        for i, values in zip(dimension_indices, chunk):
+            chunk_query["query"][i]["selection"]["values"] = values
+        chunk_query["response"] = {"format": "json-stat2"}
+        return client.post(url, chunk_query).json()
+
+    def parse_chunks(futures):
+        for future in futures:
+            for dimension_labels, chunk_labels in zip(labels, parse_json_stat(future.result(), codes, positions, result)):
+                dimension_labels.update(chunk_labels)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = set()
+        for chunk in chunks:
+            pending.add(executor.submit(fetch_chunk, chunk))
+            if len(pending) >= 2 * max_workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                parse_chunks(done)
+        parse_chunks(as_completed(pending))
+    return result, labels
@@ -0,0 +1,124 @@
+from requests.structures import CaseInsensitiveDict
+import requests
+import threading
+import hashlib
+import json
+import time
+import os
+
+
+class ResponseCache:
+    """Content-addressed on-disk cache of API responses. The responses are keyed on the method, the URL and the
+    normalized query body, and the least recently used responses are evicted when the cache grows over its size limit.
+    """
+    def __init__(self, directory: str, ttl_seconds: float, max_size_mb: float):
+        self.directory = directory
+        self.ttl_seconds = ttl_seconds
+        self.max_size_bytes = int(max_size_mb * 1024 * 1024)
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    @classmethod
+    def from_config(cls, config: dict) -> "ResponseCache":
+        """Create the cache from the cache section of the configuration.
+        """
+        return cls(config["cache"]["directory"], config["cache"]["ttl_hours"] * 3600, config["cache"]["max_size_mb"])
+
+    @staticmethod
+    def key(method: str, url: str, query: dict | None = None) -> str:
+        """Compute the cache key from the method, the URL and the query with its keys sorted, so that equal queries
+        have the same key regardless of how they were built.
+        """
+        body = json.dumps(query, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+        return hashlib.sha256(f"{method}\n{url}\n{body}".encode("utf-8")).hexdigest()
+
+    def paths(self, key: str) -> tuple[str, str]:
+        """Paths of the response body and metadata files of the given key.
+        """
+        return os.path.join(self.directory, f"{key}.body"), os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key: str) -> tuple[requests.Response, dict] | None:
+        """Read a cached response and its metadata, or None if the response is not in the cache. The access time
+        of a found response is updated for the eviction order.
+        """
+        body_path, metadata_path = self.paths(key)
+        try:
+            with open(metadata_path, mode="r", encoding="utf-8") as file:
+                metadata = json.load(file)
+            with open(body_path, mode="rb") as file:
+                body = file.read()
+        except (OSError, ValueError):
+            return None
+        os.utime(metadata_path)
+        response = requests.Response()
+        response.status_code = 200
+        response._content = body
+        response.headers = CaseInsensitiveDict(metadata["headers"])
+        response.encoding = metadata["encoding"]
+        response.url = metadata["url"]
+        return response, metadata
+
+    def is_fresh(self, metadata: dict) -> bool:
+        """Check whether a cached response is younger than the time to live of the cache.
+        """
+        return time.time() - metadata["stored_at"] < self.ttl_seconds
+
+    def validation_headers(self, metadata: dict) -> dict[str, str]:
+        """Headers for revalidating a stale cached response with the server.
+        """
+        headers = {}
+        if "ETag" in metadata["headers"]:
+            headers["If-None-Match"] = metadata["headers"]["ETag"]
+        if "Last-Modified" in metadata["headers"]:
+            headers["If-Modified-Since"] = metadata["headers"]["Last-Modified"]
+        return headers
+
+    def put(self, key: str, response: requests.Response):
+        """Store a response in the cache and evict the least recently used responses if the cache is too large.
+        """
+        body_path, metadata_path = self.paths(key)
+        headers = {name: response.headers[name] for name in ["ETag", "Last-Modified", "Content-Type"] if name in response.headers}
+        metadata = {"url": response.url, "stored_at": time.time(), "headers": headers, "encoding": response.encoding}
+        with open(f"{body_path}.tmp", mode="wb") as file:
+            file.write(response.content)
+        os.replace(f"{body_path}.tmp", body_path)
+        with open(f"{metadata_path}.tmp", mode="w", encoding="utf-8") as file:
+            json.dump(metadata, file)
+        os.replace(f"{metadata_path}.tmp", metadata_path)
+        self.evict()
+
+    def touch(self, key: str):
+        """Mark a stale cached response as fresh after the server has confirmed that it has not changed.
+        """
+        _, metadata_path = self.paths(key)
+        with open(metadata_path, mode="r", encoding="utf-8") as file:
+            metadata = json.load(file)
+        metadata["stored_at"] = time.time()
+        with open(f"{metadata_path}.tmp", mode="w", encoding="utf-8") as file:
+            json.dump(metadata, file)
+        os.replace(f"{metadata_path}.tmp", metadata_path)
+
+    def evict(self):
+        """Remove the least recently used responses until the cache fits in its size limit.
+        """
+        with self.lock:
+            entries = []
+            for filename in os.listdir(self.directory):
+                if filename.endswith(".json"):
+                    key = filename[:-len(".json")]
+                    body_path, metadata_path = self.paths(key)
+                    try:
+                        size = os.path.getsize(body_path) + os.path.getsize(metadata_path)
+                        entries.append((os.path.getmtime(metadata_path), size, key))
+                    except OSError:
+                        continue
+            total_size = sum(size for _, size, _ in entries)
+            for _, size, key in sorted(entries):
+                if total_size <= self.max_size_bytes:
+                    break
+                for path in self.paths(key):
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+                total_size -= size
@@ -0,0 +1,139 @@
+from requests.adapters import HTTPAdapter
+from response_cache import ResponseCache
+import instrumentation
+import requests
+import threading
+import logging
+import random
+import time
+
+
+class StatFinApiError(Exception):
+    """Raised when a request to the StatsFin API fails after all the retries.
+    """
+
+class RateLimiter:
+    """Thread-safe sliding window rate limiter allowing at most the given amount of requests per period.
+    """
+    def __init__(self, max_requests: int, period_seconds: float):
+        self.max_requests = max_requests
+        self.period_seconds = period_seconds
+        self.request_times = []
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Wait until a request can be made without exceeding the rate limit and reserve a slot for it.
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.request_times = [request_time for request_time in self.request_times if now - request_time < self.period_seconds]
+                if len(self.request_times) < self.max_requests:
+                    self.request_times.append(now)
+                    return
+                wait_seconds = self.period_seconds - (now - self.request_times[0])
+            time.sleep(wait_seconds)
+
+class StatFinClient:
+    """HTTP client for the StatsFin PxWeb API sharing one pooled session between threads. Requests have a timeout, are
+    rate limited and retried with jittered exponential backoff on connection errors, server errors and HTTP 429.
+    Responses are served from the optional response cache while they are fresh, and in offline mode only from the cache.
+    """
+    RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+    def __init__(self, timeout_seconds: float = 60, max_retries: int = 5, backoff_seconds: float = 1,
+                 max_backoff_seconds: float = 30, rate_limit_requests: int = 30, rate_limit_period_seconds: float = 10,
+                 pool_size: int = 10, cache: ResponseCache | None = None, offline: bool = False):
+        if offline and cache is None:
+            raise ValueError("Offline mode requires a response cache")
+        self.cache = cache
+        self.offline = offline
+        self.timeout_seconds = timeout_seconds
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self.rate_limiter = RateLimiter(rate_limit_requests, rate_limit_period_seconds)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    @classmethod
+    def from_config(cls, config: dict, offline: bool = False) -> "StatFinClient":
+        """Create the client from the requests and cache sections of the configuration.
+        """
+        cache = ResponseCache.from_config(config) if config["cache"]["enabled"] or offline else None
+        return cls(**config["requests"], cache=cache, offline=offline)
+
+    def backoff(self, attempt: int, retry_after: str | None = None) -> float:
+        """Compute the time to wait before the next attempt. The Retry-After header of the response is respected
+        when given, otherwise the wait time grows exponentially with full jitter.
+        """
+        if retry_after is not None and retry_after.isdigit():
+            return float(retry_after)
+        return random.uniform(0, min(self.max_backoff_seconds, self.backoff_seconds * 2**attempt))
+
+    def request(self, method: str, url: str, query: dict | None = None) -> requests.Response:
+        """Make a request to the API, using the response cache when it is enabled. A fresh cached response is returned
+        without a request, and a stale one is revalidated with the server. In offline mode only cached responses are
+        returned, regardless of their age.
+        """
+        if self.cache is None:
+            return self.send(method, url, query)
+        key = self.cache.key(method, url, query)
+        cached = self.cache.get(key)
+        if self.offline:
+            if cached is None:
+                raise StatFinApiError(f"No cached response for {url} in offline mode")
+            instrumentation.count("cached_responses", 1, url=url, bytes=len(cached[0].content))
+            return cached[0]
+        if cached is not None and self.cache.is_fresh(cached[1]):
+            logging.info(f"Using cached response for {url}")
+            instrumentation.count("cached_responses", 1, url=url, bytes=len(cached[0].content))
+            return cached[0]
+        response = self.send(method, url, query, {} if cached is None else self.cache.validation_headers(cached[1]))
+        if response.status_code == 304:
+            logging.info(f"Cached response for {url} has not changed")
+            self.cache.touch(key)
+            return cached[0]
+        self.cache.put(key, response)
+        return response
+
+    def send(self, method: str, url: str, query: dict | None = None, headers: dict[str, str] | None = None) -> requests.Response:
+        """Send a request to the API, retrying failed attempts. Raises StatFinApiError when the request does not
+        succeed within the retries or fails with a status code that is not worth retrying. The request is recorded as
+        a span with the amount of attempts and the size of the response.
+        """
+        with instrumentation.span("api_call", method=method, url=url) as fields:
+            for attempt in range(self.max_retries + 1):
+                fields["attempts"] = attempt + 1
+                self.rate_limiter.acquire()
+                try:
+                    response = self.session.request(method, url, json=query, headers=headers, timeout=self.timeout_seconds)
+                except (requests.ConnectionError, requests.Timeout) as error:
+                    logging.warning(f"Request to {url} failed on attempt {attempt + 1}: {error}")
+                    retry_after = None
+                else:
+                    fields["status"] = response.status_code
+                    if response.status_code == 200 or (response.status_code == 304 and headers):
+                        fields["bytes"] = len(response.content)
+                        return response
+                    if response.status_code not in self.RETRY_STATUS_CODES:
+                        logging.error(f"Request to API server {url} failed with status code: {response.status_code}")
+                        raise StatFinApiError(f"Request to {url} failed with status code {response.status_code}")
+                    logging.warning(f"Request to {url} failed on attempt {attempt + 1} with status code: {response.status_code}")
+                    retry_after = response.headers.get("Retry-After")
+                if attempt < self.max_retries:
+                    time.sleep(self.backoff(attempt, retry_after))
+            logging.error(f"Request to API server {url} failed after {self.max_retries + 1} attempts")
+            raise StatFinApiError(f"Request to {url} failed after {self.max_retries + 1} attempts")
+
+    def get(self, url: str) -> requests.Response:
+        """Make a GET request to the API, e.g., for the metadata of a table.
+        """
+        return self.request("GET", url)
+
+    def post(self, url: str, query: dict) -> requests.Response:
+        """Make a POST request with the given query to the API.
+        """
+        return self.request("POST", url, query)
@@ -0,0 +1,50 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+import pytest
+import json
+import sys
+import os
+
+
+# The modules of the package are imported as top-level modules, as when the package is run
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", "statfin-data-extractor"))
+
+class StubServer:
+    """Local HTTP server answering the requests with the queued responses, given as tuples of the status code, the
+    headers and the JSON body, and recording the requests it received.
+    """
+    def __init__(self):
+        self.responses = []
+        self.requests = []
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def respond(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length) if length else b""
+                stub.requests.append((self.command, self.path, json.loads(body) if body else None))
+                status, headers, content = stub.responses.pop(0) if stub.responses else (200, {}, {})
+                data = json.dumps(content).encode("utf-8")
+                self.send_response(status)
+                for name, value in ({"Content-Type": "application/json", "Content-Length": str(len(data))} | headers).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = respond
+            do_POST = respond
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.thread = threading.Thread(target=self.server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True)
+
+@pytest.fixture
+def stub_server():
+    stub = StubServer()
+    stub.thread.start()
+    yield stub
+    stub.server.shutdown()
+    stub.server.server_close()
@@ -0,0 +1,65 @@
+from api_calls import extract_postal_code_info_history
+from test_query_chunks import ChunkClient
+import pandas as pd
+import numpy as np
+import json
+import os
+
+
+CODES = ["Postinumeroalue", "Tiedot", "Vuosi"]
+POSTAL_CODES = [f"{code:05d}" for code in range(100, 120)]
+YEARS = ["2018", "2019", "2020", "2021"]
+
+def history_client() -> ChunkClient:
+    """Client answering the queries of the postal code information from random values of all the postal codes,
+    variables and years.
+    """
+    with open(os.path.join(os.path.dirname(__file__), "..", "src", "statfin-data-extractor", "queries", "postal_area_basics_query.json"), "r") as file:
+        variables = json.load(file)["query"][1]["selection"]["values"]
+    rng = np.random.default_rng(0)
+    values = rng.integers(0, 1000, size=(len(POSTAL_CODES), len(variables), len(YEARS))).astype(float)
+    return ChunkClient(values, [POSTAL_CODES, variables, YEARS], CODES)
+
+def fetched_cells(client: ChunkClient) -> set[tuple[str, str]]:
+    """Postal codes and years queried from the client.
+    """
+    return {(postal_code, year) for query in client.queries
+            for postal_code in query["query"][0]["selection"]["values"] for year in query["query"][2]["selection"]["values"]}
+
+def test_history_is_one_row_for_every_postal_code_and_year():
+    client = history_client()
+    history = extract_postal_code_info_history(client, "url", POSTAL_CODES[:5], YEARS[:2], cell_limit=300)
+    assert list(zip(history["Postal code"], history["Year"])) == [(postal_code, int(year)) for postal_code in POSTAL_CODES[:5] for year in YEARS[:2]]
+    np.testing.assert_array_equal(history.iloc[:, 2:].to_numpy(dtype=float),
+                                  client.values[:5].transpose(0, 2, 1)[:, :2].reshape(-1, client.values.shape[1]))
+
+def test_only_the_new_years_and_postal_codes_are_fetched():
+    previous = extract_postal_code_info_history(history_client(), "url", POSTAL_CODES[:6], YEARS[:3])
+    # Marks the kept rows, which would be overwritten if they were fetched again
+    previous.iloc[:, 2] = -1
+    postal_codes = POSTAL_CODES[1:6] + POSTAL_CODES[10:12]
+    client = history_client()
+    history = extract_postal_code_info_history(client, "url", postal_codes, YEARS[1:], previous)
+    assert fetched_cells(client) == {(postal_code, year) for postal_code in POSTAL_CODES[1:6] for year in YEARS[3:]} | \
+                                    {(postal_code, year) for postal_code in POSTAL_CODES[10:12] for year in YEARS[1:]}
+    expected = extract_postal_code_info_history(history_client(), "url", postal_codes, YEARS[1:])
+    kept = history["Postal code"].isin(POSTAL_CODES[1:6]) & history["Year"].isin([2019, 2020])
+    assert (history.loc[kept].iloc[:, 2] == -1).all()
+    expected.loc[kept, expected.columns[2]] = -1
+    pd.testing.assert_frame_equal(history, expected)
+
+def test_postal_codes_missing_years_are_fetched_again():
+    previous = extract_postal_code_info_history(history_client(), "url", POSTAL_CODES[:4], YEARS[:2])
+    previous = previous.loc[~((previous["Postal code"] == POSTAL_CODES[3]) & (previous["Year"] == 2019))]
+    client = history_client()
+    history = extract_postal_code_info_history(client, "url", POSTAL_CODES[:4], YEARS[:2], previous)
+    assert fetched_cells(client) == {(POSTAL_CODES[3], year) for year in YEARS[:2]}
+    pd.testing.assert_frame_equal(history, extract_postal_code_info_history(history_client(), "url", POSTAL_CODES[:4], YEARS[:2]))
+
+def test_complete_history_is_not_fetched():
+    previous = extract_postal_code_info_history(history_client(), "url", POSTAL_CODES[:4], YEARS)
+    client = history_client()
+    history = extract_postal_code_info_history(client, "url", POSTAL_CODES[:3], YEARS[1:3], previous)
+    assert client.queries == []
+    expected = previous.loc[previous["Postal code"].isin(POSTAL_CODES[:3]) & previous["Year"].isin([2019, 2020])]
+    pd.testing.assert_frame_equal(history, expected.reset_index(drop=True))
@@ -0,0 +1,91 @@
+from query_chunks import fetch_chunked, parse_json_stat, plan_query_chunks
+import numpy as np
+import itertools
+import threading
+import pytest
+import math
+
+
+POSTAL_CODES = [f"{code:05d}" for code in range(100, 137)]
+VARIABLES = ["he_vakiy", "he_kika", "te_taly", "pt_tyott", "hr_mtu"]
+YEARS = ["2019", "2020", "2021"]
+
+@pytest.mark.parametrize("cell_limit", [1, 7, 40, 100, 555, 10**6])
+def test_chunks_cover_every_cell_once_under_the_limit(cell_limit):
+    dimensions = [POSTAL_CODES, VARIABLES, YEARS]
+    chunks = plan_query_chunks(dimensions, cell_limit)
+    cells = [cell for chunk in chunks for cell in itertools.product(*chunk)]
+    assert sorted(cells) == sorted(itertools.product(*dimensions))
+    assert all(math.prod(len(values) for values in chunk) <= cell_limit for chunk in chunks)
+
+def test_postal_codes_are_split_first():
+    chunks = plan_query_chunks([POSTAL_CODES, VARIABLES, YEARS], 5 * 3 * 10)
+    assert all(chunk[1] == VARIABLES and chunk[2] == YEARS for chunk in chunks)
+    assert [len(chunk[0]) for chunk in chunks] == [10, 10, 10, 7]
+
+def test_query_under_the_limit_is_not_split():
+    assert plan_query_chunks([POSTAL_CODES, VARIABLES, YEARS], 10**6) == [(POSTAL_CODES, VARIABLES, YEARS)]
+
+def json_stat(values: np.ndarray, dimensions: list[list[str]], codes: list[str], order: list[int]) -> dict:
+    """Json-stat2 response of the values, whose axes are the given dimensions, with the dimensions in the given order
+    and the values of missing cells as nulls.
+    """
+    values = values.transpose(order)
+    return {
+        "id": [codes[i] for i in order],
+        "size": list(values.shape),
+        "dimension": {codes[i]: {"category": {"index": {value: position for position, value in enumerate(dimensions[i])},
+                                              "label": {value: f"{value} label" for value in dimensions[i]}}}
+                      for i in order},
+        "value": [None if np.isnan(value) else float(value) for value in values.ravel()]
+    }
+
+def test_parse_json_stat_with_reordered_dimensions():
+    codes = ["Postinumeroalue", "Tiedot", "Vuosi"]
+    dimensions = [POSTAL_CODES[:4], VARIABLES[:3], YEARS[:2]]
+    values = np.arange(24, dtype=float).reshape(4, 3, 2)
+    values[1, 2, 0] = np.nan
+    result = np.full((4, 3, 2), -1.0)
+    labels = parse_json_stat(json_stat(values, dimensions, codes, [2, 0, 1]), codes,
+                             [{value: position for position, value in enumerate(dimension_values)} for dimension_values in dimensions], result)
+    np.testing.assert_array_equal(result, values)
+    assert labels[1] == {variable: f"{variable} label" for variable in VARIABLES[:3]}
+
+class ChunkClient:
+    """Client answering the chunk queries from the full array of values, recording the queries.
+    """
+    def __init__(self, values: np.ndarray, dimensions: list[list[str]], codes: list[str]):
+        self.values = values
+        self.dimensions = dimensions
+        self.codes = codes
+        self.queries = []
+        self.lock = threading.Lock()
+
+    def post(self, url: str, query: dict):
+        with self.lock:
+            self.queries.append(query)
+        chunk = [query["query"][i]["selection"]["values"] for i in range(len(self.codes))]
+        indices = [[dimension.index(value) for value in values] for dimension, values in zip(self.dimensions, chunk)]
+        content = json_stat(self.values[np.ix_(*indices)], chunk, self.codes, [1, 2, 0])
+
+        class Response:
+            def json(self):
+                return content
+        return Response()
+
+@pytest.mark.parametrize("max_workers", [1, 3])
+def test_fetch_chunked_assembles_the_chunks(max_workers):
+    codes = ["Postinumeroalue", "Tiedot", "Vuosi"]
+    dimensions = [POSTAL_CODES, VARIABLES, YEARS]
+    rng = np.random.default_rng(0)
+    values = rng.normal(size=(len(POSTAL_CODES), len(VARIABLES), len(YEARS)))
+    values[rng.random(values.shape) < 0.1] = np.nan
+    query = {"query": [{"code": code, "selection": {"filter": "item", "values": dimension_values}} for code, dimension_values in zip(codes, dimensions)],
+             "response": {"format": "csv"}}
+    client = ChunkClient(values, dimensions, codes)
+    result, labels = fetch_chunked(client, "url", query, [0, 1, 2], 40, max_workers)
+    assert len(client.queries) == len(plan_query_chunks(dimensions, 40)) > 1
+    assert all(chunk_query["response"] == {"format": "json-stat2"} for chunk_query in client.queries)
+    np.testing.assert_array_equal(result, values)
+    assert labels[0] == {postal_code: f"{postal_code} label" for postal_code in POSTAL_CODES}
+    assert query["query"][0]["selection"]["values"] == POSTAL_CODES
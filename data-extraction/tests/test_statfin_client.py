@@ -0,0 +1,85 @@
+from statfin_client import RateLimiter, StatFinApiError, StatFinClient
+import statfin_client
+import pytest
+import time
+
+
+@pytest.fixture
+def waits(monkeypatch) -> list[float]:
+    """Record the waits of the retries instead of sleeping them. The waits of the rate limiter are not recorded, as
+    the rate limits of the tests are never reached.
+    """
+    waits = []
+    monkeypatch.setattr(statfin_client.time, "sleep", waits.append)
+    return waits
+
+def test_429_waits_for_retry_after(stub_server, waits):
+    stub_server.responses = [(429, {"Retry-After": "7"}, {}), (200, {}, {"value": [1]})]
+    client = StatFinClient(max_retries=3)
+    response = client.post(f"{stub_server.url}/table", {"query": []})
+    assert response.status_code == 200
+    assert response.json() == {"value": [1]}
+    assert waits == [7.0]
+    assert [request[:2] for request in stub_server.requests] == [("POST", "/table"), ("POST", "/table")]
+    assert stub_server.requests[1][2] == {"query": []}
+
+def test_429_without_retry_after_backs_off(stub_server, waits):
+    stub_server.responses = [(429, {}, {}), (429, {"Retry-After": "Wed, 21 Oct 2015 07:28:00 GMT"}, {}), (200, {}, {})]
+    client = StatFinClient(max_retries=3, backoff_seconds=2, max_backoff_seconds=3)
+    assert client.get(f"{stub_server.url}/table").status_code == 200
+    assert len(waits) == 2
+    assert 0 <= waits[0] <= 2
+    assert 0 <= waits[1] <= 3
+
+def test_server_errors_are_retried(stub_server, waits):
+    stub_server.responses = [(503, {}, {}), (500, {}, {}), (502, {}, {}), (200, {}, {"value": [2]})]
+    client = StatFinClient(max_retries=3, backoff_seconds=1, max_backoff_seconds=30)
+    assert client.get(f"{stub_server.url}/table").json() == {"value": [2]}
+    assert len(stub_server.requests) == 4
+    assert all(0 <= wait <= 2**attempt for attempt, wait in enumerate(waits))
+    assert len(waits) == 3
+
+def test_gives_up_after_the_retries(stub_server, waits):
+    stub_server.responses = [(500, {}, {})] * 5
+    client = StatFinClient(max_retries=2)
+    with pytest.raises(StatFinApiError, match="after 3 attempts"):
+        client.get(f"{stub_server.url}/table")
+    assert len(stub_server.requests) == 3
+    assert len(waits) == 2
+
+def test_client_errors_are_not_retried(stub_server, waits):
+    stub_server.responses = [(400, {}, {"error": "invalid query"})]
+    client = StatFinClient(max_retries=3)
+    with pytest.raises(StatFinApiError, match="status code 400"):
+        client.post(f"{stub_server.url}/table", {"query": []})
+    assert len(stub_server.requests) == 1
+    assert waits == []
+
+def test_connection_errors_are_retried(waits):
+    client = StatFinClient(max_retries=1, timeout_seconds=1)
+    with pytest.raises(StatFinApiError, match="after 2 attempts"):
+        client.get("http://127.0.0.1:9/table")
+    assert len(waits) == 1
+
+def test_rate_limiter_window():
+    limiter = RateLimiter(3, 0.3)
+    start = time.monotonic()
+    for _ in range(3):
+        limiter.acquire()
+    assert time.monotonic() - start < 0.1
+    limiter.acquire()
+    # The fourth request waits until the first one is out of the window
+    assert time.monotonic() - start >= 0.3
+    # The window has room for two more requests
+    limiter.acquire()
+    limiter.acquire()
+    assert time.monotonic() - start < 0.5
+
+def test_client_requests_are_rate_limited(stub_server):
+    client = StatFinClient(rate_limit_requests=2, rate_limit_period_seconds=0.4)
+    start = time.monotonic()
+    for _ in range(5):
+        client.get(f"{stub_server.url}/table")
+    # Two requests in the first window, two in the second and the last one in the third
+    assert time.monotonic() - start >= 0.8
+    assert len(stub_server.requests) == 5
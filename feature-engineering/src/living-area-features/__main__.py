@@ -1,10 +1,19 @@
-from google.cloud import storage
+from storage_backends import StorageBackend, create_backends
 import pandas as pd
 import numpy as np
-from sklearn import preprocessing
+from concurrent.futures import ThreadPoolExecutor
+import dataclasses
+import hashlib
 import feature_processing
+import history_features
+import instrumentation
+import compact_tables
+import app_outputs
+import manifest
+import columnar
 import logging
 import tomllib
+import io
 import os
 
 
@@ -14,6 +23,22 @@ logging.basicConfig(
     datefmt="%Y-%m-%d %H:%M:%S"
 )
 
+RAW_DATA_NAMES = ["postal_code_mapping", "postal_code_info_latest", "postal_code_info_old", "apartment_prices_areas", "apartment_prices_municipalities"]
+HISTORY_NAME = "postal_code_info_history"
+# Columns of the raw data tables needed by the features, all the columns of the other tables being loaded. The latest
+# postal code info is loaded whole as it is the raw data of the app as well.
+RAW_DATA_COLUMNS = {
+    "postal_code_info_old": ["Postal code", feature_processing.POPULATION],
+    "apartment_prices_areas": ["Postal code", feature_processing.APARTMENT_PRICE],
+    "apartment_prices_municipalities": ["municipality", feature_processing.APARTMENT_PRICE],
+    HISTORY_NAME: ["Postal code", "Year", *dict.fromkeys(feature.column for feature in history_features.HISTORY_FEATURES)]
+}
+# Tables whose missing values are kept as NaNs instead of being replaced with zeros
+UNFILLED_TABLES = ["apartment_prices_municipalities", HISTORY_NAME]
+# Version of the computation of the features, to be increased with every change to the preprocessing, the computation
+# or the normalization code that changes the features, so that the features are recomputed
+FEATURES_VERSION = 1
+
 def load_config():
     """Load configuration details related to GCP.
     """
@@ -21,92 +46,218 @@ def load_config():
         config = tomllib.load(file)
     return config
 
-def preprocess_data(df: pd.DataFrame) -> pd.DataFrame:
-    """Fix postal codes to have leading zeros and handle missing data.
+@instrumentation.timed
+def preprocess_data(df: pd.DataFrame, columns: list[str] | None = None, fill_value: float | None = 0.0) -> pd.DataFrame:
+    """Fix postal codes to have leading zeros and handle missing data by converting the given columns, or all of them,
+    to compact types with the missing values replaced with the fill value, if given.
+    """
+    return compact_tables.compact_table(df, columns, fill_value)
+
+def preprocess_raw_data(raw_data: dict[str, pd.DataFrame]) -> dict[str, pd.DataFrame]:
+    """Preprocess the columns of the raw data tables needed by the features, either parsed from the storage or passed
+    in memory by the pipeline.
     """
-    df["Postal code"] = df["Postal code"].astype(str).str.pad(width=5, side='left', fillchar="0")
-    df = df.replace(["...", "..", "."], 0).fillna(0)
-    return df
+    return {name: preprocess_data(df, RAW_DATA_COLUMNS.get(name), None if name in UNFILLED_TABLES else 0.0) for name, df in raw_data.items()}
 
-def normalize_features(features: pd.DataFrame) -> pd.DataFrame:
-    """Normalize features by scaling them to mean zero and standard deviation of one.
-    In addition, clip change in population to maximum of 200% growth as there might be,
+@instrumentation.timed
+def normalize_features(features: pd.DataFrame) -> tuple[dict[str, pd.DataFrame], pd.DataFrame]:
+    """Normalize features of every municipality separately by scaling them to mean zero and standard deviation of one
+    within the municipality. In addition, clip change in population to maximum of 200% growth as there might be,
     cases in the data where there was no population before, thus causing outliers for
     values in the change in population feature. The function also applies log scaling
     for population density as this feature has a wide range of values with a long right tail,
-    which should not affect too much on the end result inferences.
+    which should not affect too much on the end result inferences. Areas without population density get the smallest
+    log population density of their municipality. All the municipalities are normalized in one vectorized pass over the
+    rows sorted by municipality, the scaling being the same as with the scikit-learn StandardScaler: missing values are
+    ignored and constant features are not scaled. The normalized features of every municipality are returned together
+    with the means and standard deviations used in the scaling.
+    """
+    codes, municipalities = pd.factorize(features["municipality"])
+    order = np.argsort(codes, kind="stable")
+    order = order[codes[order] >= 0]
+    sorted_codes = codes[order]
+    starts = np.searchsorted(sorted_codes, np.arange(len(municipalities)))
+    ends = np.append(starts[1:], len(order))
+    feature_names = features.columns[2:]
+    values = features.iloc[:, 2:].to_numpy(dtype=float)[order]
+
+    growth = values[:, feature_names.get_loc("Change in population")]
+    growth[growth > 2] = 2
+    density = values[:, feature_names.get_loc("Population density")]
+    positive = density > 0
+    with np.errstate(divide="ignore", invalid="ignore"):
+        log_density = np.log(density)
+    minimum_log_density = np.minimum.reduceat(np.where(positive, log_density, np.inf), starts)
+    minimum_log_density[np.isinf(minimum_log_density)] = np.nan
+    density[:] = np.where(positive, log_density, minimum_log_density[sorted_codes])
+
+    present = ~np.isnan(values)
+    counts = np.add.reduceat(present.astype(np.intp), starts, axis=0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        means = np.add.reduceat(np.where(present, values, 0), starts, axis=0) / counts
+        deviations = np.where(present, values - means[sorted_codes], 0)
+        correction = np.add.reduceat(deviations, starts, axis=0)
+        variances = (np.add.reduceat(deviations**2, starts, axis=0) - correction**2 / counts) / counts
+    scales = np.sqrt(variances)
+    eps = np.finfo(np.float64).eps
+    scales[variances <= counts * eps * variances + (counts * means * eps)**2] = 1
+    values -= means[sorted_codes]
+    values /= scales[sorted_codes]
+
+    normalized = pd.DataFrame(values, columns=feature_names, index=features.index[order])
+    normalized.insert(0, "municipality", features["municipality"].to_numpy()[order])
+    normalized.insert(0, "Postal code", features["Postal code"].to_numpy()[order])
+    municipality_features = {municipality: normalized.iloc[start:end] for municipality, start, end in zip(municipalities, starts, ends)}
+    parameters = pd.DataFrame({"municipality": np.repeat(municipalities.to_numpy(), len(feature_names)), "feature": np.tile(feature_names, len(municipalities)),
+                               "mean": means.ravel(), "scale": scales.ravel()})
+    return municipality_features, parameters
+
+def raw_data_names(config: dict) -> list[str]:
+    """Names of the raw data tables used by the features, including the postal code info panel in the history mode.
+    """
+    return RAW_DATA_NAMES + ([HISTORY_NAME] if config["history"]["enabled"] else [])
+
+@instrumentation.timed
+def load_raw_data(backend: StorageBackend, storage_format: str, max_workers: int = 8, names: list[str] = RAW_DATA_NAMES) -> dict[str, pd.DataFrame]:
+    """Read the given raw data tables of the extraction stage from the storage. The tables are downloaded and parsed
+    concurrently, only the columns needed by the features being parsed and the placeholders of missing values being
+    parsed as NaNs.
+    """
+    def read(name: str) -> pd.DataFrame:
+        blob_name = columnar.artifact_name(name, storage_format)
+        columns = RAW_DATA_COLUMNS.get(name)
+        if storage_format == "columnar":
+            return columnar.read_table(backend.local_path(blob_name) or backend.read(blob_name), columns)
+        return pd.read_csv(io.BytesIO(backend.read(blob_name)), sep=";", usecols=columns, na_values=compact_tables.PLACEHOLDERS,
+                           dtype={"Postal code": str})
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return dict(zip(names, executor.map(read, names)))
+
+@instrumentation.timed
+def compute_features(raw_data: dict[str, pd.DataFrame]) -> tuple[pd.DataFrame, dict[str, pd.DataFrame], pd.DataFrame]:
+    """Compute the features of the postal code areas from the raw data tables and normalize them separately for each
+    municipality. When the raw data has the postal code info panel of the history mode, the history features are
+    computed from it as well. Returns the postal code area info with the features for the application, the normalized
+    features of every municipality and the normalization parameters.
+    """
+    tables = preprocess_raw_data(raw_data)
+
+    logging.info("Building the features")
+    postal_code_info = tables["postal_code_info_latest"].merge(tables["postal_code_mapping"], how="left", on="Postal code")
+    inputs = feature_processing.feature_inputs(postal_code_info, tables["postal_code_info_old"], tables["apartment_prices_areas"],
+                                               tables["apartment_prices_municipalities"])
+    feature_columns = [feature_processing.build_features(inputs, postal_code_info["municipality"], index=postal_code_info.index)]
+    feature_names = list(feature_processing.FEATURE_NAMES)
+    if HISTORY_NAME in tables:
+        feature_columns.append(history_features.build_history_features(tables[HISTORY_NAME], postal_code_info["Postal code"], index=postal_code_info.index))
+        feature_names.extend(history_features.HISTORY_FEATURE_NAMES)
+    postal_code_info = pd.concat([postal_code_info, *feature_columns], axis=1)
+    features = postal_code_info.loc[:, ["Postal code", "municipality", *feature_names]]
+
+    logging.info("Normalizing the features of every municipality")
+    municipality_features, normalization_parameters = normalize_features(features)
+    return postal_code_info, municipality_features, normalization_parameters
+
+def feature_definition_hash() -> str:
+    """Hash of the definitions of the features: the version of their computation, the registries of the features and
+    the history features and the columns of the raw data they use. A change in any of them changes the features even
+    if the raw data is the same, so the hash is one of the parameters of the manifest.
+    """
+    definitions = [str(FEATURES_VERSION), repr(feature_processing.FEATURES), repr(history_features.HISTORY_FEATURES),
+                   repr(RAW_DATA_COLUMNS), repr(UNFILLED_TABLES)]
+    return hashlib.md5("\n".join(definitions).encode("utf-8")).hexdigest()
+
+def manifest_parameters(output_settings: app_outputs.OutputSettings) -> dict:
+    """Parameters of the features manifest: the hash of the feature definitions and the settings of the app data
+    outputs, a change in either requiring the features to be recomputed.
+    """
+    return {"features": feature_definition_hash(), "app_data": dataclasses.asdict(output_settings)}
+
+@instrumentation.timed
+def store_features(features_backend: StorageBackend | None, app_data_backend: StorageBackend, postal_code_info: pd.DataFrame,
+                   municipality_features: dict[str, pd.DataFrame], normalization_parameters: pd.DataFrame, storage_format: str,
+                   previous_outputs: dict[str, str], max_workers: int = 8, output_settings: app_outputs.OutputSettings | None = None) -> dict[str, str]:
+    """Upload the changed features of every municipality and the normalization parameters to the features storage, when
+    given, and stream the postal code area info to the app data storage as the raw data of the app, written as set in
+    the output settings. The outputs are serialized and uploaded concurrently with a bounded amount of threads.
+    Features of municipalities no longer in the data and outputs of the raw data no longer written, e.g., of
+    municipalities no longer in the data, are deleted. Returns the content hashes of the outputs.
     """
-    features["Change in population"] = np.where(features["Change in population"] > 2, 2, features["Change in population"])
-    with np.errstate(divide="ignore"):
-        minimum_log_pop_density = np.log(features.loc[features["Population density"] > 0, ["Population density"]]).min()
-        features["Population density"] = np.where(features["Population density"] > 0, np.log(features["Population density"]), minimum_log_pop_density)
-    feature_array = features.iloc[:,2:].to_numpy()
-    scaler = preprocessing.StandardScaler()
-    standard_features = scaler.fit_transform(feature_array)
-    features.iloc[:, 2:] = standard_features
-    return features
+    output_settings = output_settings or app_outputs.OutputSettings()
+
+    def upload_features(municipality: str, muni_features: pd.DataFrame) -> str:
+        blob_name = columnar.artifact_name(f"{municipality}_features", storage_format, kind="features")
+        data = columnar.features_to_arrow(muni_features) if storage_format == "columnar" else muni_features.to_csv(sep=";", index=False)
+        return manifest.upload_if_changed(features_backend, blob_name, data, previous_outputs)
+
+    def upload_raw_data() -> dict[str, str]:
+        order = None
+        if output_settings.partition_by_municipality:
+            # The areas are ordered by municipality, so that the rows of every partition are streamed one after another
+            codes, _ = pd.factorize(postal_code_info["municipality"])
+            order = np.argsort(codes, kind="stable")
+            order = order[codes[order] >= 0]
+            if len(order) < len(codes):
+                logging.warning(f"Leaving {len(codes) - len(order)} areas without a municipality out of the partitions of the raw data")
+        chunks = app_outputs.row_chunks(postal_code_info, output_settings.chunk_rows, order)
+        if storage_format != "columnar":
+            chunks = (compact_tables.decimal_floats(chunk) for chunk in chunks)
+        return app_outputs.write_output(app_data_backend, "raw_data", chunks, storage_format, output_settings,
+                                        lambda chunk: chunk["municipality"].to_numpy(dtype=object), sep=",", index=False, quoting=1)
+
+    futures = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        if features_backend is not None:
+            logging.info(f"Uploading the features of {len(municipality_features)} municipalities and the normalization parameters to the storage if changed")
+            for municipality, muni_features in municipality_features.items():
+                futures[columnar.artifact_name(f"{municipality}_features", storage_format, kind="features")] = executor.submit(upload_features, municipality, muni_features)
+            futures["normalization_parameters.csv"] = executor.submit(manifest.upload_if_changed, features_backend, "normalization_parameters.csv",
+                                                                      normalization_parameters.to_csv(sep=";", index=False), previous_outputs)
+        logging.info("Streaming the raw data to the app data storage")
+        raw_data_future = executor.submit(upload_raw_data)
+        outputs = {blob_name: future.result() for blob_name, future in futures.items()} | raw_data_future.result()
+
+    for blob_name in previous_outputs.keys() - outputs.keys():
+        if app_outputs.is_output_name(blob_name, "raw_data"):
+            if app_data_backend.exists(blob_name):
+                logging.info(f"Deleting an output of the raw data no longer written: {blob_name}")
+                app_data_backend.delete(blob_name)
+        elif features_backend is not None:
+            logging.info(f"Deleting the features of a municipality no longer in the data: {blob_name}")
+            features_backend.delete(blob_name)
+    return outputs
 
 def main():
     config = load_config()
-    logging.info("Creating client for authenticating to GCP")
-    storage_client = storage.Client(project=config["cloud"]["project_id"])
-    raw_data_bucket = storage_client.bucket(config["cloud"]["bucket_name_raw_data"])
-    postal_code_mapping_blob = raw_data_bucket.blob("postal_code_mapping.csv")
-    postal_code_info_latest_blob = raw_data_bucket.blob("postal_code_info_latest.csv")
-    postal_code_info_old_blob = raw_data_bucket.blob("postal_code_info_old.csv")
-    apartment_prices_areas_blob = raw_data_bucket.blob("apartment_prices_areas.csv")
-    apartment_prices_municipalities_blob = raw_data_bucket.blob("apartment_prices_municipalities.csv")
-
-    logging.info("Downloading the csv-files from the GCP cloud storage bucket")
-    postal_code_mapping_blob.download_to_filename("postal_code_mapping.csv")
-    postal_code_info_latest_blob.download_to_filename("postal_code_info_latest.csv")
-    postal_code_info_old_blob.download_to_filename("postal_code_info_old.csv")
-    apartment_prices_areas_blob.download_to_filename("apartment_prices_areas.csv")
-    apartment_prices_municipalities_blob.download_to_filename("apartment_prices_municipalities.csv")
-
-    logging.info("Reading the downloaded csv-files to Pandas dataframes")
-    postal_code_mapping = pd.read_csv("./postal_code_mapping.csv", sep=";")
-    postal_code_mapping = preprocess_data(postal_code_mapping)
-    postal_code_info_latest = pd.read_csv("./postal_code_info_latest.csv", sep=";")
-    postal_code_info_latest = preprocess_data(postal_code_info_latest)
-    postal_code_info_old = pd.read_csv("./postal_code_info_old.csv", sep=";")
-    postal_code_info_old = preprocess_data(postal_code_info_old)
-    apartment_prices_areas = pd.read_csv("./apartment_prices_areas.csv", sep=";")
-    apartment_prices_municipalities = pd.read_csv("./apartment_prices_municipalities.csv", sep=";")
-    apartment_prices_areas = preprocess_data(apartment_prices_areas)
-    
-    postal_code_info = feature_processing.calculate_population_growth(postal_code_info_latest, postal_code_info_old)
-    postal_code_info = postal_code_info.merge(postal_code_mapping, how="left", on="Postal code")
-    postal_code_info = feature_processing.process_middle_age(postal_code_info)
-    postal_code_info = feature_processing.process_student_ratio(postal_code_info)
-    postal_code_info = feature_processing.process_unemployment_rate(postal_code_info)
-    postal_code_info = feature_processing.process_pensioner_ratio(postal_code_info)
-    postal_code_info = feature_processing.process_housing_density(postal_code_info)
-    postal_code_info = feature_processing.process_population_density(postal_code_info)
-    postal_code_info = feature_processing.process_median_income(postal_code_info)
-    postal_code_info = feature_processing.process_higher_education(postal_code_info)
-    postal_code_info = feature_processing.process_rented_apartments(postal_code_info)
-    postal_code_info = feature_processing.process_block_apartments(postal_code_info)
-    apartment_prices = feature_processing.process_apartment_prices(apartment_prices_areas, apartment_prices_municipalities, postal_code_mapping)
-    postal_code_info = postal_code_info.merge(apartment_prices, how="left", on="Postal code")
-    
-    features = postal_code_info.loc[:, ["Postal code", "municipality", "Apartment price", "Change in population", "Middle age",
-                                    "Student ratio", "Unemployment rate", "Pensioner ratio", "Housing density", "Population density", 
-                                    "Median income", "Higher education ratio", "Households living on rent ratio", "Block apartment ratio"]]
-
-    features_bucket = storage_client.bucket(config["cloud"]["bucket_name_features"])
-    for municipality in postal_code_info["municipality"].unique():
-        logging.info(f"Normalizing features for {municipality} and uploading the result as a csv-file to GCP cloud storage bucket")
-        muni_features = normalize_features(features.loc[features["municipality"] == municipality,:].copy())
-        muni_features_blob = features_bucket.blob(f"{municipality}_features.csv")
-        muni_features_blob.upload_from_string(muni_features.to_csv(sep=";", index=False))
-    
-    app_data_bucket = storage_client.bucket(config["cloud"]["bucket_name_app_data"])
-
-    logging.info("Uploading the raw data as csv-file to GCP cloud storage bucket")
-    postal_code_info_blob = app_data_bucket.blob("raw_data.csv")
-    postal_code_info_blob.upload_from_string(postal_code_info.to_csv(sep=",", index=False, quoting=1))
+    instrumentation.configure(config["instrumentation"]["metrics_file"], "features")
+    with instrumentation.span("features"):
+        logging.info("Creating the storage backends")
+        backends = create_backends(config, {"raw_data": config["cloud"]["bucket_name_raw_data"], "features": config["cloud"]["bucket_name_features"],
+                                            "app_data": config["cloud"]["bucket_name_app_data"]})
+        storage_format = config["storage"]["format"]
+        output_settings = app_outputs.settings_from_config(config["app_data"])
+
+        logging.info("Comparing the raw data to the manifest of the previous run")
+        names = raw_data_names(config)
+        inputs = manifest.blob_hashes(backends["raw_data"], [columnar.artifact_name(name, storage_format) for name in names])
+        parameters = manifest_parameters(output_settings)
+        previous_manifest = manifest.load_manifest(backends["features"], "features_manifest.json")
+        if previous_manifest is not None and previous_manifest["inputs"] == inputs and previous_manifest["parameters"] == parameters:
+            logging.info("The raw data, the feature definitions and the output settings have not changed since the previous run, skipping the features")
+            return
+        previous_outputs = {} if previous_manifest is None else previous_manifest["outputs"]
+
+        logging.info("Reading the raw data from the storage to Pandas dataframes")
+        raw_data = load_raw_data(backends["raw_data"], storage_format, config["storage"]["max_workers"], names)
+        postal_code_info, municipality_features, normalization_parameters = compute_features(raw_data)
+        outputs = store_features(backends["features"], backends["app_data"], postal_code_info, municipality_features,
+                                 normalization_parameters, storage_format, previous_outputs, config["storage"]["max_workers"], output_settings)
+
+        logging.info("Saving the manifest of the features")
+        manifest.save_manifest(backends["features"], "features_manifest.json", inputs, outputs, parameters)
 
 
 if __name__ == "__main__":
-    main()
+    with instrumentation.profiled("features"):
+        main()
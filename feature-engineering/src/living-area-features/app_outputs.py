@@ -0,0 +1,167 @@
+from collections.abc import Callable, Iterable, Iterator
+from storage_backends import StorageBackend
+from dataclasses import dataclass
+import pyarrow.parquet as pq
+import pyarrow as pa
+import pandas as pd
+import numpy as np
+import itertools
+import columnar
+
+
+# Compressions of the csv outputs with the extensions of the names and the content types of the compressed outputs
+COMPRESSIONS = {"none": "", "gzip": ".gz", "zstd": ".zst"}
+CONTENT_TYPES = {"none": "text/csv", "gzip": "application/gzip", "zstd": "application/zstd"}
+PARQUET_CONTENT_TYPE = "application/vnd.apache.parquet"
+
+@dataclass
+class OutputSettings:
+    """Declarative definition of how the app data outputs are written. The outputs are streamed to the storage in
+    chunks of the given amount of rows, the csv outputs being compressed with "gzip" or "zstd" unless the compression is
+    "none". Only the given columns are written, or all of them if no columns are given. When partitioned by
+    municipality, the rows of every municipality are written to their own object under the prefix of the output, e.g.,
+    raw_data/Helsinki.csv.gz, instead of one object for all the municipalities.
+    """
+    compression: str = "none"
+    columns: list[str] | None = None
+    partition_by_municipality: bool = False
+    chunk_rows: int = 10000
+
+def settings_from_config(config: dict) -> OutputSettings:
+    """Create the output settings from the app data section of the config, failing on unknown compressions.
+    """
+    columns = config.get("columns", "all")
+    settings = OutputSettings(config.get("compression", "none"), None if columns == "all" else list(columns),
+                              config.get("partition_by_municipality", False), config.get("chunk_rows", 10000))
+    if settings.compression not in COMPRESSIONS:
+        raise ValueError(f"Unknown compression of the app data: {settings.compression}, expected one of {', '.join(COMPRESSIONS)}")
+    if settings.chunk_rows < 1:
+        raise ValueError("The chunks of the app data must have at least one row")
+    return settings
+
+def output_name(name: str, storage_format: str, settings: OutputSettings, municipality: str | None = None) -> str:
+    """Name of the app data output in the storage format, e.g., raw_data.csv.gz, or of the partition of the given
+    municipality, e.g., raw_data/Helsinki.csv.gz. Only the csv outputs are compressed, as Parquet files are compressed
+    internally.
+    """
+    name = name if municipality is None else f"{name}/{municipality}"
+    if storage_format == "columnar":
+        return f"{name}.parquet"
+    return f"{name}.csv{COMPRESSIONS[settings.compression]}"
+
+def is_output_name(blob_name: str, name: str) -> bool:
+    """Check whether the blob is the app data output of the given name or one of its partitions, in any format.
+    """
+    return blob_name.startswith((f"{name}.", f"{name}/"))
+
+class ChunkCollector:
+    """Writable file collecting the data written to it by an Arrow stream until the chunks are taken.
+    """
+    def __init__(self):
+        self.chunks = []
+        self.closed = False
+
+    def write(self, data: bytes) -> int:
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self) -> list[bytes]:
+        chunks, self.chunks = self.chunks, []
+        return chunks
+
+def row_chunks(df: pd.DataFrame, chunk_rows: int, order: np.ndarray | None = None) -> Iterator[pd.DataFrame]:
+    """Split the rows of the dataframe, or the rows of the given positions in their order, into chunks of at most the
+    given amount of rows. Only the rows of one chunk are copied at a time. Without rows there is one empty chunk, so
+    that the output still has a header.
+    """
+    positions = np.arange(len(df.index)) if order is None else order
+    for start in range(0, max(len(positions), 1), chunk_rows):
+        yield df.iloc[positions[start:start + chunk_rows]]
+
+def csv_chunks(frames: Iterable[pd.DataFrame], **csv_options) -> Iterator[bytes]:
+    """Serialize the frames to csv with the given options of to_csv, the header being written with the first frame.
+    """
+    for i, frame in enumerate(frames):
+        yield frame.to_csv(header=i == 0, **csv_options).encode("utf-8")
+
+def compressed_chunks(chunks: Iterable[bytes], compression: str) -> Iterator[bytes]:
+    """Compress the chunks into one gzip or zstd stream, yielding the compressed data as soon as the compressor
+    outputs it.
+    """
+    if compression == "none":
+        yield from chunks
+        return
+    collector = ChunkCollector()
+    stream = pa.CompressedOutputStream(pa.PythonFile(collector, mode="w"), compression)
+    for chunk in chunks:
+        stream.write(chunk)
+        yield from collector.take()
+    stream.close()
+    yield from collector.take()
+
+def parquet_chunks(frames: Iterable[pd.DataFrame]) -> Iterator[bytes]:
+    """Serialize the frames to one zstd-compressed Parquet file with a row group for every frame, all the frames
+    having the schema of the first one.
+    """
+    collector = ChunkCollector()
+    writer = None
+    for frame in frames:
+        table = columnar.to_arrow_table(frame, None if writer is None else writer.schema)
+        if writer is None:
+            writer = pq.ParquetWriter(pa.PythonFile(collector, mode="w"), table.schema, compression="zstd")
+        writer.write_table(table)
+        yield from collector.take()
+    writer.close()
+    yield from collector.take()
+
+def municipality_runs(frames: Iterable[pd.DataFrame], municipalities: Callable[[pd.DataFrame], np.ndarray]) -> Iterator[tuple[str, pd.DataFrame]]:
+    """Split the frames into runs of consecutive rows of the same municipality, given by the municipalities function
+    for the rows of a frame.
+    """
+    for frame in frames:
+        values = municipalities(frame)
+        boundaries = np.flatnonzero(values[1:] != values[:-1]) + 1
+        for start, stop in zip([0, *boundaries], [*boundaries, len(values)]):
+            yield values[start], frame.iloc[start:stop]
+
+def write_output(backend: StorageBackend, name: str, frames: Iterable[pd.DataFrame], storage_format: str, settings: OutputSettings,
+                 municipalities: Callable[[pd.DataFrame], np.ndarray] | None = None, **csv_options) -> dict[str, str]:
+    """Stream the frames of the app data output to the storage in the storage format, the csv outputs with the given
+    options of to_csv. The frames are serialized, compressed and uploaded one at a time, so the whole output is never
+    held in memory. When partitioned by municipality, the rows of every municipality, given by the municipalities
+    function, are streamed to the partition of the municipality, the rows of a municipality having to be consecutive.
+    Returns the content hashes of the written objects.
+    """
+    def write(blob_name: str, output_frames: Iterable[pd.DataFrame]) -> str:
+        if settings.columns is not None:
+            output_frames = (frame.loc[:, settings.columns] for frame in output_frames)
+        if storage_format == "columnar":
+            return backend.write_chunks(blob_name, parquet_chunks(output_frames), PARQUET_CONTENT_TYPE)
+        chunks = compressed_chunks(csv_chunks(output_frames, **csv_options), settings.compression)
+        return backend.write_chunks(blob_name, chunks, CONTENT_TYPES[settings.compression])
+
+    if not settings.partition_by_municipality:
+        blob_name = output_name(name, storage_format, settings)
+        return {blob_name: write(blob_name, frames)}
+    outputs = {}
+    for municipality, runs in itertools.groupby(municipality_runs(frames, municipalities), key=lambda run: run[0]):
+        blob_name = output_name(name, storage_format, settings, municipality)
+        if blob_name in outputs:
+            raise ValueError(f"The rows of the municipality {municipality} are not consecutive in the app data output {name}")
+        outputs[blob_name] = write(blob_name, (rows for _, rows in runs))
+    return outputs
+
+def read_output(backend: StorageBackend, blob_name: str) -> bytes:
+    """Read an app data output or one of its partitions, decompressing a compressed csv output.
+    """
+    data = backend.read(blob_name)
+    for compression, extension in COMPRESSIONS.items():
+        if extension and blob_name.endswith(extension):
+            return pa.input_stream(pa.BufferReader(data), compression=compression).read()
+    return data
@@ -0,0 +1,67 @@
+from pandas.api.types import is_numeric_dtype
+import pandas as pd
+import numpy as np
+
+
+# Placeholders of the StatFin data for values that are missing or confidential
+PLACEHOLDERS = ["...", "..", "."]
+POSTAL_CODE_WIDTH = 5
+# Integers up to this magnitude are exact in float32
+FLOAT32_EXACT_INTEGER = 2**24
+
+def fixed_width_postal_codes(postal_codes: pd.Series) -> pd.Series:
+    """Postal codes as five character codes with their leading zeros, stored in one Arrow string buffer instead of
+    separate Python strings.
+    """
+    return postal_codes.astype(str).str.pad(width=POSTAL_CODE_WIDTH, side="left", fillchar="0").astype("string[pyarrow]")
+
+def compact_numbers(values: pd.Series, fill_value: float | None) -> pd.Series:
+    """Downcast a numeric column, replacing its missing values with the fill value if given. Columns of integers,
+    e.g., counts of people, are int32, or int64 if they don't fit in it, and float32 with missing values if they are
+    exact in it. Other columns, e.g., ratios and averages, are float32.
+    """
+    numbers = values.to_numpy(dtype=float, na_value=np.nan, copy=True)
+    missing = np.isnan(numbers)
+    if fill_value is not None:
+        numbers[missing] = fill_value
+        missing[:] = False
+    present = numbers[~missing]
+    if not np.array_equal(present, np.trunc(present)):
+        dtype = np.float32
+    elif missing.any():
+        dtype = np.float32 if (np.abs(present) <= FLOAT32_EXACT_INTEGER).all() else np.float64
+    else:
+        limits = np.iinfo(np.int32)
+        dtype = np.int32 if ((present >= limits.min) & (present <= limits.max)).all() else np.int64
+    return pd.Series(numbers.astype(dtype), index=values.index, name=values.name)
+
+def compact_column(values: pd.Series, fill_value: float | None) -> pd.Series:
+    """Convert a column of a raw data table to its compact type: postal codes to fixed width codes, municipalities to
+    categories and numbers to the smallest type holding them. Text columns holding numbers and placeholders, e.g.,
+    the columns of tables that were not parsed from a file, are converted to numbers, and other text columns are kept.
+    """
+    if values.name == "Postal code":
+        return fixed_width_postal_codes(values)
+    if values.name == "municipality":
+        return values.astype("category")
+    if is_numeric_dtype(values):
+        return compact_numbers(values, fill_value)
+    values = values.replace(PLACEHOLDERS, np.nan)
+    numbers = pd.to_numeric(values, errors="coerce")
+    if numbers.notna().sum() < values.notna().sum():
+        return values
+    return compact_numbers(numbers, fill_value)
+
+def compact_table(df: pd.DataFrame, columns: list[str] | None = None, fill_value: float | None = 0.0) -> pd.DataFrame:
+    """Convert the given columns of a raw data table, or all of them, to their compact types. Missing values are
+    replaced with the fill value if given, so that the counts with missing values can be integers as well.
+    """
+    columns = df.columns if columns is None else columns
+    return pd.DataFrame({column: compact_column(df[column], fill_value) for column in columns}, index=df.index)
+
+def decimal_floats(df: pd.DataFrame) -> pd.DataFrame:
+    """Widen the float32 columns to float64 with the values of their shortest decimal representations, so that they
+    are written to text as they were parsed, e.g., 56.4 instead of 56.400001525878906.
+    """
+    float32_columns = df.columns[df.dtypes == np.float32]
+    return df.assign(**{column: df[column].to_numpy().astype(str).astype(float) for column in float32_columns})
@@ -1,149 +1,158 @@
+from dataclasses import dataclass, field
+from collections.abc import Mapping
 import numpy as np
 import pandas as pd
+import instrumentation
 import logging
 
 
-def calculate_population_growth(postal_code_info_latest: pd.DataFrame, postal_code_info_old: pd.DataFrame) -> pd.DataFrame:
-    """Creates the feature for population growth in the postal code area in last 5 years. The growth is calculated by taking
-    the difference between the current population and the population 5 years ago, and dividing the difference with the
-    area's population 5 years ago. Null values (e.g., due to dividing by zero) are treated as zeros, essentially meaning 
-    no change in population.
-    """
-    logging.info("Creating population growth feature")
-    df = postal_code_info_latest.loc[:, ["Postal code", "Asukkaat yhteensä (HE)"]].merge(
-        right=postal_code_info_old.loc[:, ["Postal code", "Asukkaat yhteensä (HE)"]], how="left", on="Postal code")
-    df["Change in population"] = (df["Asukkaat yhteensä (HE)_x"] - df["Asukkaat yhteensä (HE)_y"]) / df["Asukkaat yhteensä (HE)_y"]
-    logging.warning(f"Amount of missing values to be filled with zeros: {df['Change in population'].isna().sum()}")
-    df["Change in population"] = df["Change in population"].fillna(0)
-    postal_code_info = postal_code_info_latest.merge(df.loc[:, ["Postal code", "Change in population"]], how="left", on="Postal code")
-    return postal_code_info
+POPULATION = "Asukkaat yhteensä (HE)"
+OLD_POPULATION = "Asukkaat yhteensä (HE) 5 years ago"
+AREA_APARTMENT_PRICE = "Area apartment price"
+MUNICIPALITY_APARTMENT_PRICE = "Municipality apartment price"
+APARTMENT_PRICE = "Neliöhinta EUR/m2"
 
-def process_middle_age(postal_code_info: pd.DataFrame) -> pd.DataFrame:
-    """Creates the feature for the middle age of the postal code area. If the area doesn't have value for the middle age,
-    the middle age of the municipality will be used for the area instead.
+@dataclass
+class Feature:
+    """Declarative definition of a feature of the postal code areas. The value of the feature is the sum of the numerator
+    columns divided by the sum of the denominator columns, each column multiplied by its coefficient, or just the sum of
+    the numerator columns if there is no denominator. Where the missing column, or the value itself if not given, is zero,
+    the value is replaced with the fallback of the municipality. The fallback is either a given column or the aggregate of
+    the municipality: the ratio of the sums of the numerator and the denominator, or the average of the value weighted by
+    the weight column. Values that are still missing, e.g., due to dividing by zero, are replaced with the fill value.
     """
-    logging.info("Creating middle age feature")
-    postal_code_info["Asukkaiden keski-ikä (HE)"] = postal_code_info["Asukkaiden keski-ikä (HE)"].astype(int)
-    muni_middle_age = postal_code_info.groupby("municipality").apply(lambda data: (data["Asukkaiden keski-ikä (HE)"] * data["Asukkaat yhteensä (HE)"]).sum() / data["Asukkaat yhteensä (HE)"].sum())
-    muni_middle_age_df = pd.DataFrame(muni_middle_age, columns=["Muni middle age"]).reset_index("municipality")
-    postal_code_info = postal_code_info.merge(muni_middle_age_df, on="municipality", how="left")
-    logging.warning(f"Amount of missing values to be filled with the municipality's middle age: {(postal_code_info['Asukkaiden keski-ikä (HE)'] == 0).sum()}")
-    postal_code_info["Middle age"] = np.where(postal_code_info["Asukkaiden keski-ikä (HE)"] == 0, postal_code_info["Muni middle age"], postal_code_info["Asukkaiden keski-ikä (HE)"])
-    return postal_code_info
+    name: str
+    numerator: dict[str, float]
+    denominator: dict[str, float] = field(default_factory=dict)
+    weight: str | None = None
+    fallback: str | None = None
+    fallback_column: str | None = None
+    missing_column: str | None = None
+    fill_value: float | None = 0.0
 
-def process_student_ratio(postal_code_info: pd.DataFrame) -> pd.DataFrame:
-    """Creates the feature for student ratio in the postal code area. This is calculated by dividing the number of students
-    in the area by the population of the area. Missing values are filled with zeros.
-    """
-    logging.info("Creating student ratio feature")
-    postal_code_info["Student ratio"] = postal_code_info["Opiskelijat (PT)"].astype(int) / postal_code_info["Asukkaat yhteensä (HE)"].astype(int)
-    logging.warning(f"Amount of missing values to be filled with zeros: {postal_code_info['Student ratio'].isna().sum()}")
-    postal_code_info["Student ratio"] = postal_code_info["Student ratio"].fillna(0)
-    return postal_code_info
+FEATURES = [
+    # Apartment price of the postal code area, or of the whole municipality if the area doesn't have one
+    Feature("Apartment price", numerator={AREA_APARTMENT_PRICE: 1}, fallback_column=MUNICIPALITY_APARTMENT_PRICE, fill_value=None),
+    # Population growth in the last 5 years relative to the population 5 years ago, no change if not known
+    Feature("Change in population", numerator={POPULATION: 1, OLD_POPULATION: -1}, denominator={OLD_POPULATION: 1}),
+    # Middle age of the area, or the population weighted middle age of the municipality if the area doesn't have one
+    Feature("Middle age", numerator={"Asukkaiden keski-ikä (HE)": 1}, weight=POPULATION, fallback="Muni middle age", fill_value=None),
+    Feature("Student ratio", numerator={"Opiskelijat (PT)": 1}, denominator={POPULATION: 1}),
+    # Only the people who are part of the workforce are taken into account, the rate of the municipality is used for
+    # areas without population
+    Feature("Unemployment rate", numerator={"Työttömät (PT)": 1}, denominator={"Työttömät (PT)": 1, "Työlliset (PT)": 1},
+            fallback="Muni unemployment rate", missing_column=POPULATION),
+    Feature("Pensioner ratio", numerator={"Eläkeläiset (PT)": 1}, denominator={POPULATION: 1}),
+    Feature("Housing density", numerator={"Asumisväljyys (TE)": 1}, weight=POPULATION, fallback="Muni housing density", fill_value=None),
+    Feature("Population density", numerator={POPULATION: 1}, denominator={"Postinumeroalueen pinta-ala": 1}),
+    Feature("Median income", numerator={"Asukkaiden mediaanitulot (HR)": 1}, weight=POPULATION, fallback="Muni median income", fill_value=None),
+    # Higher education is either a university degree (Bachelor's or Master's) or a polytechnic degree
+    Feature("Higher education ratio", numerator={"Ylemmän korkeakoulututkinnon suorittaneet (KO)": 1, "Alemman korkeakoulututkinnon suorittaneet (KO)": 1},
+            denominator={POPULATION: 1}),
+    Feature("Households living on rent ratio", numerator={"Vuokra-asunnoissa asuvat taloudet (TE)": 1}, denominator={"Taloudet yhteensä (TE)": 1}),
+    Feature("Block apartment ratio", numerator={"Kerrostaloasunnot (RA)": 1}, denominator={"Asunnot (RA)": 1})
+]
 
-def process_unemployment_rate(postal_code_info: pd.DataFrame) -> pd.DataFrame:
-    """Creates the feature for unemployment rate of the postal code area. This is calculated by dividing the number of unemployed
-    people in the area by the sum of unemployed and employed people in the area. Therefore, only people who are part of the workforce
-    are taken into account in this feature. If the area doesn't have specified values for unemployed and employed people, the
-    unemployment rate of the municipality will be used for the area.
-    """
-    logging.info("Creating unemployment rate feature")
-    postal_code_info["Työttömät (PT)"] = postal_code_info["Työttömät (PT)"].astype(int)
-    postal_code_info["Työlliset (PT)"] = postal_code_info["Työlliset (PT)"].astype(int)
-    muni_unemployed_rate = postal_code_info.groupby("municipality").apply(lambda data: data["Työttömät (PT)"].sum() / (data["Työlliset (PT)"].sum() + data["Työttömät (PT)"].sum()))
-    muni_unemployed_rate_df = pd.DataFrame(muni_unemployed_rate, columns=["Muni unemployment rate"]).reset_index("municipality")
-    postal_code_info = postal_code_info.merge(muni_unemployed_rate_df, on="municipality", how="left")
-    logging.warning(f"Amount of missing values to be filled with the municipality's unemployment rate: {(postal_code_info['Asukkaat yhteensä (HE)'] == 0).sum()}")
-    postal_code_info["Unemployment rate"] = np.where(postal_code_info["Asukkaat yhteensä (HE)"] != 0, postal_code_info["Työttömät (PT)"] / (postal_code_info["Työttömät (PT)"] + postal_code_info["Työlliset (PT)"]), postal_code_info["Muni unemployment rate"])
-    logging.warning(f"Amount of values without workforce to be filled with zeros: {postal_code_info['Unemployment rate'].isna().sum()}")
-    postal_code_info["Unemployment rate"] = postal_code_info["Unemployment rate"].fillna(0)
-    return postal_code_info
+FEATURE_NAMES = [feature.name for feature in FEATURES]
 
-def process_pensioner_ratio(postal_code_info: pd.DataFrame) -> pd.DataFrame:
-    """Creates the feature for pensioner ratio in the postal code area. This is calculated by dividing the number of pensioners
-    in the area by the population of the area. Missing values are filled with zeros.
+@instrumentation.timed
+def feature_inputs(postal_code_info: pd.DataFrame, postal_code_info_old: pd.DataFrame, apartment_prices_areas: pd.DataFrame,
+                   apartment_prices_municipalities: pd.DataFrame) -> dict[str, pd.Series | np.ndarray]:
+    """Collect the input columns of the features. The columns of the postal code info are used as they are, and the old
+    population and the apartment prices are aligned to its postal code areas by lookups instead of merging the tables.
+    Areas without an apartment price of their own have the price zero, so that the price of the municipality is used.
     """
-    logging.info("Creating pensioner ratio feature")
-    postal_code_info["Pensioner ratio"] = postal_code_info["Eläkeläiset (PT)"].astype(int) / postal_code_info["Asukkaat yhteensä (HE)"]
-    logging.warning(f"Amount of missing values to be filled with zeros: {postal_code_info['Pensioner ratio'].isna().sum()}")
-    postal_code_info["Pensioner ratio"] = postal_code_info["Pensioner ratio"].fillna(0)
-    return postal_code_info
+    postal_codes = postal_code_info["Postal code"]
+    inputs = {column: postal_code_info[column] for column in postal_code_info.columns}
+    inputs[OLD_POPULATION] = postal_code_info_old.set_index("Postal code")[POPULATION].reindex(postal_codes).to_numpy(dtype=float)
+    inputs[AREA_APARTMENT_PRICE] = apartment_prices_areas.set_index("Postal code")[APARTMENT_PRICE].reindex(postal_codes).fillna(0).to_numpy(dtype=float)
+    inputs[MUNICIPALITY_APARTMENT_PRICE] = postal_code_info["municipality"].map(apartment_prices_municipalities.set_index("municipality")[APARTMENT_PRICE]).to_numpy(dtype=float)
+    return inputs
 
-def process_housing_density(postal_code_info: pd.DataFrame) -> pd.DataFrame:
-    """Creates the feature for housing density. If the postal code area doesn't have any value for this in the data, the
-    average value of the whole municipality will be used as the feature value for the area.
+def output_columns(features: list[Feature]) -> list[str]:
+    """Names of the columns built for the given features: the aggregate of the municipality used as the fallback,
+    if any, followed by the feature itself.
     """
-    logging.info("Creating housing density feature")
-    postal_code_info["Asumisväljyys (TE)"] = postal_code_info["Asumisväljyys (TE)"].astype(float)
-    muni_housing_density = postal_code_info.groupby("municipality").apply(lambda data: (data["Asukkaat yhteensä (HE)"] * data["Asumisväljyys (TE)"]).sum() / data["Asukkaat yhteensä (HE)"].sum())
-    muni_housing_density_df = pd.DataFrame(muni_housing_density, columns=["Muni housing density"]).reset_index("municipality")
-    postal_code_info = postal_code_info.merge(muni_housing_density_df, how="left", on="municipality")
-    logging.warning(f"Amount of missing values to be filled with municipality's average housing density: {(postal_code_info['Asumisväljyys (TE)'] == 0).sum()}")
-    postal_code_info["Housing density"] = np.where(postal_code_info["Asumisväljyys (TE)"] == 0, postal_code_info["Muni housing density"], postal_code_info["Asumisväljyys (TE)"])
-    return postal_code_info
+    return [column for feature in features for column in ([feature.fallback] if feature.fallback else []) + [feature.name]]
 
-def process_population_density(postal_code_info: pd.DataFrame) -> pd.DataFrame:
-    """Creates the feature for population density by dividing the population amount by the surface area of the postal code area.
-    Missing values will be replaced with zeros.
+def linear_combination(inputs: Mapping[str, pd.Series | np.ndarray], coefficients: dict[str, float], length: int) -> np.ndarray:
+    """Sum the given input columns multiplied by their coefficients.
     """
-    logging.info("Create feature for population density")
-    postal_code_info["Population density"] = postal_code_info["Asukkaat yhteensä (HE)"] / postal_code_info["Postinumeroalueen pinta-ala"] 
-    logging.warning(f"Amount of missing values to be filled with zeros: {postal_code_info['Population density'].isna().sum()}")
-    postal_code_info["Population density"] = postal_code_info["Population density"].fillna(0)
-    return postal_code_info
+    total = np.zeros(length)
+    for column, coefficient in coefficients.items():
+        total += coefficient * np.asarray(inputs[column], dtype=float)
+    return total
 
-def process_median_income(postal_code_info: pd.DataFrame) -> pd.DataFrame:
-    """Creates the feature for median income of the postal code area. If the postal code area doesn't have any value for this 
-    in the data, the average value of the whole municipality will be used as the feature value for the area.
+@instrumentation.timed
+def municipality_sums(terms: np.ndarray, codes: np.ndarray, municipality_count: int) -> np.ndarray:
+    """Sum the rows of the terms matrix by municipality in one grouped reduction over the rows sorted by municipality.
+    Rows without a municipality, i.e., with the code -1, are left out and missing terms are treated as zeros.
     """
-    logging.info("Create feature for median income")
-    postal_code_info["Asukkaiden mediaanitulot (HR)"] = postal_code_info["Asukkaiden mediaanitulot (HR)"].astype(float)
-    muni_median_income = postal_code_info.groupby("municipality").apply(lambda data: (data["Asukkaat yhteensä (HE)"] * data["Asukkaiden mediaanitulot (HR)"]).sum() / data["Asukkaat yhteensä (HE)"].sum())
-    muni_median_income_df = pd.DataFrame(muni_median_income, columns=["Muni median income"]).reset_index("municipality")
-    postal_code_info = postal_code_info.merge(muni_median_income_df, how="left", on="municipality")
-    logging.warning(f"Amount of missing values to be filled with municipality's average median income: {(postal_code_info['Asukkaiden mediaanitulot (HR)'] == 0).sum()}")
-    postal_code_info["Median income"] = np.where(postal_code_info["Asukkaiden mediaanitulot (HR)"] == 0, postal_code_info["Muni median income"], postal_code_info["Asukkaiden mediaanitulot (HR)"])
-    return postal_code_info
+    if municipality_count == 0:
+        return np.zeros((0, terms.shape[1]))
+    order = np.argsort(codes, kind="stable")
+    order = order[codes[order] >= 0]
+    starts = np.searchsorted(codes[order], np.arange(municipality_count))
+    return np.add.reduceat(np.nan_to_num(terms[order]), starts, axis=0)
 
-def process_higher_education(postal_code_info: pd.DataFrame) -> pd.DataFrame:
-    """Creates the feature for higher education ratio of the population in the postal code area. Higher education is defined as
-    either a university degree (Bachelor's or Master's) or a polytechnic degree. The ratio is calculated by dividing the amount of
-    people with a higher education degree by the population of the postal code area. Missing values are replaced with zeros.
+@instrumentation.timed
+def build_features(inputs: Mapping[str, pd.Series | np.ndarray], municipalities: pd.Series, features: list[Feature] = FEATURES,
+                   index: pd.Index | None = None) -> pd.DataFrame:
+    """Build the columns of the given features into one preallocated matrix. The raw values of all the features are
+    computed first, then the aggregates of the municipalities needed for the fallbacks are computed for all the features
+    at once, and lastly the fallbacks and the fill values are applied in place. Returns the matrix as a dataframe with the
+    aggregates used as the fallbacks and the features as its columns. The computation of every feature is recorded
+    as a span and the amounts of filled values as counts.
     """
-    logging.info("Create feature for higher education ratio")
-    postal_code_info["Higher education ratio"] = (postal_code_info["Ylemmän korkeakoulututkinnon suorittaneet (KO)"].astype(int) + postal_code_info["Alemman korkeakoulututkinnon suorittaneet (KO)"].astype(int)) / postal_code_info["Asukkaat yhteensä (HE)"]
-    logging.warning(f"Amount of missing values to be filled with zeros: {postal_code_info['Higher education ratio'].isna().sum()}")
-    postal_code_info["Higher education ratio"] = postal_code_info["Higher education ratio"].fillna(0)
-    return postal_code_info
+    length = len(municipalities)
+    codes, municipality_names = pd.factorize(municipalities)
+    columns = output_columns(features)
+    result = np.empty((length, len(columns)), order="F")
+    aggregated = [feature for feature in features if feature.fallback is not None]
+    aggregate_terms = np.empty((length, 2 * len(aggregated)))
 
-def process_rented_apartments(postal_code_info: pd.DataFrame) -> pd.DataFrame:
-    """Creates the feature for the ratio of households living in rented apartments of all the households in the postal code area.
-    Missing values are replaced with zeros.
-    """
-    logging.info("Create feature for rented apartments ratio")
-    postal_code_info["Households living on rent ratio"] = postal_code_info["Vuokra-asunnoissa asuvat taloudet (TE)"].astype(int) / postal_code_info["Taloudet yhteensä (TE)"].astype(int)
-    logging.warning(f"Amount of missing values to be filled with zeros: {postal_code_info['Households living on rent ratio'].isna().sum()}")
-    postal_code_info["Households living on rent ratio"] = postal_code_info["Households living on rent ratio"].fillna(0)
-    return postal_code_info
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for feature in features:
+            with instrumentation.span("feature", feature=feature.name, rows_out=length):
+                numerator = linear_combination(inputs, feature.numerator, length)
+                value = result[:, columns.index(feature.name)]
+                if feature.denominator:
+                    denominator = linear_combination(inputs, feature.denominator, length)
+                    np.divide(numerator, denominator, out=value)
+                else:
+                    value[:] = numerator
+                if feature.fallback is not None:
+                    position = aggregated.index(feature)
+                    if feature.denominator:
+                        aggregate_terms[:, 2 * position] = numerator
+                        aggregate_terms[:, 2 * position + 1] = denominator
+                    else:
+                        weight = np.asarray(inputs[feature.weight], dtype=float)
+                        aggregate_terms[:, 2 * position] = value * weight
+                        aggregate_terms[:, 2 * position + 1] = weight
 
-def process_block_apartments(postal_code_info: pd.DataFrame) -> pd.DataFrame:
-    """Creates the feature for the ratio of block apartments of all of the apartments in the postal code area. Missing values are replaced
-    with zeros.
-    """
-    logging.info("Create feature for block apartments ratio")
-    postal_code_info["Block apartment ratio"] = postal_code_info["Kerrostaloasunnot (RA)"].astype(int) / postal_code_info["Asunnot (RA)"].astype(int)
-    logging.warning(f"Amount of missing values to be filled with zeros: {postal_code_info['Block apartment ratio'].isna().sum()}")
-    postal_code_info["Block apartment ratio"] = postal_code_info["Block apartment ratio"].fillna(0)
-    return postal_code_info
+        logging.info(f"Computing the aggregates of {len(municipality_names)} municipalities for {len(aggregated)} features")
+        sums = municipality_sums(aggregate_terms, codes, len(municipality_names))
+        # The last row of the aggregates is for the areas without a municipality, which are indexed with -1
+        aggregates = np.vstack([sums[:, 0::2] / sums[:, 1::2], np.full((1, len(aggregated)), np.nan)])
 
-def process_apartment_prices(apartment_prices_areas: pd.DataFrame, apartment_prices_municipalities: pd.DataFrame, postal_code_mapping: pd.DataFrame) -> pd.DataFrame:
-    """Creates the feature for apartment prices of the postal code area. If the postal code area doesn't have a value for the apartment price,
-    the apartment price value of the whole municipality will be used as the feature value.
-    """
-    logging.info("Create feature for apartment prices")
-    apartment_prices = postal_code_mapping.merge(apartment_prices_areas, how="left", on="Postal code").fillna(0)
-    apartment_prices = apartment_prices.merge(apartment_prices_municipalities, how="left", on="municipality")
-    logging.warning(f"Amount of missing values to be filled with municipality's average apartment price: {(apartment_prices['Neliöhinta EUR/m2_x'] == 0).sum()}")
-    apartment_prices["Apartment price"] = np.where(apartment_prices["Neliöhinta EUR/m2_x"] == 0, apartment_prices["Neliöhinta EUR/m2_y"], apartment_prices["Neliöhinta EUR/m2_x"])
-    apartment_prices = apartment_prices.loc[:,["Postal code", "Apartment price"]]
-    return apartment_prices
+    for feature in features:
+        value = result[:, columns.index(feature.name)]
+        if feature.fallback is not None:
+            fallback = result[:, columns.index(feature.fallback)]
+            fallback[:] = aggregates[codes, aggregated.index(feature)]
+        elif feature.fallback_column is not None:
+            fallback = np.asarray(inputs[feature.fallback_column], dtype=float)
+        else:
+            fallback = None
+        if fallback is not None:
+            missing = (np.asarray(inputs[feature.missing_column], dtype=float) if feature.missing_column else value) == 0
+            logging.warning(f"Amount of missing values of {feature.name} to be filled with the municipality's value: {missing.sum()}")
+            instrumentation.count("filled_with_municipality_value", int(missing.sum()), feature=feature.name)
+            np.copyto(value, fallback, where=missing)
+        if feature.fill_value is not None:
+            missing = np.isnan(value)
+            logging.warning(f"Amount of missing values of {feature.name} to be filled with {feature.fill_value}: {missing.sum()}")
+            instrumentation.count("filled_with_fill_value", int(missing.sum()), feature=feature.name)
+            value[missing] = feature.fill_value
+    return pd.DataFrame(result, columns=columns, index=index, copy=False)
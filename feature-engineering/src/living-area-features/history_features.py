@@ -0,0 +1,111 @@
+from dataclasses import dataclass
+import numpy as np
+import pandas as pd
+import instrumentation
+import logging
+
+
+POPULATION = "Asukkaat yhteensä (HE)"
+MEDIAN_INCOME = "Asukkaiden mediaanitulot (HR)"
+
+@dataclass
+class HistoryFeature:
+    """Declarative definition of a time-series feature of the postal code areas, computed from the values of the column
+    over the years of the postal code info panel with the given statistic: "growth", "trend" or "volatility".
+    Values that can't be computed, e.g., for areas with less than two years of data, are replaced with the fill value.
+    """
+    name: str
+    column: str
+    statistic: str
+    fill_value: float = 0.0
+
+HISTORY_FEATURES = [
+    # Average yearly change of the population relative to the average population of the years
+    HistoryFeature("Population trend", POPULATION, "trend"),
+    # Variation of the yearly relative changes of the population
+    HistoryFeature("Population volatility", POPULATION, "volatility"),
+    HistoryFeature("Median income growth", MEDIAN_INCOME, "growth"),
+    HistoryFeature("Median income volatility", MEDIAN_INCOME, "volatility")
+]
+
+HISTORY_FEATURE_NAMES = [feature.name for feature in HISTORY_FEATURES]
+
+def panel_values(history: pd.DataFrame, postal_codes: pd.Series, column: str) -> tuple[np.ndarray, np.ndarray]:
+    """Arrange the values of the column in the postal code info panel into a matrix with a row for each of the given
+    postal codes and a column for each year. Missing values and values that are not positive, e.g., the zero population
+    of an area that did not exist yet, are NaNs. Returns the matrix and the years of its columns.
+    """
+    area_indices, panel_postal_codes = pd.factorize(history["Postal code"])
+    year_indices, years = pd.factorize(history["Year"], sort=True)
+    values = np.full((len(panel_postal_codes), len(years)), np.nan)
+    values[area_indices, year_indices] = history[column].to_numpy(dtype=float, na_value=np.nan)
+    values[~(values > 0)] = np.nan
+    rows = panel_postal_codes.get_indexer(postal_codes)
+    result = values[rows]
+    result[rows < 0] = np.nan
+    return result, years.to_numpy(dtype=float)
+
+def growth(values: np.ndarray, years: np.ndarray) -> np.ndarray:
+    """Average yearly growth rate between the first and the last year with a value.
+    """
+    valid = ~np.isnan(values)
+    rows = np.arange(len(values))
+    first = np.argmax(valid, axis=1)
+    last = values.shape[1] - 1 - np.argmax(valid[:, ::-1], axis=1)
+    elapsed_years = years[last] - years[first]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        result = (values[rows, last] / values[rows, first])**(1 / elapsed_years) - 1
+    result[elapsed_years <= 0] = np.nan
+    return result
+
+def trend(values: np.ndarray, years: np.ndarray) -> np.ndarray:
+    """Slope of the least squares line fitted to the values of every row over the years, relative to the mean of the
+    values, i.e., the average yearly change as a share of the average level.
+    """
+    valid = ~np.isnan(values)
+    counts = valid.sum(axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean_years = np.where(valid, years, 0).sum(axis=1) / counts
+        mean_values = np.where(valid, values, 0).sum(axis=1) / counts
+        year_deviations = np.where(valid, years - mean_years[:, np.newaxis], 0)
+        value_deviations = np.where(valid, values - mean_values[:, np.newaxis], 0)
+        slopes = (year_deviations * value_deviations).sum(axis=1) / (year_deviations**2).sum(axis=1)
+        result = slopes / mean_values
+    result[counts < 2] = np.nan
+    return result
+
+def volatility(values: np.ndarray, years: np.ndarray) -> np.ndarray:
+    """Standard deviation of the relative changes between consecutive years with values.
+    """
+    changes = values[:, 1:] / values[:, :-1] - 1
+    valid = ~np.isnan(changes)
+    counts = valid.sum(axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        means = np.where(valid, changes, 0).sum(axis=1) / counts
+        result = np.sqrt((np.where(valid, changes - means[:, np.newaxis], 0)**2).sum(axis=1) / counts)
+    result[counts < 2] = np.nan
+    return result
+
+STATISTICS = {"growth": growth, "trend": trend, "volatility": volatility}
+
+@instrumentation.timed
+def build_history_features(history: pd.DataFrame, postal_codes: pd.Series, features: list[HistoryFeature] = HISTORY_FEATURES,
+                           index: pd.Index | None = None) -> pd.DataFrame:
+    """Build the time-series features of the given postal code areas from the postal code info panel. The values of
+    each column are arranged into a matrix of the areas and the years once, and the statistics are computed for all
+    the areas at once along the years. Returns the features as the columns of a dataframe.
+    """
+    logging.info(f"Building the history features from {history['Year'].nunique()} years of postal code info")
+    result = np.empty((len(postal_codes), len(features)), order="F")
+    columns = {}
+    for i, feature in enumerate(features):
+        with instrumentation.span("feature", feature=feature.name, rows_out=len(postal_codes)):
+            if feature.column not in columns:
+                columns[feature.column] = panel_values(history, postal_codes, feature.column)
+            value = result[:, i]
+            value[:] = STATISTICS[feature.statistic](*columns[feature.column])
+            missing = np.isnan(value)
+            logging.warning(f"Amount of missing values of {feature.name} to be filled with {feature.fill_value}: {missing.sum()}")
+            instrumentation.count("filled_with_fill_value", int(missing.sum()), feature=feature.name)
+            value[missing] = feature.fill_value
+    return pd.DataFrame(result, columns=[feature.name for feature in features], index=index, copy=False)
@@ -0,0 +1,65 @@
+from compact_tables import compact_table, decimal_floats
+import pandas as pd
+import numpy as np
+import io
+
+
+RAW_CSV = """Postal code;municipality;Asukkaat yhteensä (HE);Asukkaiden keski-ikä (HE);Postinumeroalueen pinta-ala;Kerrostaloasunnot (RA);Nimi
+100;Helsinki;18284;41.2;2353278.0;9931;Helsinki Keskusta
+120;Helsinki;7108;40.5;414010.0;..;Punavuori
+2100;Espoo;...;.;5543202.5;4102;Tapiola
+2230;Espoo;6244;;1287210.25;3001;Matinkylä
+"""
+
+def baseline_preprocess(df: pd.DataFrame) -> pd.DataFrame:
+    """Baseline of the preprocessing before the compact tables, replacing the placeholders and missing values with
+    zeros in object columns.
+    """
+    df = df.copy()
+    df["Postal code"] = df["Postal code"].astype(str).str.pad(width=5, side="left", fillchar="0")
+    return df.replace(["...", "..", "."], 0).fillna(0)
+
+def raw_table(**options) -> pd.DataFrame:
+    return pd.read_csv(io.StringIO(RAW_CSV), sep=";", **options)
+
+def test_compact_table_matches_the_baseline():
+    for df in [raw_table(), raw_table(dtype=str), raw_table(na_values=["...", "..", "."])]:
+        result = compact_table(df)
+        expected = baseline_preprocess(df)
+        assert result["Postal code"].tolist() == ["00100", "00120", "02100", "02230"]
+        assert result["municipality"].tolist() == expected["municipality"].tolist()
+        assert result["Nimi"].tolist() == expected["Nimi"].tolist()
+        numeric = ["Asukkaat yhteensä (HE)", "Asukkaiden keski-ikä (HE)", "Postinumeroalueen pinta-ala", "Kerrostaloasunnot (RA)"]
+        pd.testing.assert_frame_equal(decimal_floats(result[numeric]), expected[numeric].astype(float), check_dtype=False)
+
+def test_compact_types():
+    result = compact_table(raw_table(na_values=["...", "..", "."]))
+    assert result["Postal code"].dtype == "string[pyarrow]"
+    assert result["municipality"].dtype == "category"
+    assert result["Asukkaat yhteensä (HE)"].dtype == np.int32
+    assert result["Kerrostaloasunnot (RA)"].dtype == np.int32
+    assert result["Asukkaiden keski-ikä (HE)"].dtype == np.float32
+    assert result["Postinumeroalueen pinta-ala"].dtype == np.float32
+    assert result["Nimi"].dtype == object
+
+def test_integers_keep_their_values():
+    df = pd.DataFrame({"Postal code": ["00100", "00120", "00130"], "small": [1.0, np.nan, 3.0], "large": [2.0**31, 1.0, 0.0],
+                       "large with missing": [2.0**24 + 1, np.nan, 0.0]})
+    filled = compact_table(df)
+    assert filled["small"].dtype == np.int32 and filled["small"].tolist() == [1, 0, 3]
+    assert filled["large"].dtype == np.int64 and filled["large"].tolist() == [2**31, 1, 0]
+    unfilled = compact_table(df, fill_value=None)
+    assert unfilled["small"].dtype == np.float32
+    np.testing.assert_array_equal(unfilled["small"], [1, np.nan, 3])
+    assert unfilled["large with missing"].dtype == np.float64
+    np.testing.assert_array_equal(unfilled["large with missing"], [2**24 + 1, np.nan, 0])
+
+def test_only_the_given_columns_are_compacted():
+    result = compact_table(raw_table(), ["Postal code", "Asukkaat yhteensä (HE)"])
+    assert list(result.columns) == ["Postal code", "Asukkaat yhteensä (HE)"]
+    assert result["Asukkaat yhteensä (HE)"].tolist() == [18284, 7108, 0, 6244]
+
+def test_decimal_floats_write_the_parsed_values():
+    result = decimal_floats(compact_table(raw_table(na_values=["...", "..", "."])))
+    assert result["Asukkaiden keski-ikä (HE)"].dtype == np.float64
+    assert result.to_csv(sep=";", index=False).splitlines()[1] == "00100;Helsinki;18284;41.2;2353278.0;9931;Helsinki Keskusta"
@@ -0,0 +1,76 @@
+from feature_processing import FEATURES, Feature, build_features, municipality_sums
+import pandas as pd
+import numpy as np
+import pytest
+
+
+MUNICIPALITIES = ["Helsinki", "Espoo", "Vantaa", "Kauniainen", None]
+
+def feature_inputs(rows: int, seed: int = 0) -> tuple[dict[str, pd.Series], pd.Series]:
+    """Random inputs of all the features and the municipalities of the rows, with zeros for the fallbacks and missing
+    values, and rows without a municipality.
+    """
+    rng = np.random.default_rng(seed)
+    columns = {column for feature in FEATURES for column in [*feature.numerator, *feature.denominator, feature.weight,
+                                                           feature.fallback_column, feature.missing_column] if column is not None}
+    inputs = {}
+    for column in sorted(columns):
+        values = rng.integers(0, 1000, size=rows).astype(float)
+        values[rng.random(rows) < 0.1] = 0
+        values[rng.random(rows) < 0.05] = np.nan
+        inputs[column] = pd.Series(values)
+    municipalities = pd.Series(rng.choice(np.array(MUNICIPALITIES, dtype=object), size=rows))
+    return inputs, municipalities
+
+def baseline_features(inputs: dict[str, pd.Series], municipalities: pd.Series, features: list[Feature]) -> pd.DataFrame:
+    """Baseline of the features computing the aggregates of the municipalities with a pandas groupby, one feature
+    at a time.
+    """
+    columns = {}
+    for feature in features:
+        numerator = sum(coefficient * inputs[column] for column, coefficient in feature.numerator.items())
+        denominator = sum(coefficient * inputs[column] for column, coefficient in feature.denominator.items()) if feature.denominator else None
+        with np.errstate(divide="ignore", invalid="ignore"):
+            value = numerator / denominator if denominator is not None else numerator
+        fallback = None
+        if feature.fallback is not None:
+            if denominator is not None:
+                terms = pd.DataFrame({"numerator": numerator, "denominator": denominator})
+            else:
+                terms = pd.DataFrame({"numerator": value * inputs[feature.weight], "denominator": inputs[feature.weight]})
+            sums = terms.groupby(municipalities).sum()
+            with np.errstate(divide="ignore", invalid="ignore"):
+                fallback = municipalities.map(sums["numerator"] / sums["denominator"]).astype(float)
+            columns[feature.fallback] = fallback
+        elif feature.fallback_column is not None:
+            fallback = inputs[feature.fallback_column]
+        if fallback is not None:
+            missing = (inputs[feature.missing_column] if feature.missing_column else value) == 0
+            value = value.where(~missing, fallback)
+        if feature.fill_value is not None:
+            value = value.fillna(feature.fill_value)
+        columns[feature.name] = value
+    return pd.DataFrame(columns)
+
+@pytest.mark.parametrize("rows", [1, 17, 500])
+def test_features_match_the_groupby_baseline(rows):
+    inputs, municipalities = feature_inputs(rows, rows)
+    result = build_features(inputs, municipalities)
+    expected = baseline_features(inputs, municipalities, FEATURES)
+    pd.testing.assert_frame_equal(result, expected, check_exact=False, rtol=1e-12)
+
+def test_features_without_municipalities():
+    inputs, municipalities = feature_inputs(20)
+    municipalities[:] = None
+    result = build_features(inputs, municipalities)
+    pd.testing.assert_frame_equal(result, baseline_features(inputs, municipalities, FEATURES), check_exact=False, rtol=1e-12)
+
+def test_municipality_sums_match_the_groupby_baseline():
+    rng = np.random.default_rng(0)
+    municipalities = pd.Series(rng.choice(np.array(MUNICIPALITIES, dtype=object), size=300))
+    codes, names = pd.factorize(municipalities)
+    terms = rng.normal(size=(300, 4))
+    terms[rng.random(terms.shape) < 0.1] = np.nan
+    expected = pd.DataFrame(terms).groupby(municipalities).sum().reindex(names)
+    np.testing.assert_allclose(municipality_sums(terms, codes, len(names)), expected.to_numpy(), rtol=1e-12)
+    assert municipality_sums(terms[:0], codes[:0], 0).shape == (0, 4)
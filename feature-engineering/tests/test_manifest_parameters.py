@@ -0,0 +1,31 @@
+import dataclasses
+import feature_processing
+import history_features
+import app_outputs
+
+
+def test_parameters_are_stable(features):
+    settings = app_outputs.OutputSettings()
+    assert features.manifest_parameters(settings) == features.manifest_parameters(settings)
+    assert features.manifest_parameters(settings)["app_data"] == dataclasses.asdict(settings)
+
+def test_changed_feature_definitions_change_the_parameters(features, monkeypatch):
+    settings = app_outputs.OutputSettings()
+    parameters = features.manifest_parameters(settings)
+    changed = [dataclasses.replace(feature, fill_value=1.0) if feature.name == "Student ratio" else feature for feature in feature_processing.FEATURES]
+    monkeypatch.setattr(feature_processing, "FEATURES", changed)
+    assert features.manifest_parameters(settings) != parameters
+    monkeypatch.undo()
+    monkeypatch.setattr(history_features, "HISTORY_FEATURES", history_features.HISTORY_FEATURES[:-1])
+    assert features.manifest_parameters(settings) != parameters
+
+def test_changed_output_settings_change_the_parameters(features):
+    assert features.manifest_parameters(app_outputs.OutputSettings()) != features.manifest_parameters(app_outputs.OutputSettings(compression="gzip"))
+
+def test_only_the_definitions_and_the_version_change_the_parameters(features, monkeypatch):
+    settings = app_outputs.OutputSettings()
+    parameters = features.manifest_parameters(settings)
+    monkeypatch.setattr(feature_processing, "build_features", lambda *arguments: None)
+    assert features.manifest_parameters(settings) == parameters
+    monkeypatch.setattr(features, "FEATURES_VERSION", features.FEATURES_VERSION + 1)
+    assert features.manifest_parameters(settings) != parameters
@@ -0,0 +1,56 @@
+from feature_processing import FEATURE_NAMES
+from sklearn.preprocessing import StandardScaler
+import pandas as pd
+import numpy as np
+import pytest
+
+
+MUNICIPALITIES = ["Helsinki", "Espoo", "Vantaa", "Kauniainen", "Sipoo"]
+
+def municipality_features(rows: int, seed: int = 0) -> pd.DataFrame:
+    """Random features of the areas of the municipalities, with missing values, population growths over 200%, areas
+    without population density, a municipality with a constant feature and one with a single area.
+    """
+    rng = np.random.default_rng(seed)
+    features = pd.DataFrame(rng.lognormal(size=(rows, len(FEATURE_NAMES))), columns=FEATURE_NAMES)
+    features[rng.random(features.shape) < 0.05] = np.nan
+    features.loc[rng.random(rows) < 0.2, "Change in population"] = 3.5
+    features.loc[rng.random(rows) < 0.2, "Population density"] = 0
+    municipalities = rng.choice(MUNICIPALITIES[:4], size=rows)
+    municipalities[-1] = MUNICIPALITIES[4]
+    features.loc[municipalities == "Espoo", "Median income"] = 25000
+    features.insert(0, "municipality", municipalities)
+    features.insert(0, "Postal code", [f"{row:05d}" for row in range(rows)])
+    return features
+
+def baseline_normalization(features: pd.DataFrame) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """Baseline normalizing the features of one municipality with the scikit-learn StandardScaler.
+    """
+    features = features.copy()
+    features["Change in population"] = np.where(features["Change in population"] > 2, 2, features["Change in population"])
+    with np.errstate(divide="ignore"):
+        minimum_log_density = np.log(features.loc[features["Population density"] > 0, "Population density"]).min()
+        features["Population density"] = np.where(features["Population density"] > 0, np.log(features["Population density"]), minimum_log_density)
+    scaler = StandardScaler()
+    features.iloc[:, 2:] = scaler.fit_transform(features.iloc[:, 2:].to_numpy())
+    return features, pd.DataFrame({"feature": features.columns[2:], "mean": scaler.mean_, "scale": scaler.scale_})
+
+@pytest.mark.parametrize("rows", [5, 40, 1000])
+def test_normalization_matches_the_standard_scaler_of_every_municipality(features, rows):
+    all_features = municipality_features(rows, rows)
+    normalized, parameters = features.normalize_features(all_features.copy())
+    assert list(normalized) == list(dict.fromkeys(all_features["municipality"]))
+    for municipality, municipality_normalized in normalized.items():
+        expected, expected_parameters = baseline_normalization(all_features.loc[all_features["municipality"] == municipality])
+        pd.testing.assert_frame_equal(municipality_normalized, expected, check_exact=False, rtol=1e-12, atol=1e-12)
+        municipality_parameters = parameters.loc[parameters["municipality"] == municipality].drop(columns="municipality")
+        pd.testing.assert_frame_equal(municipality_parameters.reset_index(drop=True), expected_parameters, check_exact=False, rtol=1e-12)
+
+def test_constant_features_are_not_scaled(features):
+    all_features = municipality_features(200)
+    # The single area of the last municipality has all its features, as the scale of a feature without values is NaN
+    all_features.iloc[-1, 2:] = all_features.iloc[-1, 2:].fillna(1.0)
+    _, parameters = features.normalize_features(all_features)
+    constant = parameters.loc[(parameters["municipality"] == "Espoo") & (parameters["feature"] == "Median income")]
+    assert constant["scale"].tolist() == [1.0]
+    assert (parameters.loc[parameters["municipality"] == "Sipoo", "scale"] == 1.0).all()
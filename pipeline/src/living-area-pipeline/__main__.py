@@ -0,0 +1,144 @@
+from storage_backends import create_backends
+from types import ModuleType
+import importlib.util
+import instrumentation
+import dataclasses
+import argparse
+import manifest
+import columnar
+import logging
+import tomllib
+import sys
+import os
+
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s",
+    datefmt="%Y-%m-%d %H:%M:%S"
+)
+
+ROOT_DIRECTORY = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", ".."))
+STAGE_DIRECTORIES = {
+    "extraction": os.path.join(ROOT_DIRECTORY, "data-extraction", "src", "statfin-data-extractor"),
+    "features": os.path.join(ROOT_DIRECTORY, "feature-engineering", "src", "living-area-features"),
+    "mappings": os.path.join(ROOT_DIRECTORY, "predictive-inferences", "src", "living-area-mappings")
+}
+# Modules copied to several packages, which must be identical in all of them as only one copy is imported
+SHARED_MODULES = ["storage_backends", "instrumentation", "manifest", "columnar", "app_outputs"]
+
+def load_config():
+    """Load configuration details related to the storage of the pipeline.
+    """
+    with open(os.path.join(os.path.dirname(__file__), "config.toml"), mode="rb") as file:
+        config = tomllib.load(file)
+    return config
+
+def parse_arguments() -> argparse.Namespace:
+    """Parse the command line arguments.
+    """
+    parser = argparse.ArgumentParser(description="Run the data extraction, the features and the mappings in a single process.")
+    parser.add_argument("--offline", action="store_true", help="Replay all API responses from the response cache without network access.")
+    return parser.parse_args()
+
+def check_shared_modules(directories: list[str]):
+    """Check that every shared module is identical in all the given package directories that have a copy of it,
+    failing if any of the copies differs.
+    """
+    for module in SHARED_MODULES:
+        copies = {}
+        for directory in directories:
+            path = os.path.join(directory, f"{module}.py")
+            if os.path.exists(path):
+                with open(path, mode="rb") as file:
+                    copies[path] = file.read()
+        if len(set(copies.values())) > 1:
+            raise ValueError(f"The copies of the shared module {module} differ: {', '.join(copies)}")
+
+def load_stage(name: str) -> ModuleType:
+    """Import the main module of a stage package under the name of the stage. The directory of the stage is added to
+    the module search path for its own modules. The modules shared by the stages, e.g., manifest and columnar, are
+    checked to be identical in every package, so it does not matter which copy is imported.
+    """
+    directory = STAGE_DIRECTORIES[name]
+    if directory not in sys.path:
+        sys.path.append(directory)
+    spec = importlib.util.spec_from_file_location(f"{name}_stage", os.path.join(directory, "__main__.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def load_stage_config(stage: ModuleType, config: dict) -> dict:
+    """Load the configuration of a stage with the storage section replaced by the one of the pipeline.
+    """
+    return stage.load_config() | {"storage": config["storage"]}
+
+def main():
+    arguments = parse_arguments()
+    config = load_config()
+    instrumentation.configure(config["instrumentation"]["metrics_file"], "pipeline")
+    with instrumentation.span("pipeline"):
+        check_shared_modules([os.path.dirname(os.path.abspath(__file__)), *STAGE_DIRECTORIES.values()])
+        extraction, features, mappings = [load_stage(name) for name in STAGE_DIRECTORIES]
+        extraction_config, features_config, mappings_config = [load_stage_config(stage, config) for stage in [extraction, features, mappings]]
+        features_output_settings = features.app_outputs.settings_from_config(features_config["app_data"])
+        mappings_output_settings = mappings.app_outputs.settings_from_config(mappings_config["app_data"])
+        storage_format = config["storage"]["format"]
+        persist_intermediate = config["pipeline"]["persist_intermediate"]
+
+        logging.info("Creating the storage backends")
+        backends = create_backends(config, {"raw_data": config["cloud"]["bucket_name_raw_data"], "features": config["cloud"]["bucket_name_features"],
+                                            "app_data": config["cloud"]["bucket_name_app_data"]})
+
+        logging.info("Extracting the raw data")
+        years = extraction.extraction_years()
+        history_enabled = extraction_config["history"]["enabled"]
+        # Without the persisted raw data there is no previous postal code info panel, so the whole history is extracted
+        previous_history = extraction.load_previous_history(backends["raw_data"], storage_format) if persist_intermediate and history_enabled else None
+        raw_data = extraction.extract_raw_data(extraction_config, years, arguments.offline, previous_history)
+        if persist_intermediate:
+            parameters = {"municipalities": extraction_config["extraction"]["municipalities"], "years": list(years.values())}
+            if history_enabled:
+                parameters["history_years"] = extraction.history_years(extraction_config, years)
+            extraction.store_raw_data(backends["raw_data"], raw_data, storage_format, parameters, config["storage"]["max_workers"])
+            raw_data_inputs = manifest.blob_hashes(backends["raw_data"], [columnar.artifact_name(name, storage_format) for name in features.raw_data_names(extraction_config)])
+
+        logging.info("Computing the features")
+        postal_code_info, municipality_features, normalization_parameters = features.compute_features(raw_data)
+        previous_manifest = manifest.load_manifest(backends["features"], "features_manifest.json") if persist_intermediate else None
+        outputs = features.store_features(backends["features"] if persist_intermediate else None, backends["app_data"], postal_code_info,
+                                          municipality_features, normalization_parameters, storage_format,
+                                          {} if previous_manifest is None else previous_manifest["outputs"], config["storage"]["max_workers"],
+                                          features_output_settings)
+        if persist_intermediate:
+            manifest.save_manifest(backends["features"], "features_manifest.json", raw_data_inputs, outputs,
+                                   features.manifest_parameters(features_output_settings))
+
+        logging.info("Computing the mappings")
+        municipalities = mappings_config["mappings"]["municipalities"]
+        if municipalities == "all":
+            municipalities = sorted(municipality_features)
+        k = mappings_config["mappings"]["k"]
+        metric = mappings.distance_metrics.metric_from_config(mappings_config["mappings"])
+        all_features = [municipality_features[municipality] for municipality in municipalities]
+        previous_manifest = manifest.load_manifest(backends["app_data"], "mappings_manifest.json")
+        outputs = mappings.store_mappings(backends["app_data"], all_features, municipalities, municipalities, k, mappings_config["mappings"]["memory_limit_mb"],
+                                          metric, mappings_config["mappings"]["workers"], mappings_output_settings,
+                                          {} if previous_manifest is None else previous_manifest["outputs"])
+        index_names = mappings.store_similarity_index(backends["app_data"], mappings_config["index"]["directory"], all_features,
+                                                      municipalities, normalization_parameters, config["storage"]["max_workers"], metric)
+
+        # Without the persisted features the manifest has no inputs, so the next separate run of the mappings recomputes everything
+        features_inputs = {}
+        if persist_intermediate:
+            features_names = [columnar.artifact_name(f"{municipality}_features", storage_format, kind="features") for municipality in municipalities]
+            features_inputs = manifest.blob_hashes(backends["features"], features_names + ["normalization_parameters.csv"])
+        outputs |= manifest.blob_hashes(backends["app_data"], index_names)
+        manifest.save_manifest(backends["app_data"], "mappings_manifest.json", features_inputs, outputs,
+                              {"municipalities": municipalities, "k": k, "metric": mappings.distance_metrics.metric_parameters(metric),
+                               "app_data": dataclasses.asdict(mappings_output_settings)})
+
+
+if __name__ == "__main__":
+    with instrumentation.profiled("pipeline"):
+        main()
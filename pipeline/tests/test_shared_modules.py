@@ -0,0 +1,24 @@
+import pytest
+import shutil
+import os
+
+
+def test_shared_modules_are_identical_in_all_packages(pipeline):
+    directories = [os.path.dirname(pipeline.__file__), *pipeline.STAGE_DIRECTORIES.values()]
+    for module in pipeline.SHARED_MODULES:
+        copies = [directory for directory in directories if os.path.exists(os.path.join(directory, f"{module}.py"))]
+        assert len(copies) >= 2, f"{module} is not shared by the packages"
+    pipeline.check_shared_modules(directories)
+
+def test_differing_copies_fail_the_check(pipeline, tmp_path):
+    directories = []
+    for name in ["first", "second"]:
+        directory = tmp_path / name
+        directory.mkdir()
+        shutil.copy(os.path.join(os.path.dirname(pipeline.__file__), "manifest.py"), directory)
+        directories.append(str(directory))
+    pipeline.check_shared_modules(directories)
+    with open(os.path.join(directories[1], "manifest.py"), mode="a") as file:
+        file.write("\n# changed\n")
+    with pytest.raises(ValueError, match="manifest"):
+        pipeline.check_shared_modules(directories)
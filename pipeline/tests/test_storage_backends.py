@@ -0,0 +1,59 @@
+from collections.abc import Iterator
+import storage_backends
+import pytest
+
+
+class OldClientWriter:
+    """Writer of a resumable upload recording the calls to it, of the clients older than the terminate method.
+    """
+    def __init__(self):
+        self.chunks = []
+        self.closed = False
+
+    def write(self, chunk: bytes):
+        self.chunks.append(chunk)
+
+    def close(self):
+        self.closed = True
+
+class FakeWriter(OldClientWriter):
+    """Writer of a resumable upload recording the calls to it.
+    """
+    def __init__(self):
+        super().__init__()
+        self.terminated = False
+
+    def terminate(self):
+        self.terminated = True
+
+class FakeBucket:
+    """Bucket handing out the given writer for every upload.
+    """
+    def __init__(self, writer):
+        self.writer = writer
+
+    def blob(self, name: str, chunk_size: int | None = None):
+        return self
+
+    def open(self, mode: str, **kwargs):
+        return self.writer
+
+def failing_chunks() -> Iterator[bytes]:
+    yield b"first"
+    raise ValueError("chunk failed")
+
+def test_failing_chunks_cancel_the_upload():
+    writer = FakeWriter()
+    with pytest.raises(ValueError, match="chunk failed"):
+        storage_backends.GCSBackend(FakeBucket(writer)).write_chunks("table.parquet", failing_chunks())
+    assert writer.chunks == [b"first"] and writer.terminated and not writer.closed
+
+def test_original_error_is_raised_when_the_upload_cannot_be_cancelled():
+    class FailingTerminateWriter(FakeWriter):
+        def terminate(self):
+            raise RuntimeError("terminate failed")
+
+    for writer in [OldClientWriter(), FailingTerminateWriter()]:
+        with pytest.raises(ValueError, match="chunk failed"):
+            storage_backends.GCSBackend(FakeBucket(writer)).write_chunks("table.parquet", failing_chunks())
+        assert not writer.closed
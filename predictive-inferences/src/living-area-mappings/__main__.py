@@ -1,8 +1,20 @@
-from google.cloud import storage
+from storage_backends import StorageBackend, create_backends
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 import numpy as np
+import nearest_neighbours
+import distance_metrics
+import similarity_index
+import instrumentation
+import app_outputs
+import manifest
+import columnar
+import dataclasses
+import itertools
 import logging
 import tomllib
+import io
 import os
 
 
@@ -12,6 +24,8 @@ logging.basicConfig(
     datefmt="%Y-%m-%d %H:%M:%S"
 )
 
+MAPPINGS_NAME = "living_area_mappings"
+
 def load_config():
     """Load configuration details related to GCP.
     """
@@ -25,67 +39,293 @@ def preprocess_data(df: pd.DataFrame) -> pd.DataFrame:
     df["Postal code"] = df["Postal code"].astype(str).str.pad(width=5, side='left', fillchar="0")
     return df
 
-def compute_mappings(all_features: list[pd.DataFrame]) -> pd.DataFrame:
+def select_targets(all_features: list[pd.DataFrame], municipalities: list[str],
+                   target_municipalities: list[str] | None) -> tuple[list[str], np.ndarray, np.ndarray, np.ndarray]:
+    """Build the feature index of the target municipalities, which are all the municipalities unless given.
+    """
+    if target_municipalities is None:
+        target_municipalities = municipalities
+    target_features = [all_features[municipalities.index(municipality)] for municipality in target_municipalities]
+    return target_municipalities, *nearest_neighbours.build_feature_index(target_features)
+
+def metric_spaces(metric: distance_metrics.DistanceMetric, all_features: list[pd.DataFrame], feature_matrix: np.ndarray,
+                  target_matrix: np.ndarray, target_offsets: np.ndarray, k: int, memory_limit_mb: float) -> tuple[np.ndarray, np.ndarray]:
+    """Map the features of all the areas and of the target areas to the space of the distance metric. With float32,
+    the neighbours of a sample of the areas are first compared to the ones computed with float64, and float64 is kept
+    when they agree less than the minimum agreement of the metric.
+    """
+    source_space, target_space = distance_metrics.metric_spaces(metric, all_features[0].columns[2:].to_list(), feature_matrix, target_matrix)
+    if metric.dtype == "float64":
+        return source_space, target_space
+    agreement, error = nearest_neighbours.neighbour_agreement(source_space, target_space, target_offsets, k, memory_limit_mb,
+                                                              metric.name, metric.accuracy_check_rows)
+    logging.info(f"The {metric.dtype} neighbours agree with the float64 ones for {agreement:.2%} of the sample, relative distance error {error:.2g}")
+    instrumentation.count("neighbour_agreement", agreement, dtype=metric.dtype, relative_error=error)
+    if agreement < metric.min_agreement:
+        logging.warning(f"The agreement is below the minimum of {metric.min_agreement:.2%}, computing the distances with float64")
+        return source_space, target_space
+    dtype = distance_metrics.DTYPES[metric.dtype]
+    return source_space.astype(dtype), target_space.astype(dtype)
+
+def source_rows(municipalities: list[str], offsets: np.ndarray, source_municipalities: list[str],
+                target_municipalities: list[str]) -> tuple[np.ndarray, np.ndarray]:
+    """Rows of the feature matrix of the areas in the source municipalities, and for every row the index of its own
+    municipality among the target municipalities, or -1 when its municipality is not a target.
+    """
+    indices = [municipalities.index(municipality) for municipality in source_municipalities]
+    rows = np.concatenate([np.arange(offsets[i], offsets[i + 1]) for i in indices] + [np.empty(0, dtype=np.intp)])
+    own_targets = np.array([target_municipalities.index(municipality) if municipality in target_municipalities else -1
+                            for municipality in source_municipalities], dtype=np.intp)
+    return rows, np.repeat(own_targets, np.diff(offsets)[indices])
+
+def compute_mappings(all_features: list[pd.DataFrame], municipalities: list[str], memory_limit_mb: float = 256,
+                     source_municipalities: list[str] | None = None, target_municipalities: list[str] | None = None,
+                     metric: distance_metrics.DistanceMetric | None = None, pool: nearest_neighbours.WorkerPool | None = None) -> Iterator[pd.DataFrame]:
     """Computes for each living area the similarity measures to other areas and selects as the closest area
-    for the municipality the area with the smallest distance.
+    for the municipality the area with the smallest distance. The features of all municipalities are concatenated
+    into one matrix only once and the distances are computed for blocks of source areas at a time, the size of a
+    block being limited by the given memory limit. The mappings are yielded one block of source areas at a time.
+    The mappings can be limited to the areas of the given source municipalities and to the closest areas in the
+    given target municipalities. The distance is the given metric, the euclidean distance by default. With a pool of
+    worker processes, the blocks of source areas are computed in parallel by the workers of the pool.
     """
     logging.info("Computing the closest living areas in each municipality for every living area.")
-    result = {}
-    columns = ["Helsinki", "Espoo", "Vantaa", "Turku", "Tampere", "Oulu"]
-
-    for i in range(6):
-        logging.info(f"Computing the living area mappings for areas in {columns[i]}")
-        source_feature_df = all_features[i]
-        source_amount = len(source_feature_df.index)
-        for idx in range(source_amount):
-            source_postal_code = source_feature_df.iloc[idx, 0]
-            result[source_postal_code] = [None] * 6
-            source_features = source_feature_df.iloc[idx,2:].to_numpy(dtype=float)
-            for j in range(6):
-                if j != i:
-                    target_feature_df = all_features[j]
-                    target_features = target_feature_df.iloc[:,2:].to_numpy(dtype=float)
-                    distances = np.sqrt(((target_features - source_features)**2).sum(axis=1))
-                    target_postal_code = target_feature_df.iloc[np.argmin(distances), 0]
-                    result[source_postal_code][j] = target_postal_code
-
-    inference_df = pd.DataFrame.from_dict(result, orient="index", columns=columns)
-    return inference_df
+    metric = metric or distance_metrics.DistanceMetric()
+    feature_matrix, postal_codes, offsets = nearest_neighbours.build_feature_index(all_features)
+    target_municipalities, target_matrix, target_postal_codes, target_offsets = select_targets(all_features, municipalities, target_municipalities)
+    feature_matrix, target_matrix = metric_spaces(metric, all_features, feature_matrix, target_matrix, target_offsets, 1, memory_limit_mb)
+    target_postal_codes = np.append(target_postal_codes, None)
+    rows, own_targets = source_rows(municipalities, offsets, source_municipalities or municipalities, target_municipalities)
+
+    logging.info(f"Computing the living area mappings for areas in {len(source_municipalities or municipalities)} municipalities")
+    for start, indices, _ in nearest_neighbours.parallel_top_k_neighbours(feature_matrix[rows], target_matrix, target_offsets, 1,
+                                                                          memory_limit_mb, metric.name, pool):
+        block_rows = slice(start, start + len(indices))
+        closest_postal_codes = target_postal_codes[indices[:, :, 0]]
+        # The areas are not mapped to their own municipality
+        own = np.flatnonzero(own_targets[block_rows] >= 0)
+        closest_postal_codes[own, own_targets[block_rows][own]] = None
+        yield pd.DataFrame(closest_postal_codes, columns=target_municipalities, index=postal_codes[rows[block_rows]], dtype=object)
+
+def compute_top_k_mappings(all_features: list[pd.DataFrame], municipalities: list[str], k: int,
+                           memory_limit_mb: float = 256, source_municipalities: list[str] | None = None,
+                           target_municipalities: list[str] | None = None,
+                           metric: distance_metrics.DistanceMetric | None = None, pool: nearest_neighbours.WorkerPool | None = None) -> Iterator[pd.DataFrame]:
+    """Computes for each living area the k closest areas and their distances in every other municipality. The
+    mappings are yielded in long format, one row per source area, target municipality and rank, for one block of
+    source areas at a time so that the whole result never needs to be held in memory. The mappings can be limited,
+    the distance measured and the blocks computed in parallel in the same way as in compute_mappings.
+    """
+    logging.info(f"Computing the {k} closest living areas in each municipality for every living area.")
+    metric = metric or distance_metrics.DistanceMetric()
+    feature_matrix, postal_codes, offsets = nearest_neighbours.build_feature_index(all_features)
+    target_municipalities, target_matrix, target_postal_codes, target_offsets = select_targets(all_features, municipalities, target_municipalities)
+    feature_matrix, target_matrix = metric_spaces(metric, all_features, feature_matrix, target_matrix, target_offsets, k, memory_limit_mb)
+    target_municipality_names = np.asarray(target_municipalities, dtype=object)
+    rows, own_targets = source_rows(municipalities, offsets, source_municipalities or municipalities, target_municipalities)
+
+    logging.info(f"Computing the living area mappings for areas in {len(source_municipalities or municipalities)} municipalities")
+    for start, indices, distances in nearest_neighbours.parallel_top_k_neighbours(feature_matrix[rows], target_matrix, target_offsets, k,
+                                                                                  memory_limit_mb, metric.name, pool):
+        block_rows, target_rows, ranks = np.indices(indices.shape).reshape(3, -1)
+        keep = (target_rows != own_targets[start + block_rows]) & (indices.ravel() >= 0)
+        yield pd.DataFrame({
+            "Postal code": postal_codes[rows[start + block_rows[keep]]],
+            "Municipality": target_municipality_names[target_rows[keep]],
+            "Rank": ranks[keep] + 1,
+            "Similar postal code": target_postal_codes[indices.ravel()[keep]],
+            "Distance": distances.ravel()[keep]
+        })
+
+@instrumentation.timed
+def update_mappings(previous_mappings: pd.DataFrame, all_features: list[pd.DataFrame], municipalities: list[str],
+                    changed_municipalities: list[str], k: int, memory_limit_mb: float = 256,
+                    metric: distance_metrics.DistanceMetric | None = None, pool: nearest_neighbours.WorkerPool | None = None) -> pd.DataFrame:
+    """Update the previous mappings after the features of some municipalities have changed. The mappings of the areas
+    in the changed municipalities are recomputed completely, and for the areas in the other municipalities only the
+    closest areas in the changed municipalities are recomputed and merged into the previous mappings.
+    """
+    logging.info(f"Updating the living area mappings for the changed municipalities: {', '.join(changed_municipalities)}")
+    unchanged_municipalities = [municipality for municipality in municipalities if municipality not in changed_municipalities]
+    postal_codes = np.concatenate([features.iloc[:, 0].to_numpy(dtype=object) for features in all_features])
+    if k == 1:
+        mappings = previous_mappings.reindex(index=postal_codes, columns=municipalities).astype(object)
+        updates = compute_mappings(all_features, municipalities, memory_limit_mb, source_municipalities=changed_municipalities,
+                                   metric=metric, pool=pool)
+        if unchanged_municipalities:
+            updates = itertools.chain(updates, compute_mappings(all_features, municipalities, memory_limit_mb, unchanged_municipalities,
+                                                                changed_municipalities, metric, pool))
+        for update in updates:
+            mappings.loc[update.index, update.columns] = update
+        return mappings
+
+    changed_areas = set(postal_codes[np.isin(np.repeat(municipalities, [len(features.index) for features in all_features]), changed_municipalities)])
+    kept = previous_mappings.loc[~previous_mappings["Postal code"].isin(changed_areas) & ~previous_mappings["Municipality"].isin(changed_municipalities)]
+    updates = list(compute_top_k_mappings(all_features, municipalities, k, memory_limit_mb, source_municipalities=changed_municipalities,
+                                          metric=metric, pool=pool))
+    if unchanged_municipalities:
+        updates.extend(compute_top_k_mappings(all_features, municipalities, k, memory_limit_mb, unchanged_municipalities, changed_municipalities,
+                                              metric, pool))
+    mappings = pd.concat([kept, *updates], ignore_index=True)
+    source_order = pd.Series(np.arange(len(postal_codes)), index=postal_codes)
+    target_order = pd.Series(np.arange(len(municipalities)), index=municipalities)
+    mappings = mappings.assign(source_order=mappings["Postal code"].map(source_order), target_order=mappings["Municipality"].map(target_order))
+    mappings = mappings.loc[mappings["source_order"].notna()].sort_values(["source_order", "target_order", "Rank"])
+    return mappings.drop(columns=["source_order", "target_order"]).reset_index(drop=True)
+
+def list_municipalities(backend: StorageBackend, storage_format: str) -> list[str]:
+    """List the municipalities which have a features file in the features storage.
+    """
+    suffix = columnar.artifact_name("_features", storage_format, kind="features")
+    return sorted(name[:-len(suffix)] for name in backend.list_names() if name.endswith(suffix))
+
+@instrumentation.timed
+def load_features(backend: StorageBackend, features_names: dict[str, str], storage_format: str, max_workers: int = 8) -> list[pd.DataFrame]:
+    """Read the features of the given municipalities from the storage, downloading and parsing them concurrently.
+    Columnar features stored on the local filesystem are memory-mapped.
+    """
+    def read(name: str) -> pd.DataFrame:
+        if storage_format == "columnar":
+            return columnar.read_features(backend.local_path(name) or backend.read(name))
+        return preprocess_data(pd.read_csv(io.BytesIO(backend.read(name)), sep=";"))
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(read, features_names.values()))
+
+@instrumentation.timed
+def load_normalization_parameters(backend: StorageBackend) -> pd.DataFrame | None:
+    """Read the normalization parameters of the features from the storage, or None if they have not been stored.
+    """
+    if not backend.exists("normalization_parameters.csv"):
+        return None
+    return pd.read_csv(io.BytesIO(backend.read("normalization_parameters.csv")), sep=";")
+
+@instrumentation.timed
+def store_mappings(app_data_backend: StorageBackend, all_features: list[pd.DataFrame], municipalities: list[str],
+                   changed_municipalities: list[str], k: int, memory_limit_mb: float, metric: distance_metrics.DistanceMetric | None = None,
+                   workers: int = 1, output_settings: app_outputs.OutputSettings | None = None,
+                   previous_outputs: dict[str, str] | None = None) -> dict[str, str]:
+    """Compute the mappings for the changed municipalities and stream them to the app data storage as csv, written as
+    set in the output settings and partitioned by the municipality of the source areas if set. When only some of the
+    municipalities have changed, the previous mappings are read from the previous outputs and updated, otherwise the
+    mappings are computed from scratch and streamed one block of source areas at a time. Previous outputs no longer
+    written, e.g., partitions of municipalities no longer mapped, are deleted. Returns the content hashes of the outputs.
+    """
+    output_settings = output_settings or app_outputs.OutputSettings()
+    previous_names = sorted(name for name in previous_outputs or {} if app_outputs.is_output_name(name, MAPPINGS_NAME))
+    if not changed_municipalities:
+        logging.info("Only the normalization parameters have changed, keeping the previous mappings")
+        return {name: previous_outputs[name] for name in previous_names}
+    postal_codes = np.concatenate([features.iloc[:, 0].to_numpy(dtype=object) for features in all_features])
+    area_municipalities = pd.Series(np.repeat(np.asarray(municipalities, dtype=object), [len(features.index) for features in all_features]),
+                                    index=postal_codes)
+    if len(changed_municipalities) < len(municipalities):
+        previous_mappings = []
+        for name in previous_names:
+            previous_mappings_file = io.BytesIO(app_outputs.read_output(app_data_backend, name))
+            if k == 1:
+                previous_mappings.append(pd.read_csv(previous_mappings_file, sep=",", dtype=str).set_index("Postal code"))
+            else:
+                previous_mappings.append(pd.read_csv(previous_mappings_file, sep=",", dtype={"Postal code": str, "Similar postal code": str},
+                                                     float_precision="round_trip"))
+
+    def source_municipalities(chunk: pd.DataFrame) -> np.ndarray:
+        return area_municipalities.reindex(chunk.index if k == 1 else chunk["Postal code"]).to_numpy()
+
+    # The worker processes are started once and used for all the mappings computed in the run, unless there are too
+    # few areas for computing any of them in parallel
+    with nearest_neighbours.worker_pool(workers if len(postal_codes) >= nearest_neighbours.PARALLEL_MIN_ROWS else 1) as pool:
+        if len(changed_municipalities) < len(municipalities):
+            area_mappings = update_mappings(pd.concat(previous_mappings), all_features, municipalities, changed_municipalities, k,
+                                            memory_limit_mb, metric, pool)
+            chunks = app_outputs.row_chunks(area_mappings, output_settings.chunk_rows)
+        elif k == 1:
+            chunks = compute_mappings(all_features, municipalities, memory_limit_mb, metric=metric, pool=pool)
+        else:
+            chunks = compute_top_k_mappings(all_features, municipalities, k, memory_limit_mb, metric=metric, pool=pool)
+
+        logging.info("Streaming the mappings as csv to the app data storage")
+        outputs = app_outputs.write_output(app_data_backend, MAPPINGS_NAME, chunks, "csv", output_settings, source_municipalities,
+                                           sep=",", index=k == 1, index_label="Postal code", quoting=1)
+    for name in set(previous_names) - outputs.keys():
+        if app_data_backend.exists(name):
+            logging.info(f"Deleting an output of the mappings no longer written: {name}")
+            app_data_backend.delete(name)
+    return outputs
+
+@instrumentation.timed
+def store_similarity_index(app_data_backend: StorageBackend, directory: str, all_features: list[pd.DataFrame],
+                           municipalities: list[str], normalization_parameters: pd.DataFrame | None, max_workers: int = 8,
+                           metric: distance_metrics.DistanceMetric | None = None) -> list[str]:
+    """Write the similarity index to the local directory and upload it to the app data storage with the directory as
+    the prefix of the names. The features are mapped to the space of the given metric, the euclidean distance by
+    default, so that the index measures the similarity in the same way as the mappings. The files are uploaded
+    concurrently. Returns the names of the uploaded index files.
+    """
+    logging.info("Writing the similarity index and uploading it to the app data storage")
+    metric = metric or distance_metrics.DistanceMetric()
+    feature_names = all_features[0].columns[2:].to_list()
+    feature_matrix, postal_codes, offsets = nearest_neighbours.build_feature_index(all_features)
+    feature_space, = distance_metrics.metric_spaces(metric, feature_names, feature_matrix)
+    index_files = similarity_index.write_similarity_index(directory, feature_space, postal_codes, offsets,
+                                                          municipalities, feature_names, normalization_parameters, metric)
+    def upload(index_file: str):
+        app_data_backend.write_file(f"{directory}/{os.path.basename(index_file)}", index_file)
+
+    # The metadata file is uploaded after the other files, so that it is the last to change also in the storage
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for future in [executor.submit(upload, index_file) for index_file in index_files[:-1]]:
+            future.result()
+    upload(index_files[-1])
+    return [f"{directory}/{filename}" for filename in similarity_index.INDEX_FILES]
 
 def main():
     config = load_config()
-    logging.info("Creating client for authenticating to GCP")
-    storage_client = storage.Client(project=config["cloud"]["project_id"])
-    features_bucket = storage_client.bucket(config["cloud"]["bucket_name_features"])
-
-    logging.info("Downloading the csv-files from the GCP cloud storage bucket")
-    municipalities = ["Helsinki", "Espoo", "Vantaa", "Turku", "Tampere", "Oulu"]
-    for municipality in municipalities:
-        filename = f"{municipality}_features.csv"
-        features_blob = features_bucket.blob(filename)
-        features_blob.download_to_filename(filename)
-
-    logging.info("Reading the downloaded csv-files to Pandas dataframes")
-    helsinki_features = pd.read_csv("Helsinki_features.csv", sep=";")
-    helsinki_features = preprocess_data(helsinki_features)
-    espoo_features = pd.read_csv("Espoo_features.csv", sep=";")
-    espoo_features = preprocess_data(espoo_features)
-    vantaa_features = pd.read_csv("Vantaa_features.csv", sep=";")
-    vantaa_features = preprocess_data(vantaa_features)
-    turku_features = pd.read_csv("Turku_features.csv", sep=";")
-    turku_features = preprocess_data(turku_features)
-    tampere_features = pd.read_csv("Tampere_features.csv", sep=";")
-    tampere_features = preprocess_data(tampere_features)
-    oulu_features = pd.read_csv("Oulu_features.csv", sep=";")
-    oulu_features = preprocess_data(oulu_features)
-    all_features = [helsinki_features, espoo_features, vantaa_features, turku_features, tampere_features, oulu_features]
-    area_mappings = compute_mappings(all_features)
-
-    app_data_bucket = storage_client.bucket(config["cloud"]["bucket_name_app_data"])
-    logging.info("Uploading the mappings as csv-file to GCP cloud storage bucket")
-    area_mappings_blob = app_data_bucket.blob("living_area_mappings.csv")
-    area_mappings_blob.upload_from_string(area_mappings.to_csv(sep=",", index=True, index_label="Postal code", quoting=1))
+    instrumentation.configure(config["instrumentation"]["metrics_file"], "mappings")
+    with instrumentation.span("mappings"):
+        logging.info("Creating the storage backends")
+        backends = create_backends(config, {"features": config["cloud"]["bucket_name_features"], "app_data": config["cloud"]["bucket_name_app_data"]})
+        storage_format = config["storage"]["format"]
+        municipalities = config["mappings"]["municipalities"]
+        if municipalities == "all":
+            municipalities = list_municipalities(backends["features"], storage_format)
+        k = config["mappings"]["k"]
+        metric = distance_metrics.metric_from_config(config["mappings"])
+        output_settings = app_outputs.settings_from_config(config["app_data"])
+
+        logging.info("Comparing the features to the manifest of the previous run")
+        features_names = {municipality: columnar.artifact_name(f"{municipality}_features", storage_format, kind="features") for municipality in municipalities}
+        inputs = manifest.blob_hashes(backends["features"], list(features_names.values()) + ["normalization_parameters.csv"])
+        parameters = {"municipalities": municipalities, "k": k, "metric": distance_metrics.metric_parameters(metric),
+                      "app_data": dataclasses.asdict(output_settings)}
+        previous_manifest = manifest.load_manifest(backends["app_data"], "mappings_manifest.json")
+        previous_outputs = {} if previous_manifest is None else previous_manifest["outputs"]
+        previous_names = [name for name in previous_outputs if app_outputs.is_output_name(name, MAPPINGS_NAME)]
+        if (previous_manifest is None or previous_manifest["parameters"] != parameters or not previous_names
+                or not all(backends["app_data"].exists(name) for name in previous_names)):
+            changed_municipalities = municipalities
+        elif previous_manifest["inputs"] == inputs:
+            logging.info("The features have not changed since the previous run, skipping the mappings")
+            return
+        elif metric.name == "mahalanobis":
+            # The whitening is fitted on the features of all the municipalities, so a change in any of them changes every distance
+            changed_municipalities = municipalities
+        else:
+            changed_municipalities = [municipality for municipality in municipalities
+                                      if previous_manifest["inputs"].get(features_names[municipality]) != inputs[features_names[municipality]]]
+
+        logging.info("Reading the features from the storage to Pandas dataframes")
+        all_features = load_features(backends["features"], features_names, storage_format, config["storage"]["max_workers"])
+        outputs = store_mappings(backends["app_data"], all_features, municipalities, changed_municipalities, k, config["mappings"]["memory_limit_mb"],
+                                 metric, config["mappings"]["workers"], output_settings, previous_outputs)
+        index_names = store_similarity_index(backends["app_data"], config["index"]["directory"], all_features, municipalities,
+                                             load_normalization_parameters(backends["features"]), config["storage"]["max_workers"],
+                                             metric)
 
+        logging.info("Saving the manifest of the mappings")
+        outputs |= manifest.blob_hashes(backends["app_data"], index_names)
+        manifest.save_manifest(backends["app_data"], "mappings_manifest.json", inputs, outputs, parameters)
 
 if __name__ == "__main__":
-    main()
+    with instrumentation.profiled("mappings"):
+        main()
@@ -0,0 +1,110 @@
+from dataclasses import dataclass, field
+import numpy as np
+
+
+METRICS = ["euclidean", "cosine", "mahalanobis"]
+DTYPES = {"float64": np.float64, "float32": np.float32}
+# Directions of the features with a variance below this share of the largest variance are dropped from the whitening
+EIGENVALUE_TOLERANCE = 1e-10
+
+@dataclass
+class DistanceMetric:
+    """Declarative definition of the distance between the features of the living areas. Every metric is computed as
+    the euclidean distance between the features mapped to the space of the metric: the features are multiplied by the
+    square roots of their weights, features without a weight having the weight one, and then for "cosine" scaled to
+    unit length and for "mahalanobis" whitened with the covariance of the weighted features of all the areas. The
+    cosine distance is one minus the cosine similarity. The distances are computed in the precision of the dtype,
+    "float64" or "float32". With float32, the neighbours of a sample of the given amount of areas are first compared
+    to the ones computed with float64, and float64 is used instead when less than the minimum share of them agree.
+    """
+    name: str = "euclidean"
+    weights: dict[str, float] = field(default_factory=dict)
+    dtype: str = "float64"
+    accuracy_check_rows: int = 1000
+    min_agreement: float = 0.99
+
+def metric_from_config(config: dict) -> DistanceMetric:
+    """Create the distance metric from the mappings section of the config, failing on unknown metrics and dtypes.
+    """
+    metric = DistanceMetric(config.get("metric", "euclidean"), dict(config.get("weights", {})), config.get("dtype", "float64"),
+                            config.get("accuracy_check_rows", 1000), config.get("min_agreement", 0.99))
+    if metric.name not in METRICS:
+        raise ValueError(f"Unknown distance metric: {metric.name}, expected one of {', '.join(METRICS)}")
+    if metric.dtype not in DTYPES:
+        raise ValueError(f"Unknown dtype of the distances: {metric.dtype}, expected one of {', '.join(DTYPES)}")
+    return metric
+
+def metric_parameters(metric: DistanceMetric) -> dict:
+    """Parameters of the metric that change the mappings, for the manifest of the mappings.
+    """
+    return {"name": metric.name, "weights": metric.weights, "dtype": metric.dtype}
+
+def feature_weights(metric: DistanceMetric, feature_names: list[str]) -> np.ndarray:
+    """Weights of the features in the order of the feature names.
+    """
+    unknown_features = [name for name in metric.weights if name not in feature_names]
+    if unknown_features:
+        raise ValueError(f"Weights given for unknown features: {', '.join(unknown_features)}")
+    weights = np.array([metric.weights.get(name, 1.0) for name in feature_names], dtype=float)
+    if (weights < 0).any():
+        raise ValueError("The weights of the features must not be negative")
+    return weights
+
+def whitening_transform(feature_matrix: np.ndarray) -> np.ndarray:
+    """Matrix W for which the euclidean distance between xW and yW is the Mahalanobis distance between x and y with the
+    covariance of the rows of the feature matrix. The covariance is inverted through its eigendecomposition, and
+    directions without variance, e.g., of features that are constant or linear combinations of the others, are dropped
+    instead of being scaled by an infinite factor. Rows with missing features are left out of the covariance, so that
+    they don't make the whole transform NaN.
+    """
+    covariance = np.atleast_2d(np.cov(feature_matrix[np.isfinite(feature_matrix).all(axis=1)], rowvar=False))
+    eigenvalues, eigenvectors = np.linalg.eigh(covariance)
+    keep = eigenvalues > EIGENVALUE_TOLERANCE * max(eigenvalues.max(), 0)
+    return eigenvectors[:, keep] / np.sqrt(eigenvalues[keep])
+
+def metric_spaces(metric: DistanceMetric, feature_names: list[str], feature_matrix: np.ndarray,
+                  *matrices: np.ndarray) -> list[np.ndarray]:
+    """Map the feature matrix of all the areas and the other given feature matrices to the space of the metric, in
+    which the euclidean distance is the distance of the metric. The whitening of the Mahalanobis distance is fitted on
+    the feature matrix of all the areas that have all their features. The mapped matrices are C-contiguous float64 matrices.
+    """
+    scales = np.sqrt(feature_weights(metric, feature_names))
+    whitening = whitening_transform(feature_matrix * scales) if metric.name == "mahalanobis" else None
+    spaces = []
+    for matrix in (feature_matrix, *matrices):
+        points = matrix * scales
+        if whitening is not None:
+            points = points @ whitening
+        points = np.ascontiguousarray(points, dtype=float)
+        if metric.name == "cosine":
+            norms = np.linalg.norm(points, axis=1, keepdims=True)
+            points /= np.where(norms > 0, norms, 1)
+        spaces.append(points)
+    return spaces
+
+def augmented_rows(source: np.ndarray, target: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Augment the rows for computing the squared euclidean distances between the source and the target rows with one
+    matrix product by the identity |a - b|² = |a|² + |b|² - 2ab. The source rows a are augmented to [a, 1] and the
+    target rows b to [-2b, |b|²], so that their product is the squared distance minus |a|², which does not change the
+    order of the distances from a source row and can be added to the selected distances only. An extra target row
+    [0, inf] is appended for padding, its product with every source row being infinite. Returns the augmented source
+    and target rows and the squared norms of the source rows.
+    """
+    augmented_source = np.empty((source.shape[0], source.shape[1] + 1), dtype=source.dtype)
+    augmented_source[:, :-1] = source
+    augmented_source[:, -1] = 1
+    augmented_target = np.zeros((target.shape[0] + 1, target.shape[1] + 1), dtype=target.dtype)
+    augmented_target[:-1, :-1] = -2 * target
+    augmented_target[:-1, -1] = np.einsum("ij,ij->i", target, target)
+    augmented_target[-1, -1] = np.inf
+    return augmented_source, augmented_target, np.einsum("ij,ij->i", source, source)
+
+def distances(metric_name: str, squared_distances: np.ndarray) -> np.ndarray:
+    """Convert the squared euclidean distances in the space of the metric to the distances of the metric. Negative
+    squared distances caused by the rounding of nearly identical rows are zeros. For unit vectors the squared
+    euclidean distance is two times the cosine distance.
+    """
+    squared_distances = np.maximum(squared_distances, 0)
+    if metric_name == "cosine":
+        return squared_distances / 2
+    return np.sqrt(squared_distances)
@@ -0,0 +1,169 @@
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+import pandas as pd
+import collections
+import functools
+import threading
+import datetime
+import resource
+import cProfile
+import logging
+import pstats
+import json
+import time
+import sys
+import io
+import os
+
+
+# Selects the profiler of the run: "cprofile" for the deterministic profiler or "sampling" for the sampling profiler
+PROFILER_VARIABLE = "LIVING_AREA_PROFILER"
+SAMPLING_INTERVAL_SECONDS = 0.005
+
+_lock = threading.Lock()
+_metrics = {"file": None, "stage": None}
+
+def configure(metrics_file: str | None, stage: str):
+    """Start recording the metrics of the stage to the given JSON lines file, appending to the metrics of previous
+    runs. Without a metrics file, e.g., when the functions of the stage are imported by the benchmarks, the metrics
+    are not recorded.
+    """
+    with _lock:
+        if _metrics["file"] is not None:
+            _metrics["file"].close()
+        _metrics["file"] = open(metrics_file, mode="a", encoding="utf-8") if metrics_file else None
+        _metrics["stage"] = stage
+
+def enabled() -> bool:
+    """Check whether the metrics are recorded.
+    """
+    return _metrics["file"] is not None
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of the process in megabytes.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024**2 if sys.platform == "darwin" else peak / 1024
+
+def record(kind: str, name: str, **fields):
+    """Write a metric as one JSON line with the time, the stage and the thread it was recorded in.
+    """
+    if not enabled():
+        return
+    metric = {"time": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="milliseconds"), "stage": _metrics["stage"],
+              "kind": kind, "name": name, "thread": threading.current_thread().name, **fields}
+    line = json.dumps(metric, ensure_ascii=False, default=str)
+    with _lock:
+        if _metrics["file"] is not None:
+            _metrics["file"].write(line + "\n")
+            _metrics["file"].flush()
+
+def count(name: str, value: int | float, **fields):
+    """Record a count, e.g., the amount of filled missing values of a feature.
+    """
+    record("count", name, value=value, **fields)
+
+@contextmanager
+def span(name: str, **fields) -> Iterator[dict]:
+    """Time the block and record it as a span with the given fields. The block can add fields, e.g., the amount of
+    rows or bytes, to the yielded dictionary. The span also records the peak memory of the process at its end and how
+    much the block raised it, and the type of the exception if the block failed.
+    """
+    if not enabled():
+        yield fields
+        return
+    start_peak_rss = peak_rss_mb()
+    start = time.perf_counter()
+    try:
+        yield fields
+    except BaseException as error:
+        fields["error"] = type(error).__name__
+        raise
+    finally:
+        duration = time.perf_counter() - start
+        end_peak_rss = peak_rss_mb()
+        record("span", name, duration_s=duration, peak_rss_mb=end_peak_rss, peak_rss_increase_mb=end_peak_rss - start_peak_rss, **fields)
+
+def timed(function: Callable) -> Callable:
+    """Decorate the function to record its calls as spans named after it. The rows of a dataframe given as the first
+    argument and of a returned dataframe are recorded as the rows in and out.
+    """
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if not enabled():
+            return function(*args, **kwargs)
+        fields = {"rows_in": len(args[0].index)} if args and isinstance(args[0], pd.DataFrame) else {}
+        with span(function.__name__, **fields) as span_fields:
+            result = function(*args, **kwargs)
+            if isinstance(result, pd.DataFrame):
+                span_fields["rows_out"] = len(result.index)
+            return result
+    return wrapper
+
+class SamplingProfiler:
+    """Profiler sampling the call stacks of all the other threads at a fixed interval in a background thread. The
+    samples are written in the collapsed stack format of flame graph tools, one stack and its amount of samples per line.
+    """
+    def __init__(self, interval_seconds: float = SAMPLING_INTERVAL_SECONDS):
+        self.interval_seconds = interval_seconds
+        self.samples = collections.Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.sample, name="sampling-profiler", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def sample(self):
+        """Sample the stacks until the profiler is stopped.
+        """
+        while not self.stopped.wait(self.interval_seconds):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == self.thread.ident:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_firstlineno})")
+                    frame = frame.f_back
+                self.samples[";".join(reversed(stack))] += 1
+
+    def write(self, path: str):
+        with open(path, mode="w", encoding="utf-8") as file:
+            for stack, samples in self.samples.most_common():
+                file.write(f"{stack} {samples}\n")
+
+@contextmanager
+def profiled(stage: str) -> Iterator[None]:
+    """Profile the block with the profiler selected by the environment variable LIVING_AREA_PROFILER, if any. The cProfile
+    statistics are written to profile_<stage>.prof and the samples of the sampling profiler to profile_<stage>.txt in
+    the working directory.
+    """
+    profiler_name = os.environ.get(PROFILER_VARIABLE, "")
+    if profiler_name == "cprofile":
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.dump_stats(f"profile_{stage}.prof")
+            logging.info(f"Wrote the cProfile statistics to profile_{stage}.prof")
+            statistics = io.StringIO()
+            pstats.Stats(profiler, stream=statistics).sort_stats("cumulative").print_stats(20)
+            logging.info(f"Functions with the highest cumulative time:\n{statistics.getvalue()}")
+    elif profiler_name == "sampling":
+        profiler = SamplingProfiler()
+        profiler.start()
+        try:
+            yield
+        finally:
+            profiler.stop()
+            profiler.write(f"profile_{stage}.txt")
+            logging.info(f"Wrote {profiler.samples.total()} stack samples to profile_{stage}.txt")
+    elif profiler_name:
+        raise ValueError(f"Unknown profiler in {PROFILER_VARIABLE}: {profiler_name}")
+    else:
+        yield
@@ -0,0 +1,36 @@
+from storage_backends import StorageBackend, content_hash
+import instrumentation
+import json
+
+
+def blob_hashes(backend: StorageBackend, blob_names: list[str]) -> dict[str, str | None]:
+    """Read the content hashes of the given blobs from their metadata without downloading them. Missing blobs
+    have the hash None.
+    """
+    return {blob_name: backend.content_hash(blob_name) for blob_name in blob_names}
+
+def load_manifest(backend: StorageBackend, manifest_name: str) -> dict | None:
+    """Load the manifest of the previous run of the stage, or None if the stage has not been run before.
+    """
+    if not backend.exists(manifest_name):
+        return None
+    return json.loads(backend.read(manifest_name))
+
+def save_manifest(backend: StorageBackend, manifest_name: str, inputs: dict[str, str | None], outputs: dict[str, str],
+                  parameters: dict | None = None):
+    """Save the manifest with the content hashes of the inputs and the outputs of the stage and the parameters
+    the outputs were computed with.
+    """
+    manifest = {"inputs": inputs, "outputs": outputs, "parameters": parameters or {}}
+    backend.write(manifest_name, json.dumps(manifest, ensure_ascii=False, indent=2), content_type="application/json")
+
+def upload_if_changed(backend: StorageBackend, blob_name: str, data: str | bytes, previous_outputs: dict[str, str]) -> str:
+    """Upload the data to the blob unless the previous run already uploaded the same content. Skipping unchanged
+    outputs keeps their hashes, and thus the inputs of the next stage, unchanged. Returns the content hash.
+    """
+    data_hash = content_hash(data.encode("utf-8") if isinstance(data, str) else data)
+    if previous_outputs.get(blob_name) != data_hash:
+        backend.write(blob_name, data)
+    else:
+        instrumentation.count("unchanged_outputs", 1, blob=blob_name)
+    return data_hash
@@ -0,0 +1,239 @@
+from concurrent.futures import ProcessPoolExecutor
+from collections.abc import Iterator
+from contextlib import contextmanager
+from dataclasses import dataclass
+import multiprocessing
+import itertools
+import numpy as np
+import pandas as pd
+import distance_metrics
+import instrumentation
+import collections
+import tempfile
+import time
+import os
+
+
+# Amount of shards of the source rows per worker process, more shards balancing the load better between the workers
+SHARDS_PER_WORKER = 4
+# Below this many source rows the rows are processed in the current process, as sending the shards to the workers and
+# their results back takes longer than the computation
+PARALLEL_MIN_ROWS = 2048
+# The matrix products are padded to multiples of this many rows and columns, so that every product is computed with
+# the kernels of whole panels and its rounding does not depend on the position of the areas in the blocks
+PANEL_SIZE = 64
+
+_shared_arrays = {}
+
+
+@instrumentation.timed
+def build_feature_index(all_features: list[pd.DataFrame]) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Concatenate the feature matrices of all municipalities into one matrix. The first two columns of the feature
+    dataframes are the postal code and the municipality, the rest are the normalized features. The feature columns are
+    copied straight into the preallocated matrix, so the features are copied once even when the dataframes are views of
+    memory-mapped files. Returns the matrix, the postal codes of the rows and the offset table, where the rows of the
+    municipality i are between offsets[i] and offsets[i + 1].
+    """
+    offsets = np.zeros(len(all_features) + 1, dtype=np.intp)
+    offsets[1:] = np.cumsum([len(features) for features in all_features])
+    feature_matrix = np.empty((offsets[-1], all_features[0].shape[1] - 2))
+    for features, start, stop in zip(all_features, offsets[:-1], offsets[1:]):
+        for column_index, column in enumerate(features.columns[2:]):
+            feature_matrix[start:stop, column_index] = features[column].to_numpy(dtype=float)
+    postal_codes = np.concatenate([features.iloc[:, 0].to_numpy(dtype=object) for features in all_features])
+    return feature_matrix, postal_codes, offsets
+
+def compute_block_size(bytes_per_row: int, memory_limit_mb: float) -> int:
+    """Compute how many source rows can be processed at once without the temporary arrays of a block exceeding
+    the given memory limit. At least one row is always processed per block.
+    """
+    return max(int(memory_limit_mb * 1024 * 1024) // max(bytes_per_row, 1), 1)
+
+def group_layout(offsets: np.ndarray, k: int) -> list[tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    """Group the municipalities of the offset table by their size rounded up to the next power of two, so that the
+    rows of the municipalities of one group can be laid out as a padded matrix without wasting much memory on small
+    municipalities. Returns for each group the municipality indices, the padded row indices and the validity mask.
+    """
+    counts = np.diff(offsets)
+    widths = 2**np.ceil(np.log2(np.maximum(counts, k))).astype(int)
+    layout = []
+    for width in np.unique(widths):
+        municipality_indices = np.flatnonzero(widths == width)
+        positions = np.arange(width)
+        valid = positions[np.newaxis, :] < counts[municipality_indices, np.newaxis]
+        padded = np.where(valid, offsets[municipality_indices, np.newaxis] + positions[np.newaxis, :], 0)
+        layout.append((municipality_indices, padded, valid))
+    return layout
+
+def top_k_neighbours(source: np.ndarray, target: np.ndarray, offsets: np.ndarray, k: int, memory_limit_mb: float,
+                     metric_name: str = "euclidean") -> Iterator[tuple[int, np.ndarray, np.ndarray]]:
+    """Find for every source row the k target rows with the smallest distance in each of the municipalities of the
+    offset table. The rows are in the space of the metric, where the distance is computed from the squared euclidean
+    distance, in the precision of the rows. The target rows are laid out once in the padded order of the municipality
+    groups, the padding being rows at an infinite distance, so that the distances of a block of source rows come out
+    of one matrix product already grouped by the municipalities. The source rows are processed in blocks so that the
+    buffers of a block stay under the memory limit, rounded up to whole panels, and the buffers are allocated once and
+    reused for every block. The result of every block is yielded as the start row of the block and the arrays of the
+    target row indices and distances with the shape (block rows, municipalities, k), ordered by the distance.
+    Municipalities with less than k areas are padded with the index -1 and an infinite distance. Rows with missing
+    features have no distance to any row: target rows with them are never selected and source rows with them only
+    get the padding. The computation of every block is recorded as a span.
+    """
+    municipality_amount = len(offsets) - 1
+    layout = group_layout(offsets, k)
+    group_bounds = np.cumsum([0] + [padded.size for _, padded, _ in layout])
+    augmented_source, augmented_target, source_norms = distance_metrics.augmented_rows(source, target)
+    padded_rows = np.concatenate([np.where(valid, padded, target.shape[0]).ravel() for _, padded, valid in layout])
+    padded_rows = np.append(padded_rows, np.full(-len(padded_rows) % PANEL_SIZE, target.shape[0]))
+    padded_target = augmented_target[padded_rows]
+    index_itemsize = np.dtype(np.intp).itemsize
+    bytes_per_row = len(padded_rows) * target.itemsize + group_bounds[-1] * index_itemsize + municipality_amount * k * (target.itemsize + index_itemsize)
+    block_size = min(compute_block_size(bytes_per_row, memory_limit_mb), max(source.shape[0], 1))
+    block_size += -block_size % PANEL_SIZE
+    # The rows of the block buffer after the rows of a shorter last block are the earlier rows or [0, 1], which keep the
+    # products with the padding of the targets finite or infinite
+    block_buffer = np.zeros((block_size, augmented_source.shape[1]), dtype=target.dtype)
+    block_buffer[:, -1] = 1
+    products_buffer = np.empty((block_size, len(padded_rows)), dtype=target.dtype)
+    for start in range(0, source.shape[0], block_size):
+        block = augmented_source[start:start + block_size]
+        with instrumentation.span("mapping_block", rows_in=block.shape[0], targets=target.shape[0], k=k):
+            block_buffer[:block.shape[0]] = block
+            products = np.matmul(block_buffer, padded_target.T, out=products_buffer)[:block.shape[0]]
+            # Rows with missing features, e.g., of areas without an apartment price, are at an infinite distance so
+            # that they are never selected, as argmin and argpartition would treat NaNs differently
+            np.copyto(products, np.inf, where=np.isnan(products))
+            block_norms = source_norms[start:start + block_size, np.newaxis, np.newaxis]
+            distances = np.full((block.shape[0], municipality_amount, k), np.inf, dtype=target.dtype)
+            indices = np.full((block.shape[0], municipality_amount, k), -1, dtype=np.intp)
+            for (municipality_indices, padded, _), group_start, group_stop in zip(layout, group_bounds[:-1], group_bounds[1:]):
+                grouped = products[:, group_start:group_stop].reshape(block.shape[0], *padded.shape)
+                if k == 1:
+                    selected = np.argmin(grouped, axis=2)[:, :, np.newaxis]
+                else:
+                    selected = np.argpartition(grouped, k - 1, axis=2)[:, :, :k]
+                    order = np.argsort(np.take_along_axis(grouped, selected, axis=2), axis=2, kind="stable")
+                    selected = np.take_along_axis(selected, order, axis=2)
+                distances[:, municipality_indices] = distance_metrics.distances(metric_name, np.take_along_axis(grouped, selected, axis=2) + block_norms)
+                indices[:, municipality_indices] = padded[np.arange(len(municipality_indices))[np.newaxis, :, np.newaxis], selected]
+            distances[np.isnan(distances)] = np.inf
+            indices[np.isinf(distances)] = -1
+        yield start, indices, distances
+
+@dataclass
+class WorkerPool:
+    """Worker processes for finding the closest target rows in parallel, together with the temporary directory of the
+    arrays shared with them. The pool is created once with worker_pool and reused for all the searches of a run.
+    """
+    executor: ProcessPoolExecutor
+    directory: str
+    workers: int
+    searches: itertools.count
+
+@contextmanager
+def worker_pool(workers: int) -> Iterator[WorkerPool | None]:
+    """Start the given amount of worker processes for parallel_top_k_neighbours and stop them at the end of the block.
+    All the workers are started before the pool is yielded, so that the searches don't wait for them. With one worker
+    there are no worker processes and None is yielded, the rows being processed in the current process.
+    """
+    if workers <= 1:
+        yield None
+        return
+    # The workers are spawned instead of forked, so that they do not inherit the locks or open files of the threads
+    # of the parent process
+    with tempfile.TemporaryDirectory() as directory, \
+            ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        for future in [executor.submit(os.getpid) for _ in range(workers)]:
+            future.result()
+        yield WorkerPool(executor, directory, workers, itertools.count())
+
+def attach_shared_arrays(paths: dict[str, str]) -> dict[str, np.ndarray]:
+    """Memory-map the arrays shared by the parent process in a worker process. The arrays of the latest search are
+    kept mapped, so that they are mapped once per search and worker.
+    """
+    if _shared_arrays.get("paths") != paths:
+        _shared_arrays.clear()
+        _shared_arrays.update({name: np.load(path, mmap_mode="r") for name, path in paths.items()}, paths=paths)
+    return _shared_arrays
+
+def shard_top_k_neighbours(paths: dict[str, str], start: int, stop: int, k: int, memory_limit_mb: float,
+                           metric_name: str) -> tuple[int, np.ndarray, np.ndarray, float, int]:
+    """Find the k closest target rows of the shard of the shared source rows between the start and the stop row in a
+    worker process. Returns the start row, the target row indices and the distances of the whole shard, the duration
+    of the computation and the process id of the worker.
+    """
+    started = time.perf_counter()
+    arrays = attach_shared_arrays(paths)
+    blocks = list(top_k_neighbours(arrays["source"][start:stop], arrays["target"], arrays["offsets"], k, memory_limit_mb, metric_name))
+    indices = np.concatenate([indices for _, indices, _ in blocks])
+    distances = np.concatenate([distances for _, _, distances in blocks])
+    return start, indices, distances, time.perf_counter() - started, os.getpid()
+
+def parallel_top_k_neighbours(source: np.ndarray, target: np.ndarray, offsets: np.ndarray, k: int, memory_limit_mb: float,
+                              metric_name: str = "euclidean", pool: WorkerPool | None = None) -> Iterator[tuple[int, np.ndarray, np.ndarray]]:
+    """Find the k closest target rows in the same way as top_k_neighbours, but with the source rows split into shards
+    that are processed by the worker processes of the pool. The source and target rows and the offset table are
+    written once per search to files in the directory of the pool, which the workers memory-map, so that only the
+    row ranges of the shards and the resulting arrays are sent between the processes. The memory limit is divided
+    between the workers. The results of the shards are yielded in the order of the rows, so the result is the same as
+    with one process, and at most two shards per worker are waiting to be yielded at a time. The computation of every
+    shard is recorded as a span. Without a pool, or with less than PARALLEL_MIN_ROWS source rows, the rows are
+    processed in the current process.
+    """
+    if pool is None or source.shape[0] < PARALLEL_MIN_ROWS:
+        yield from top_k_neighbours(source, target, offsets, k, memory_limit_mb, metric_name)
+        return
+    shard_rows = -(-source.shape[0] // (pool.workers * SHARDS_PER_WORKER))
+    search = next(pool.searches)
+    paths = {name: os.path.join(pool.directory, f"{search}_{name}.npy") for name in ["source", "target", "offsets"]}
+    try:
+        for name, array in [("source", source), ("target", target), ("offsets", offsets)]:
+            np.save(paths[name], array)
+
+        def completed(future) -> tuple[int, np.ndarray, np.ndarray]:
+            shard_start, indices, distances, duration, process_id = future.result()
+            instrumentation.record("span", "mapping_shard", duration_s=duration, rows_in=len(indices), targets=target.shape[0],
+                                   k=k, process=process_id)
+            return shard_start, indices, distances
+
+        pending = collections.deque()
+        try:
+            for start in range(0, source.shape[0], shard_rows):
+                pending.append(pool.executor.submit(shard_top_k_neighbours, paths, start, start + shard_rows, k,
+                                                    memory_limit_mb / pool.workers, metric_name))
+                if len(pending) > 2 * pool.workers:
+                    yield completed(pending.popleft())
+            while pending:
+                yield completed(pending.popleft())
+        finally:
+            for future in pending:
+                future.cancel()
+    finally:
+        for path in paths.values():
+            if os.path.exists(path):
+                os.remove(path)
+
+@instrumentation.timed
+def neighbour_agreement(source: np.ndarray, target: np.ndarray, offsets: np.ndarray, k: int, memory_limit_mb: float,
+                        metric_name: str, sample_rows: int, seed: int = 0) -> tuple[float, float]:
+    """Check the accuracy of float32 distances against float64 ones by finding the neighbours of a random sample of
+    the source rows in both precisions. Returns the share of the neighbours that are the same in both and the largest
+    error of the float32 distances relative to the largest float64 distance of the sample. The neighbours differ only
+    when the squared distances of two target areas differ less than their float32 rounding, which is relative to the
+    squared lengths of the rows, so the agreement is usually complete. The largest error is of the distances close to
+    zero, where the square root amplifies the rounding, and is around 1e-4 of the largest distance with the normalized
+    features.
+    """
+    rng = np.random.default_rng(seed)
+    rows = np.sort(rng.choice(source.shape[0], size=min(sample_rows, source.shape[0]), replace=False))
+    results = []
+    for dtype in (np.float64, np.float32):
+        sample, targets = source[rows].astype(dtype), target.astype(dtype)
+        blocks = list(top_k_neighbours(sample, targets, offsets, k, memory_limit_mb, metric_name))
+        results.append((np.concatenate([indices for _, indices, _ in blocks]), np.concatenate([distances for _, _, distances in blocks])))
+    (indices64, distances64), (indices32, distances32) = results
+    finite = np.isfinite(distances64)
+    agreement = float((indices64 == indices32)[finite].mean()) if finite.any() else 1.0
+    scale = distances64[finite].max() if finite.any() else 0.0
+    error = float(np.abs(distances32[finite] - distances64[finite]).max() / scale) if scale > 0 else 0.0
+    return agreement, error
@@ -0,0 +1,140 @@
+from aiohttp import web
+from functools import lru_cache
+import similarity_index
+import asyncio
+import logging
+import tomllib
+import os
+
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s",
+    datefmt="%Y-%m-%d %H:%M:%S"
+)
+
+def load_config():
+    """Load configuration details related to the similarity index and the service.
+    """
+    with open(os.path.join(os.path.dirname(__file__), "config.toml"), mode="rb") as file:
+        config = tomllib.load(file)
+    return config
+
+def create_query_function(index: similarity_index.SimilarityIndex, cache_size: int):
+    """Create a function answering similar area queries from the given index, with an LRU cache of the recent answers.
+    The cache belongs to the index, so that a reloaded index never serves answers of the previous one.
+    """
+    @lru_cache(maxsize=cache_size)
+    def query(postal_code: str, k: int, municipalities: tuple[str, ...] | None) -> list[dict]:
+        similar_areas = similarity_index.query_similar_areas(index, postal_code, k, None if municipalities is None else list(municipalities))
+        return [{"postal_code": similar_postal_code, "municipality": municipality, "distance": distance}
+                for similar_postal_code, municipality, distance in similar_areas]
+    return query
+
+def index_version(directory: str) -> float:
+    """Version of the similarity index in the given directory. The metadata file is written last, so its
+    modification time changes only after all the other files of a new index are in place.
+    """
+    return os.stat(os.path.join(directory, "metadata.json")).st_mtime
+
+def answer_query(request: web.Request, postal_code: str | None, k: str | int | None, municipalities: list[str] | None) -> dict:
+    """Answer a single query with the currently loaded index. Raises a HTTP error for invalid queries.
+    """
+    index, query = request.app["state"]["index"]
+    if postal_code is None or postal_code not in index.rows:
+        raise web.HTTPNotFound(text=f"Unknown postal code: {postal_code}")
+    try:
+        k = int(k if k is not None else request.app["config"]["service"]["default_k"])
+    except (TypeError, ValueError):
+        raise web.HTTPBadRequest(text=f"Invalid k: {k}")
+    if k < 1:
+        raise web.HTTPBadRequest(text=f"Invalid k: {k}")
+    if municipalities is not None:
+        unknown = [municipality for municipality in municipalities if municipality not in index.municipality_rows]
+        if unknown:
+            raise web.HTTPBadRequest(text=f"Unknown municipalities: {', '.join(unknown)}")
+        municipalities = tuple(municipalities)
+    return {"postal_code": postal_code, "similar": query(postal_code, k, municipalities)}
+
+async def get_similar(request: web.Request) -> web.Response:
+    """Answer a query given as the query parameters postal_code, k and a comma-separated list of municipalities.
+    """
+    municipalities = request.query.get("municipalities")
+    if municipalities is not None:
+        municipalities = [municipality.strip() for municipality in municipalities.split(",") if municipality.strip()]
+    return web.json_response(answer_query(request, request.query.get("postal_code"), request.query.get("k"), municipalities))
+
+def query_fields(query: dict) -> tuple[str | None, int | None, list[str] | None]:
+    """Take the postal code, k and the municipalities of a query object of a batch. Raises a HTTP error if any of
+    them has the wrong type, e.g., a list as the postal code.
+    """
+    postal_code, k, municipalities = query.get("postal_code"), query.get("k"), query.get("municipalities")
+    if postal_code is not None and not isinstance(postal_code, str):
+        raise web.HTTPBadRequest(text=f"Invalid postal code: {postal_code}")
+    if k is not None and (not isinstance(k, int) or isinstance(k, bool)):
+        raise web.HTTPBadRequest(text=f"Invalid k: {k}")
+    if municipalities is not None and (not isinstance(municipalities, list)
+                                       or not all(isinstance(municipality, str) for municipality in municipalities)):
+        raise web.HTTPBadRequest(text=f"Invalid municipalities: {municipalities}")
+    return postal_code, k, municipalities
+
+async def post_similar(request: web.Request) -> web.Response:
+    """Answer a batch of queries given as a JSON list of objects with the keys postal_code, k and municipalities.
+    """
+    try:
+        queries = await request.json()
+    except ValueError:
+        raise web.HTTPBadRequest(text="Request body is not valid JSON")
+    if not isinstance(queries, list) or not all(isinstance(query, dict) for query in queries):
+        raise web.HTTPBadRequest(text="Request body must be a list of query objects")
+    return web.json_response([answer_query(request, *query_fields(query)) for query in queries])
+
+async def reload_index(app: web.Application):
+    """Poll the index directory and swap in a new index when a new one has been written. Requests in flight keep
+    using the index they started with, as the index and its query function are replaced with a single assignment.
+    """
+    directory = app["config"]["index"]["directory"]
+    service_config = app["config"]["service"]
+    while True:
+        await asyncio.sleep(service_config["reload_interval_seconds"])
+        try:
+            version = index_version(directory)
+            if version == app["state"]["index_version"]:
+                continue
+            logging.info(f"Reloading the similarity index from {directory}")
+            index = await asyncio.to_thread(similarity_index.load_similarity_index, directory)
+        except Exception as error:
+            logging.warning(f"Reloading the similarity index failed: {error}")
+            continue
+        app["state"]["index"] = (index, create_query_function(index, service_config["cache_size"]))
+        app["state"]["index_version"] = version
+
+async def start_reloading(app: web.Application):
+    """Start the background task for reloading the index and cancel it when the service shuts down.
+    """
+    reload_task = asyncio.create_task(reload_index(app))
+    yield
+    reload_task.cancel()
+
+def create_app(config: dict) -> web.Application:
+    """Create the service application with the similarity index loaded from the local filesystem.
+    """
+    directory = config["index"]["directory"]
+    logging.info(f"Loading the similarity index from {directory}")
+    app = web.Application()
+    app["config"] = config
+    version = index_version(directory)
+    index = similarity_index.load_similarity_index(directory)
+    app["state"] = {"index": (index, create_query_function(index, config["service"]["cache_size"])), "index_version": version}
+    app.router.add_get("/similar", get_similar)
+    app.router.add_post("/similar", post_similar)
+    app.cleanup_ctx.append(start_reloading)
+    return app
+
+def main():
+    config = load_config()
+    web.run_app(create_app(config), host=config["service"]["host"], port=config["service"]["port"])
+
+
+if __name__ == "__main__":
+    main()
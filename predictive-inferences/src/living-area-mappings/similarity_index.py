@@ -0,0 +1,122 @@
+from dataclasses import dataclass
+from scipy.spatial import cKDTree
+import numpy as np
+import pandas as pd
+import distance_metrics
+import logging
+import json
+import os
+
+
+INDEX_FILES = ["features.npy", "postal_codes.npy", "offsets.npy", "metadata.json"]
+
+@dataclass
+class SimilarityIndex:
+    """Feature matrix of the living areas in the space of the distance metric together with a KD-tree over it and the
+    lookup tables from postal codes to rows and from municipalities to row ranges. The euclidean distances between the
+    rows are converted to the distances of the metric.
+    """
+    features: np.ndarray
+    postal_codes: np.ndarray
+    offsets: np.ndarray
+    municipalities: list[str]
+    feature_names: list[str]
+    normalization_parameters: pd.DataFrame | None
+    metric: distance_metrics.DistanceMetric
+    tree: cKDTree
+    rows: dict[str, int]
+    municipality_rows: dict[str, slice]
+
+def replace_file(path: str, write) -> None:
+    """Write a file through a temporary file and move it in place, so that readers which have the previous version
+    of the file memory-mapped keep reading the previous version instead of a truncated file.
+    """
+    with open(f"{path}.tmp", mode="wb") as file:
+        write(file)
+    os.replace(f"{path}.tmp", path)
+
+def write_similarity_index(directory: str, feature_matrix: np.ndarray, postal_codes: np.ndarray, offsets: np.ndarray,
+                           municipalities: list[str], feature_names: list[str],
+                           normalization_parameters: pd.DataFrame | None = None,
+                           metric: distance_metrics.DistanceMetric | None = None) -> list[str]:
+    """Write the similarity index of the living areas to the given directory. The feature matrix is in the space of
+    the given metric, the euclidean distance by default. The feature matrix and the lookup tables are saved as numpy
+    files, which can be memory-mapped when loading the index, and the names, the normalization parameters and the
+    parameters of the metric are saved as json. The metadata file is replaced last, so its modification time tells
+    when a complete new index is in place. Areas with missing features are left out of the index, as they have no
+    distance to the other areas and are not mapped either. Returns the paths of the written files.
+    """
+    metric = metric or distance_metrics.DistanceMetric()
+    finite = np.isfinite(feature_matrix).all(axis=1)
+    if not finite.all():
+        logging.warning(f"Leaving {int((~finite).sum())} areas with missing features out of the similarity index")
+        offsets = np.concatenate([[0], np.cumsum(finite)])[offsets]
+        feature_matrix, postal_codes = feature_matrix[finite], postal_codes[finite]
+    os.makedirs(directory, exist_ok=True)
+    replace_file(os.path.join(directory, "features.npy"), lambda file: np.save(file, np.ascontiguousarray(feature_matrix, dtype=float)))
+    replace_file(os.path.join(directory, "postal_codes.npy"), lambda file: np.save(file, postal_codes.astype("U5")))
+    replace_file(os.path.join(directory, "offsets.npy"), lambda file: np.save(file, offsets))
+    metadata = {
+        "municipalities": municipalities,
+        "feature_names": feature_names,
+        "normalization_parameters": None if normalization_parameters is None else normalization_parameters.to_dict(orient="records"),
+        "metric": distance_metrics.metric_parameters(metric)
+    }
+    replace_file(os.path.join(directory, "metadata.json"), lambda file: file.write(json.dumps(metadata, ensure_ascii=False).encode("utf-8")))
+    return [os.path.join(directory, filename) for filename in INDEX_FILES]
+
+def load_similarity_index(directory: str) -> SimilarityIndex:
+    """Load the similarity index from the given directory. The feature matrix and the lookup tables are
+    memory-mapped instead of being read into memory. The KD-tree is built over the memory-mapped feature matrix when
+    loading, as a stored tree would hold a copy of the whole matrix, and the tree refers to the matrix without copying it.
+    """
+    features = np.load(os.path.join(directory, "features.npy"), mmap_mode="r")
+    postal_codes = np.load(os.path.join(directory, "postal_codes.npy"), mmap_mode="r")
+    offsets = np.load(os.path.join(directory, "offsets.npy"), mmap_mode="r")
+    with open(os.path.join(directory, "metadata.json"), mode="r", encoding="utf-8") as file:
+        metadata = json.load(file)
+    normalization_parameters = metadata["normalization_parameters"]
+    # Indices written without the parameters of the metric have the standardized features with the euclidean distance
+    metric = metadata.get("metric", distance_metrics.metric_parameters(distance_metrics.DistanceMetric()))
+    return SimilarityIndex(
+        features=features,
+        postal_codes=postal_codes,
+        offsets=offsets,
+        municipalities=metadata["municipalities"],
+        feature_names=metadata["feature_names"],
+        normalization_parameters=None if normalization_parameters is None else pd.DataFrame(normalization_parameters),
+        metric=distance_metrics.DistanceMetric(metric["name"], metric["weights"], metric["dtype"]),
+        tree=cKDTree(features),
+        rows={str(postal_code): row for row, postal_code in enumerate(postal_codes)},
+        municipality_rows={municipality: slice(int(offsets[i]), int(offsets[i + 1])) for i, municipality in enumerate(metadata["municipalities"])}
+    )
+
+def query_similar_areas(index: SimilarityIndex, postal_code: str, k: int,
+                        municipalities: list[str] | None = None) -> list[tuple[str, str, float]]:
+    """Find the k living areas most similar to the area of the given postal code, optionally only from the given
+    municipalities. The area itself is never included in the result. Returns the postal code, the municipality
+    and the distance of every similar area in the metric of the index, ordered by the distance.
+    """
+    row = index.rows[postal_code]
+    source = index.features[row]
+    if municipalities is None:
+        distances, rows = index.tree.query(source, k=min(k + 1, len(index.postal_codes)))
+        distances = distance_metrics.distances(index.metric.name, np.atleast_1d(distances)**2)
+        similar = [(distance, int(target_row)) for distance, target_row in zip(distances, np.atleast_1d(rows)) if target_row != row]
+        similar = similar[:k]
+    else:
+        target_rows = np.concatenate([np.arange(index.municipality_rows[municipality].start, index.municipality_rows[municipality].stop) for municipality in municipalities])
+        target_rows = target_rows[target_rows != row]
+        distances = distance_metrics.distances(index.metric.name, ((index.features[target_rows] - source)**2).sum(axis=1))
+        if k < len(target_rows):
+            selected = np.argpartition(distances, k - 1)[:k]
+        else:
+            selected = np.arange(len(target_rows))
+        selected = selected[np.argsort(distances[selected], kind="stable")]
+        similar = [(distances[i], int(target_rows[i])) for i in selected]
+    return [(str(index.postal_codes[target_row]), municipality_of_row(index, target_row), float(distance)) for distance, target_row in similar]
+
+def municipality_of_row(index: SimilarityIndex, row: int) -> str:
+    """Find the municipality of the given row of the feature matrix from the offset table.
+    """
+    return index.municipalities[int(np.searchsorted(index.offsets, row, side="right")) - 1]
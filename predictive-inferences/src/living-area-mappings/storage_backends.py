@@ -0,0 +1,266 @@
+from collections.abc import Iterable, Iterator
+from abc import ABC, abstractmethod
+from google.cloud import storage
+import instrumentation
+import hashlib
+import logging
+import base64
+import shutil
+import os
+
+
+# Size of the chunks of the resumable uploads to GCP cloud storage, which must be a multiple of 256 KB
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+
+def content_hash(data: bytes) -> str:
+    """Compute the hash of the content in the same format as the md5 hash of a GCP cloud storage blob.
+    """
+    return base64.b64encode(hashlib.md5(data).digest()).decode("ascii")
+
+class StorageBackend(ABC):
+    """Storage of the named data objects of a stage, e.g., the blobs of a GCP cloud storage bucket. Objects are
+    written as strings or bytes, or streamed in chunks, and identified by their content hashes.
+    """
+    @abstractmethod
+    def content_hash(self, name: str) -> str | None:
+        """Content hash of the object, or None if the object does not exist.
+        """
+
+    def exists(self, name: str) -> bool:
+        """Check whether the object exists.
+        """
+        return self.content_hash(name) is not None
+
+    @abstractmethod
+    def read(self, name: str) -> bytes:
+        """Read the content of the object.
+        """
+
+    def local_path(self, name: str) -> str | None:
+        """Path of the object on the local filesystem if the backend stores it there, so that the object can be
+        memory-mapped instead of read. Other backends return None.
+        """
+        return None
+
+    @abstractmethod
+    def write(self, name: str, data: str | bytes, content_type: str | None = None):
+        """Write the data to the object, replacing any previous content.
+        """
+
+    def write_file(self, name: str, path: str):
+        """Write the content of a local file to the object.
+        """
+        with open(path, mode="rb") as file:
+            self.write(name, file.read())
+
+    def write_chunks(self, name: str, chunks: Iterable[bytes], content_type: str | None = None) -> str:
+        """Write the chunks of data to the object as they are produced, replacing any previous content once all the
+        chunks have been written. Backends that can stream the chunks don't hold the whole content in memory. Returns
+        the content hash of the written content.
+        """
+        data = b"".join(chunks)
+        self.write(name, data, content_type)
+        return content_hash(data)
+
+    @abstractmethod
+    def delete(self, name: str):
+        """Delete the object.
+        """
+
+    @abstractmethod
+    def list_names(self) -> list[str]:
+        """List the names of all the objects.
+        """
+
+class GCSBackend(StorageBackend):
+    """Storage in a GCP cloud storage bucket.
+    """
+    def __init__(self, bucket: storage.Bucket):
+        self.bucket = bucket
+
+    def content_hash(self, name: str) -> str | None:
+        blob = self.bucket.get_blob(name)
+        return None if blob is None else blob.md5_hash
+
+    def read(self, name: str) -> bytes:
+        return self.bucket.blob(name).download_as_bytes()
+
+    def write(self, name: str, data: str | bytes, content_type: str | None = None):
+        self.bucket.blob(name).upload_from_string(data, content_type=content_type)
+
+    def write_file(self, name: str, path: str):
+        self.bucket.blob(name).upload_from_filename(path)
+
+    def write_chunks(self, name: str, chunks: Iterable[bytes], content_type: str | None = None) -> str:
+        # The chunks are sent in a resumable upload, which is cancelled if producing them fails. Cancelling is best
+        # effort so that the original error is raised: clients without the terminate method of the writer leave the
+        # unfinished upload to expire, and the object is not created either way.
+        digest = hashlib.md5()
+        writer = self.bucket.blob(name, chunk_size=UPLOAD_CHUNK_SIZE).open("wb", ignore_flush=True, content_type=content_type)
+        try:
+            for chunk in chunks:
+                digest.update(chunk)
+                writer.write(chunk)
+        except BaseException:
+            try:
+                if hasattr(writer, "terminate"):
+                    writer.terminate()
+            except Exception as error:
+                logging.warning(f"Cancelling the upload of {name} failed: {error}")
+            raise
+        writer.close()
+        return base64.b64encode(digest.digest()).decode("ascii")
+
+    def delete(self, name: str):
+        self.bucket.delete_blob(name)
+
+    def list_names(self) -> list[str]:
+        return [blob.name for blob in self.bucket.list_blobs()]
+
+class LocalBackend(StorageBackend):
+    """Storage in a directory of the local filesystem, the object names being paths relative to the directory.
+    """
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def local_path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def content_hash(self, name: str) -> str | None:
+        if not self.exists(name):
+            return None
+        return content_hash(self.read(name))
+
+    def exists(self, name: str) -> bool:
+        return os.path.isfile(self.local_path(name))
+
+    def read(self, name: str) -> bytes:
+        with open(self.local_path(name), mode="rb") as file:
+            return file.read()
+
+    def write(self, name: str, data: str | bytes, content_type: str | None = None):
+        path = self.local_path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(f"{path}.tmp", mode="wb") as file:
+            file.write(data.encode("utf-8") if isinstance(data, str) else data)
+        os.replace(f"{path}.tmp", path)
+
+    def write_file(self, name: str, path: str):
+        target_path = self.local_path(name)
+        os.makedirs(os.path.dirname(target_path), exist_ok=True)
+        shutil.copyfile(path, f"{target_path}.tmp")
+        os.replace(f"{target_path}.tmp", target_path)
+
+    def write_chunks(self, name: str, chunks: Iterable[bytes], content_type: str | None = None) -> str:
+        path = self.local_path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        digest = hashlib.md5()
+        try:
+            with open(f"{path}.tmp", mode="wb") as file:
+                for chunk in chunks:
+                    digest.update(chunk)
+                    file.write(chunk)
+        except BaseException:
+            os.remove(f"{path}.tmp")
+            raise
+        os.replace(f"{path}.tmp", path)
+        return base64.b64encode(digest.digest()).decode("ascii")
+
+    def delete(self, name: str):
+        os.remove(self.local_path(name))
+
+    def list_names(self) -> list[str]:
+        names = []
+        for root, _, filenames in os.walk(self.directory):
+            names.extend(os.path.relpath(os.path.join(root, filename), self.directory).replace(os.sep, "/")
+                         for filename in filenames if not filename.endswith(".tmp"))
+        return sorted(names)
+
+class MemoryBackend(StorageBackend):
+    """Storage in memory, for running the whole pipeline in one process without persisting the data.
+    """
+    def __init__(self):
+        self.objects = {}
+
+    def content_hash(self, name: str) -> str | None:
+        return None if name not in self.objects else content_hash(self.objects[name])
+
+    def exists(self, name: str) -> bool:
+        return name in self.objects
+
+    def read(self, name: str) -> bytes:
+        return self.objects[name]
+
+    def write(self, name: str, data: str | bytes, content_type: str | None = None):
+        self.objects[name] = data.encode("utf-8") if isinstance(data, str) else data
+
+    def delete(self, name: str):
+        del self.objects[name]
+
+    def list_names(self) -> list[str]:
+        return sorted(self.objects)
+
+class InstrumentedBackend(StorageBackend):
+    """Storage backend recording the transfers of another backend as spans with the amount of bytes transferred.
+    """
+    def __init__(self, backend: StorageBackend, role: str):
+        self.backend = backend
+        self.role = role
+
+    def content_hash(self, name: str) -> str | None:
+        return self.backend.content_hash(name)
+
+    def exists(self, name: str) -> bool:
+        return self.backend.exists(name)
+
+    def read(self, name: str) -> bytes:
+        with instrumentation.span("blob_read", role=self.role, blob=name) as fields:
+            data = self.backend.read(name)
+            fields["bytes"] = len(data)
+        return data
+
+    def local_path(self, name: str) -> str | None:
+        return self.backend.local_path(name)
+
+    def write(self, name: str, data: str | bytes, content_type: str | None = None):
+        data = data.encode("utf-8") if isinstance(data, str) else data
+        with instrumentation.span("blob_write", role=self.role, blob=name, bytes=len(data)):
+            self.backend.write(name, data, content_type)
+
+    def write_file(self, name: str, path: str):
+        with instrumentation.span("blob_write", role=self.role, blob=name, bytes=os.path.getsize(path)):
+            self.backend.write_file(name, path)
+
+    def write_chunks(self, name: str, chunks: Iterable[bytes], content_type: str | None = None) -> str:
+        with instrumentation.span("blob_write", role=self.role, blob=name, bytes=0, chunks=0) as fields:
+            def counted_chunks() -> Iterator[bytes]:
+                for chunk in chunks:
+                    fields["bytes"] += len(chunk)
+                    fields["chunks"] += 1
+                    yield chunk
+            return self.backend.write_chunks(name, counted_chunks(), content_type)
+
+    def delete(self, name: str):
+        self.backend.delete(name)
+
+    def list_names(self) -> list[str]:
+        return self.backend.list_names()
+
+def create_backends(config: dict, bucket_names: dict[str, str]) -> dict[str, StorageBackend]:
+    """Create the storage backends selected in the storage section of the configuration for the given roles, e.g.,
+    raw_data and features, and their GCP cloud storage bucket names. The local backend stores every role in its own
+    subdirectory, so the stages find the data of each other when run separately. The transfers of the backends are
+    recorded by the instrumentation.
+    """
+    backend = config["storage"]["backend"]
+    if backend == "gcs":
+        storage_client = storage.Client(project=config["cloud"]["project_id"])
+        backends = {role: GCSBackend(storage_client.bucket(bucket_name)) for role, bucket_name in bucket_names.items()}
+    elif backend == "local":
+        backends = {role: LocalBackend(os.path.join(config["storage"]["directory"], role)) for role in bucket_names}
+    elif backend == "memory":
+        backends = {role: MemoryBackend() for role in bucket_names}
+    else:
+        raise ValueError(f"Unknown storage backend: {backend}")
+    return {role: InstrumentedBackend(storage_backend, role) for role, storage_backend in backends.items()}
@@ -0,0 +1,19 @@
+from types import ModuleType
+import importlib.util
+import pytest
+import sys
+import os
+
+
+PACKAGE_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", "living-area-mappings")
+# The modules of the package are imported as top-level modules, as when the package is run
+sys.path.insert(0, PACKAGE_DIRECTORY)
+
+@pytest.fixture(scope="session")
+def mappings() -> ModuleType:
+    """Main module of the mappings package.
+    """
+    spec = importlib.util.spec_from_file_location("mappings_main", os.path.join(PACKAGE_DIRECTORY, "__main__.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
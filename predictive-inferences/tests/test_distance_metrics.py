@@ -0,0 +1,100 @@
+from scipy.spatial.distance import cdist
+import nearest_neighbours
+import distance_metrics
+import numpy as np
+import pandas as pd
+import pytest
+
+
+FEATURE_NAMES = ["a", "b", "c", "d"]
+WEIGHTS = {"a": 0.5, "c": 2.0, "d": 0.0}
+OFFSETS = np.array([0, 25, 31, 70])
+
+def reference_distances(metric_name: str, source: np.ndarray, target: np.ndarray, all_rows: np.ndarray) -> np.ndarray:
+    """Distances of the metric between the weighted rows computed with scipy.
+    """
+    weights = np.array([WEIGHTS.get(name, 1.0) for name in FEATURE_NAMES])
+    if metric_name == "mahalanobis":
+        scales = np.sqrt(weights)[weights > 0]
+        kept = all_rows[:, weights > 0] * scales
+        inverse_covariance = np.linalg.inv(np.cov(kept, rowvar=False))
+        return cdist(source[:, weights > 0] * scales, target[:, weights > 0] * scales, "mahalanobis", VI=inverse_covariance)
+    return cdist(source, target, metric_name, w=weights)
+
+@pytest.fixture
+def rows() -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    rng = np.random.default_rng(5)
+    all_rows = rng.normal(size=(OFFSETS[-1], len(FEATURE_NAMES))) * [1, 3, 0.5, 2] + [0, 1, -2, 0]
+    return all_rows, all_rows[:40], all_rows[20:][:OFFSETS[-1]]
+
+@pytest.mark.parametrize("metric_name", distance_metrics.METRICS)
+def test_metric_spaces_match_scipy(rows, metric_name):
+    all_rows, source, target = rows
+    metric = distance_metrics.DistanceMetric(metric_name, WEIGHTS)
+    _, source_space, target_space = distance_metrics.metric_spaces(metric, FEATURE_NAMES, all_rows, source, target)
+    distances = distance_metrics.distances(metric_name, cdist(source_space, target_space, "sqeuclidean"))
+    np.testing.assert_allclose(distances, reference_distances(metric_name, source, target, all_rows), rtol=1e-9, atol=1e-12)
+
+@pytest.mark.parametrize("metric_name", distance_metrics.METRICS)
+@pytest.mark.parametrize("k", [1, 4])
+def test_top_k_neighbours_match_scipy(rows, metric_name, k):
+    all_rows, source, _ = rows
+    metric = distance_metrics.DistanceMetric(metric_name, WEIGHTS)
+    source_space, target_space = distance_metrics.metric_spaces(metric, FEATURE_NAMES, all_rows, source)[::-1]
+    blocks = list(nearest_neighbours.top_k_neighbours(source_space, target_space, OFFSETS, k, 0.01, metric_name))
+    indices = np.concatenate([block[1] for block in blocks])
+    distances = np.concatenate([block[2] for block in blocks])
+    reference = reference_distances(metric_name, source, all_rows, all_rows)
+    # The distances of the areas to themselves are the square roots of the rounding errors of the matrix product
+    for municipality, (start, stop) in enumerate(zip(OFFSETS[:-1], OFFSETS[1:])):
+        expected = np.sort(reference[:, start:stop], axis=1)[:, :k]
+        np.testing.assert_allclose(distances[:, municipality], expected, rtol=1e-7, atol=1e-6)
+        np.testing.assert_allclose(np.take_along_axis(reference, indices[:, municipality], axis=1), expected, rtol=1e-7, atol=1e-6)
+
+def test_unknown_weights_and_metrics_fail():
+    with pytest.raises(ValueError, match="unknown features"):
+        distance_metrics.feature_weights(distance_metrics.DistanceMetric(weights={"x": 1.0}), FEATURE_NAMES)
+    with pytest.raises(ValueError, match="Unknown distance metric"):
+        distance_metrics.metric_from_config({"metric": "manhattan"})
+
+def features_frames(all_rows: np.ndarray) -> list[pd.DataFrame]:
+    return [pd.DataFrame({"Postal code": [f"{row:05d}" for row in range(start, stop)], "municipality": f"M{i}",
+                          **dict(zip(FEATURE_NAMES, all_rows[start:stop].T))})
+            for i, (start, stop) in enumerate(zip(OFFSETS[:-1], OFFSETS[1:]))]
+
+def test_float32_is_used_when_the_neighbours_agree(mappings, rows):
+    all_rows, _, _ = rows
+    metric = distance_metrics.DistanceMetric(dtype="float32", accuracy_check_rows=50)
+    source_space, target_space = mappings.metric_spaces(metric, features_frames(all_rows), all_rows, all_rows, OFFSETS, 2, 16)
+    assert source_space.dtype == np.float32 and target_space.dtype == np.float32
+    agreement, error = nearest_neighbours.neighbour_agreement(all_rows, all_rows, OFFSETS, 2, 16, "euclidean", 50)
+    assert agreement == 1.0
+    assert error < 1e-3
+
+def test_float32_falls_back_to_float64(mappings):
+    # Areas far from the origin that differ by much less than the float32 rounding of their squared lengths
+    rng = np.random.default_rng(6)
+    all_rows = 1e4 + rng.normal(size=(OFFSETS[-1], len(FEATURE_NAMES))) * 1e-3
+    agreement, _ = nearest_neighbours.neighbour_agreement(all_rows, all_rows, OFFSETS, 1, 16, "euclidean", 50)
+    assert agreement < 0.99
+    metric = distance_metrics.DistanceMetric(dtype="float32", accuracy_check_rows=50)
+    source_space, target_space = mappings.metric_spaces(metric, features_frames(all_rows), all_rows, all_rows, OFFSETS, 1, 16)
+    assert source_space.dtype == np.float64 and target_space.dtype == np.float64
+
+@pytest.mark.parametrize("metric_name", distance_metrics.METRICS)
+def test_areas_with_missing_features_do_not_change_the_others(mappings, rows, metric_name):
+    all_rows, _, _ = rows
+    municipalities = ["Espoo", "Helsinki", "Vantaa"]
+    all_features = [pd.DataFrame({"Postal code": [f"{row:05d}" for row in range(start, stop)], "municipality": municipality,
+                                  **dict(zip(FEATURE_NAMES, all_rows[start:stop].T))})
+                    for municipality, start, stop in zip(municipalities, OFFSETS[:-1], OFFSETS[1:])]
+    metric = distance_metrics.DistanceMetric(metric_name, WEIGHTS)
+    missing = all_features[1].loc[2, "Postal code"]
+    all_features[1].loc[2, "b"] = np.nan
+    result = pd.concat(mappings.compute_top_k_mappings(all_features, municipalities, 3, 0.01, metric=metric), ignore_index=True)
+    # The mappings are the same as without the area, also the covariance of the Mahalanobis distance
+    all_features[1] = all_features[1].drop(index=2)
+    expected = pd.concat(mappings.compute_top_k_mappings(all_features, municipalities, 3, 0.01, metric=metric), ignore_index=True)
+    assert missing not in result["Postal code"].tolist() and missing not in result["Similar postal code"].tolist()
+    pd.testing.assert_frame_equal(result.drop(columns="Distance"), expected.drop(columns="Distance"), check_dtype=False)
+    np.testing.assert_allclose(result["Distance"], expected["Distance"], rtol=1e-9, atol=1e-9)
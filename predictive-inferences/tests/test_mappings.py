@@ -0,0 +1,75 @@
+import pandas as pd
+import numpy as np
+import pytest
+
+
+MUNICIPALITIES = ["Espoo", "Helsinki", "Kauniainen", "Vantaa"]
+COUNTS = [23, 41, 2, 17]
+
+def municipality_features(seed: int = 0) -> list[pd.DataFrame]:
+    rng = np.random.default_rng(seed)
+    return [pd.DataFrame({"Postal code": [f"{municipality_index}{row:04d}" for row in range(count)], "municipality": municipality,
+                          **{feature: rng.normal(size=count) for feature in ["a", "b", "c", "d"]}})
+            for municipality_index, (municipality, count) in enumerate(zip(MUNICIPALITIES, COUNTS))]
+
+def brute_force_mappings(all_features: list[pd.DataFrame], k: int, source_municipalities: list[str],
+                         target_municipalities: list[str]) -> pd.DataFrame:
+    """Baseline of the top k mappings looping over the source areas and the target municipalities.
+    """
+    rows = []
+    for source in [all_features[MUNICIPALITIES.index(municipality)] for municipality in source_municipalities]:
+        for _, area in source.iterrows():
+            for municipality in target_municipalities:
+                if municipality == area["municipality"]:
+                    continue
+                target = all_features[MUNICIPALITIES.index(municipality)]
+                distances = np.sqrt(((target.iloc[:, 2:].to_numpy() - area.iloc[2:].to_numpy(dtype=float))**2).sum(axis=1))
+                for rank, nearest in enumerate(np.argsort(distances, kind="stable")[:k]):
+                    rows.append((area["Postal code"], municipality, rank + 1, target["Postal code"].iloc[nearest], distances[nearest]))
+    return pd.DataFrame(rows, columns=["Postal code", "Municipality", "Rank", "Similar postal code", "Distance"])
+
+@pytest.mark.parametrize("k", [1, 3])
+@pytest.mark.parametrize("source_municipalities, target_municipalities", [(None, None), (["Helsinki", "Kauniainen"], None),
+                                                                          (None, ["Vantaa", "Espoo"]), (["Vantaa"], ["Vantaa", "Kauniainen"])])
+def test_top_k_mappings_match_the_brute_force(mappings, k, source_municipalities, target_municipalities):
+    all_features = municipality_features()
+    result = pd.concat(mappings.compute_top_k_mappings(all_features, MUNICIPALITIES, k, 0.01, source_municipalities, target_municipalities),
+                       ignore_index=True)
+    expected = brute_force_mappings(all_features, k, source_municipalities or MUNICIPALITIES, target_municipalities or MUNICIPALITIES)
+    pd.testing.assert_frame_equal(result.drop(columns="Distance"), expected.drop(columns="Distance"), check_dtype=False)
+    np.testing.assert_allclose(result["Distance"], expected["Distance"], rtol=1e-9, atol=1e-6)
+
+def test_mappings_are_the_closest_areas(mappings):
+    all_features = municipality_features()
+    result = pd.concat(mappings.compute_mappings(all_features, MUNICIPALITIES, 0.01))
+    expected = brute_force_mappings(all_features, 1, MUNICIPALITIES, MUNICIPALITIES)
+    expected = expected.pivot(index="Postal code", columns="Municipality", values="Similar postal code")
+    expected = expected.reindex(index=result.index, columns=MUNICIPALITIES).astype(object)
+    # Areas are not mapped to their own municipality
+    expected = expected.where(expected.notna(), None)
+    pd.testing.assert_frame_equal(result, expected, check_names=False)
+
+def full_mappings(mappings, all_features: list[pd.DataFrame], k: int) -> pd.DataFrame:
+    if k == 1:
+        return pd.concat(mappings.compute_mappings(all_features, MUNICIPALITIES, 0.01))
+    return pd.concat(mappings.compute_top_k_mappings(all_features, MUNICIPALITIES, k, 0.01), ignore_index=True)
+
+@pytest.mark.parametrize("k", [1, 3])
+def test_updated_mappings_match_the_recomputed_ones(mappings, k):
+    previous_features = municipality_features(0)
+    all_features = [municipality_features(1)[index] if municipality == "Helsinki" else features
+                    for index, (municipality, features) in enumerate(zip(MUNICIPALITIES, previous_features))]
+    updated = mappings.update_mappings(full_mappings(mappings, previous_features, k), all_features, MUNICIPALITIES, ["Helsinki"], k, 0.01)
+    pd.testing.assert_frame_equal(updated, full_mappings(mappings, all_features, k), check_dtype=False)
+
+def test_areas_with_missing_features_are_not_mapped(mappings):
+    all_features = municipality_features()
+    all_features[1].loc[5, "b"] = np.nan
+    missing = all_features[1].loc[5, "Postal code"]
+    closest = pd.concat(mappings.compute_mappings(all_features, MUNICIPALITIES, 0.01))
+    top_k = pd.concat(mappings.compute_top_k_mappings(all_features, MUNICIPALITIES, 3, 0.01), ignore_index=True)
+    assert not (closest == missing).any().any() and missing not in top_k["Similar postal code"].tolist()
+    assert closest.loc[missing].isna().all() and missing not in top_k["Postal code"].tolist()
+    first = top_k.loc[top_k["Rank"] == 1].pivot(index="Postal code", columns="Municipality", values="Similar postal code")
+    first = first.reindex(index=closest.index, columns=MUNICIPALITIES).astype(object)
+    pd.testing.assert_frame_equal(closest, first.where(first.notna(), None), check_names=False)
@@ -0,0 +1,85 @@
+import nearest_neighbours
+import pandas as pd
+import numpy as np
+import pytest
+
+
+# Municipalities of different sizes, including an empty one and ones smaller than k
+COUNTS = [40, 2, 1, 0, 130, 17, 64, 3]
+
+def brute_force_neighbours(source: np.ndarray, target: np.ndarray, offsets: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+    """Baseline of the top k neighbours looping over the source rows and the municipalities.
+    """
+    indices = np.full((source.shape[0], len(offsets) - 1, k), -1)
+    distances = np.full((source.shape[0], len(offsets) - 1, k), np.inf)
+    for row in range(source.shape[0]):
+        for municipality, (start, stop) in enumerate(zip(offsets[:-1], offsets[1:])):
+            row_distances = np.sqrt(((target[start:stop] - source[row])**2).sum(axis=1))
+            nearest = np.argsort(row_distances, kind="stable")[:k]
+            # Rows with missing features have no distance
+            nearest = nearest[~np.isnan(row_distances[nearest])]
+            indices[row, municipality, :len(nearest)] = start + nearest
+            distances[row, municipality, :len(nearest)] = row_distances[nearest]
+    return indices, distances
+
+@pytest.mark.parametrize("k", [1, 3, 5])
+@pytest.mark.parametrize("memory_limit_mb", [0.01, 100])
+def test_top_k_neighbours_match_the_brute_force(k, memory_limit_mb):
+    rng = np.random.default_rng(k)
+    offsets = np.cumsum([0, *COUNTS])
+    target = rng.normal(size=(offsets[-1], 6))
+    source = rng.normal(size=(203, 6))
+    blocks = list(nearest_neighbours.top_k_neighbours(source, target, offsets, k, memory_limit_mb))
+    assert (len(blocks) > 1) == (memory_limit_mb < 1)
+    indices = np.concatenate([block_indices for _, block_indices, _ in blocks])
+    distances = np.concatenate([block_distances for _, _, block_distances in blocks])
+    expected_indices, expected_distances = brute_force_neighbours(source, target, offsets, k)
+    np.testing.assert_array_equal(indices, expected_indices)
+    np.testing.assert_allclose(distances, expected_distances, rtol=1e-9, atol=1e-6)
+
+@pytest.mark.parametrize("k", [1, 3])
+def test_rows_with_missing_features_are_not_neighbours(k):
+    rng = np.random.default_rng(k)
+    offsets = np.cumsum([0, *COUNTS])
+    target = rng.normal(size=(offsets[-1], 6))
+    missing = [0, 41, 50]
+    target[missing, 2] = np.nan
+    source = target[::3]
+    (_, indices, distances), = nearest_neighbours.top_k_neighbours(source, target, offsets, k, 100)
+    expected_indices, expected_distances = brute_force_neighbours(source, target, offsets, k)
+    np.testing.assert_array_equal(indices, expected_indices)
+    np.testing.assert_allclose(distances, expected_distances, rtol=1e-9, atol=1e-6)
+    assert not np.isin(indices, missing).any()
+    assert (indices[0] == -1).all() and np.isinf(distances[0]).all()
+
+def test_small_municipalities_are_padded():
+    offsets = np.cumsum([0, *COUNTS])
+    target = np.random.default_rng(0).normal(size=(offsets[-1], 3))
+    (_, indices, distances), = nearest_neighbours.top_k_neighbours(target[:10], target, offsets, 4, 100)
+    for municipality, count in enumerate(COUNTS):
+        assert (indices[:, municipality, count:] == -1).all()
+        assert np.isinf(distances[:, municipality, count:]).all()
+        assert (indices[:, municipality, :count] >= offsets[municipality]).all()
+        assert np.isfinite(distances[:, municipality, :count]).all()
+
+@pytest.mark.parametrize("k", [1, 4, 200])
+def test_group_layout_covers_every_row_once(k):
+    offsets = np.cumsum([0, *COUNTS])
+    layout = nearest_neighbours.group_layout(offsets, k)
+    municipalities = np.concatenate([municipality_indices for municipality_indices, _, _ in layout])
+    assert sorted(municipalities) == list(range(len(COUNTS)))
+    for municipality_indices, padded, valid in layout:
+        assert padded.shape == valid.shape and padded.shape[1] >= k
+        for municipality, rows, row_valid in zip(municipality_indices, padded, valid):
+            np.testing.assert_array_equal(rows[row_valid], np.arange(offsets[municipality], offsets[municipality + 1]))
+
+def test_build_feature_index_concatenates_the_municipalities():
+    rng = np.random.default_rng(0)
+    all_features = [pd.DataFrame({"Postal code": [f"{municipality}{row:04d}" for row in range(count)], "municipality": str(municipality),
+                                  "a": rng.normal(size=count), "b": rng.normal(size=count)})
+                    for municipality, count in enumerate(COUNTS)]
+    feature_matrix, postal_codes, offsets = nearest_neighbours.build_feature_index(all_features)
+    combined = pd.concat(all_features, ignore_index=True)
+    np.testing.assert_array_equal(feature_matrix, combined[["a", "b"]].to_numpy())
+    np.testing.assert_array_equal(postal_codes, combined["Postal code"].to_numpy())
+    np.testing.assert_array_equal(offsets, np.cumsum([0, *COUNTS]))
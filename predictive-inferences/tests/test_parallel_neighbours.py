@@ -0,0 +1,49 @@
+import nearest_neighbours
+import numpy as np
+import pytest
+import os
+
+
+def serial_and_parallel(pool, source, target, offsets, k, metric_name="euclidean", memory_limit_mb=0.05):
+    serial = list(nearest_neighbours.top_k_neighbours(source, target, offsets, k, memory_limit_mb, metric_name))
+    parallel = list(nearest_neighbours.parallel_top_k_neighbours(source, target, offsets, k, memory_limit_mb, metric_name, pool))
+    return [np.concatenate([block[i] for block in blocks]) for blocks in (serial, parallel) for i in (1, 2)]
+
+@pytest.fixture(scope="module")
+def pool():
+    with nearest_neighbours.worker_pool(2) as pool:
+        yield pool
+
+@pytest.mark.parametrize("k", [1, 3])
+@pytest.mark.parametrize("dtype", [np.float64, np.float32])
+def test_parallel_results_are_identical_to_serial(pool, monkeypatch, k, dtype):
+    monkeypatch.setattr(nearest_neighbours, "PARALLEL_MIN_ROWS", 0)
+    rng = np.random.default_rng(k)
+    # Municipalities of different sizes, including ones smaller than k
+    offsets = np.cumsum([0, 40, 2, 1, 130, 17, 64])
+    target = rng.normal(size=(offsets[-1], 5)).astype(dtype)
+    source = rng.normal(size=(301, 5)).astype(dtype)
+    serial_indices, serial_distances, parallel_indices, parallel_distances = serial_and_parallel(pool, source, target, offsets, k)
+    np.testing.assert_array_equal(parallel_indices, serial_indices)
+    np.testing.assert_array_equal(parallel_distances, serial_distances)
+
+def test_pool_is_reused_by_consecutive_searches(pool, monkeypatch):
+    monkeypatch.setattr(nearest_neighbours, "PARALLEL_MIN_ROWS", 0)
+    rng = np.random.default_rng(0)
+    for rows in [50, 120]:
+        offsets = np.array([0, rows // 2, rows])
+        target = rng.normal(size=(rows, 4))
+        serial_indices, serial_distances, parallel_indices, parallel_distances = serial_and_parallel(pool, target, target, offsets, 2, "cosine")
+        np.testing.assert_array_equal(parallel_indices, serial_indices)
+        np.testing.assert_array_equal(parallel_distances, serial_distances)
+    assert not any(name.endswith(".npy") for name in os.listdir(pool.directory))
+
+def test_small_searches_are_serial(pool):
+    rng = np.random.default_rng(1)
+    target = rng.normal(size=(20, 3))
+    blocks = list(nearest_neighbours.parallel_top_k_neighbours(target, target, np.array([0, 10, 20]), 1, 256, "euclidean", pool))
+    assert len(blocks) == 1
+
+def test_one_worker_has_no_pool():
+    with nearest_neighbours.worker_pool(1) as pool:
+        assert pool is None
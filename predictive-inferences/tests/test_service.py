@@ -0,0 +1,79 @@
+from aiohttp.test_utils import TestClient, TestServer
+import similarity_index
+import numpy as np
+import service
+import asyncio
+import pytest
+
+
+MUNICIPALITIES = ["Helsinki", "Espoo", "Vantaa"]
+OFFSETS = np.array([0, 8, 14, 20])
+
+@pytest.fixture
+def config(tmp_path) -> dict:
+    rng = np.random.default_rng(4)
+    postal_codes = np.array([f"{code:05d}" for code in range(100, 100 + OFFSETS[-1])])
+    similarity_index.write_similarity_index(str(tmp_path), rng.normal(size=(OFFSETS[-1], 4)), postal_codes, OFFSETS,
+                                            MUNICIPALITIES, ["a", "b", "c", "d"])
+    return {"index": {"directory": str(tmp_path)},
+            "service": {"default_k": 3, "cache_size": 16, "reload_interval_seconds": 3600}}
+
+def request(config: dict, method: str, path: str, **kwargs) -> tuple[int, dict | list | str]:
+    """Send a request to the service created with the config and return the status and the body of the response.
+    """
+    async def send():
+        async with TestClient(TestServer(service.create_app(config))) as client:
+            response = await client.request(method, path, **kwargs)
+            if response.content_type == "application/json":
+                return response.status, await response.json()
+            return response.status, await response.text()
+    return asyncio.run(send())
+
+def expected_similar(config: dict, postal_code: str, k: int, municipalities: list[str] | None = None) -> list[str]:
+    index = similarity_index.load_similarity_index(config["index"]["directory"])
+    return [similar_postal_code for similar_postal_code, _, _ in similarity_index.query_similar_areas(index, postal_code, k, municipalities)]
+
+def test_get_similar(config):
+    status, body = request(config, "GET", "/similar", params={"postal_code": "00105"})
+    assert status == 200
+    assert body["postal_code"] == "00105"
+    assert [area["postal_code"] for area in body["similar"]] == expected_similar(config, "00105", 3)
+    assert all(area["postal_code"] != "00105" for area in body["similar"])
+
+    status, body = request(config, "GET", "/similar", params={"postal_code": "00105", "k": "2", "municipalities": "Espoo, Vantaa"})
+    assert status == 200
+    assert [area["postal_code"] for area in body["similar"]] == expected_similar(config, "00105", 2, ["Espoo", "Vantaa"])
+    assert {area["municipality"] for area in body["similar"]} <= {"Espoo", "Vantaa"}
+
+def test_get_invalid_queries(config):
+    assert request(config, "GET", "/similar", params={"postal_code": "99999"})[0] == 404
+    assert request(config, "GET", "/similar")[0] == 404
+    assert request(config, "GET", "/similar", params={"postal_code": "00105", "k": "two"})[0] == 400
+    assert request(config, "GET", "/similar", params={"postal_code": "00105", "k": "0"})[0] == 400
+    assert request(config, "GET", "/similar", params={"postal_code": "00105", "municipalities": "Turku"})[0] == 400
+
+def test_post_similar(config):
+    queries = [{"postal_code": "00105", "k": 2}, {"postal_code": "00110", "municipalities": ["Helsinki"]}]
+    status, body = request(config, "POST", "/similar", json=queries)
+    assert status == 200
+    assert [area["postal_code"] for area in body[0]["similar"]] == expected_similar(config, "00105", 2)
+    assert [area["postal_code"] for area in body[1]["similar"]] == expected_similar(config, "00110", 3, ["Helsinki"])
+
+@pytest.mark.parametrize("query", [
+    {"postal_code": "00105", "k": [1]},
+    {"postal_code": "00105", "k": {}},
+    {"postal_code": "00105", "k": "2"},
+    {"postal_code": "00105", "k": True},
+    {"postal_code": ["00105"]},
+    {"postal_code": {"code": "00105"}},
+    {"postal_code": "00105", "municipalities": "Helsinki"},
+    {"postal_code": "00105", "municipalities": [["Helsinki"]]},
+    {"postal_code": "00105", "municipalities": [{}]},
+])
+def test_post_invalid_types(config, query):
+    assert request(config, "POST", "/similar", json=[query])[0] == 400
+
+def test_post_invalid_bodies(config):
+    assert request(config, "POST", "/similar", data="not json")[0] == 400
+    assert request(config, "POST", "/similar", json={"postal_code": "00105"})[0] == 400
+    assert request(config, "POST", "/similar", json=[{"postal_code": "99999"}])[0] == 404
@@ -0,0 +1,83 @@
+import similarity_index
+import storage_backends
+import distance_metrics
+import numpy as np
+import pandas as pd
+import pytest
+import os
+
+
+MUNICIPALITIES = ["Helsinki", "Espoo", "Vantaa"]
+OFFSETS = np.array([0, 30, 45, 60])
+
+@pytest.fixture
+def index_directory(tmp_path) -> str:
+    rng = np.random.default_rng(3)
+    postal_codes = np.array([f"{code:05d}" for code in range(OFFSETS[-1])])
+    similarity_index.write_similarity_index(str(tmp_path), rng.normal(size=(OFFSETS[-1], 5)), postal_codes, OFFSETS,
+                                            MUNICIPALITIES, ["a", "b", "c", "d", "e"])
+    return str(tmp_path)
+
+def test_tree_uses_the_memory_mapped_features(index_directory):
+    assert sorted(os.listdir(index_directory)) == sorted(similarity_index.INDEX_FILES)
+    index = similarity_index.load_similarity_index(index_directory)
+    assert isinstance(index.features, np.memmap)
+    assert np.shares_memory(index.tree.data, index.features)
+
+@pytest.mark.parametrize("municipalities", [None, ["Espoo"], ["Helsinki", "Vantaa"]])
+def test_query_matches_brute_force(index_directory, municipalities):
+    index = similarity_index.load_similarity_index(index_directory)
+    features = np.asarray(index.features)
+    for row in [0, 31, 59]:
+        postal_code = str(index.postal_codes[row])
+        targets = np.arange(OFFSETS[-1]) if municipalities is None else np.concatenate(
+            [np.arange(OFFSETS[MUNICIPALITIES.index(municipality)], OFFSETS[MUNICIPALITIES.index(municipality) + 1]) for municipality in municipalities])
+        targets = targets[targets != row]
+        distances = np.sqrt(((features[targets] - features[row])**2).sum(axis=1))
+        expected = targets[np.argsort(distances, kind="stable")[:4]]
+        similar = similarity_index.query_similar_areas(index, postal_code, 4, municipalities)
+        assert [similar_postal_code for similar_postal_code, _, _ in similar] == [str(index.postal_codes[target]) for target in expected]
+        np.testing.assert_allclose([distance for _, _, distance in similar], np.sort(distances)[:4])
+        assert [municipality for _, municipality, _ in similar] == [similarity_index.municipality_of_row(index, target) for target in expected]
+
+@pytest.mark.parametrize("metric_name", ["euclidean", "cosine", "mahalanobis"])
+def test_index_measures_the_distances_of_the_mappings(mappings, tmp_path, metric_name):
+    rng = np.random.default_rng(8)
+    all_features = [pd.DataFrame({"Postal code": [f"{i}{row:04d}" for row in range(size)], "municipality": municipality,
+                                  **{name: rng.normal(size=size) for name in ["a", "b", "c"]}})
+                    for i, (municipality, size) in enumerate(zip(MUNICIPALITIES, np.diff(OFFSETS)))]
+    metric = distance_metrics.DistanceMetric(metric_name, {"a": 2.0, "c": 0.5})
+    mappings.store_similarity_index(storage_backends.MemoryBackend(), str(tmp_path), all_features, MUNICIPALITIES, None, 2, metric)
+    index = similarity_index.load_similarity_index(str(tmp_path))
+    assert index.metric == metric
+
+    top_k = pd.concat(mappings.compute_top_k_mappings(all_features, MUNICIPALITIES, 3, metric=metric), ignore_index=True)
+    for postal_code in ["00000", "10003", "20014"]:
+        expected = top_k.loc[top_k["Postal code"] == postal_code]
+        for municipality, rows in expected.groupby("Municipality"):
+            similar = similarity_index.query_similar_areas(index, postal_code, 3, [municipality])
+            assert [similar_postal_code for similar_postal_code, _, _ in similar] == rows["Similar postal code"].to_list()
+            np.testing.assert_allclose([distance for _, _, distance in similar], rows["Distance"], rtol=1e-9, atol=1e-12)
+        # The KD-tree over all the areas gives the same distances as comparing to the areas of every municipality
+        similar = similarity_index.query_similar_areas(index, postal_code, 3)
+        compared = similarity_index.query_similar_areas(index, postal_code, 3, MUNICIPALITIES)
+        assert [similar_postal_code for similar_postal_code, _, _ in similar] == [similar_postal_code for similar_postal_code, _, _ in compared]
+        np.testing.assert_allclose([distance for _, _, distance in similar], [distance for _, _, distance in compared], rtol=1e-9, atol=1e-12)
+
+def test_areas_with_missing_features_are_left_out(tmp_path):
+    rng = np.random.default_rng(4)
+    features = rng.normal(size=(OFFSETS[-1], 5))
+    missing = [3, 30, 31]
+    features[missing, 1] = np.nan
+    postal_codes = np.array([f"{code:05d}" for code in range(OFFSETS[-1])])
+    similarity_index.write_similarity_index(str(tmp_path), features, postal_codes, OFFSETS, MUNICIPALITIES, ["a", "b", "c", "d", "e"])
+    index = similarity_index.load_similarity_index(str(tmp_path))
+    kept = np.delete(np.arange(OFFSETS[-1]), missing)
+    assert list(index.rows) == postal_codes[kept].tolist()
+    np.testing.assert_array_equal(index.features, features[kept])
+    np.testing.assert_array_equal(index.offsets, [0, 29, 42, 57])
+    for municipalities in [None, ["Espoo"]]:
+        similar = similarity_index.query_similar_areas(index, "00032", 5, municipalities)
+        assert len(similar) == 5 and not {postal_code for postal_code, _, _ in similar} & set(postal_codes[missing])
+        assert all(municipality == MUNICIPALITIES[int(np.searchsorted(OFFSETS, int(postal_code), side="right")) - 1]
+                   for postal_code, municipality, _ in similar)